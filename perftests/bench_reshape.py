@@ -0,0 +1,260 @@
+'''
+Benchmark the scan and reshape operations on synthetic pool-file sets.
+
+For each source pool count, a synthetic pool-file set is generated (see
+synth_pools.py), and then each requested operation is timed for each target
+pool count and process count.  Every measurement runs in a fresh forked
+subprocess so that its peak RSS can be reported separately.  Results are
+written as JSON lines, one per measurement, with these fields:
+
+    op, src_pools, tgt_pools, processes, scheduler, nkpt, bytes, seconds,
+    mb_per_s, files_per_s, peak_rss_mb, peak_child_rss_mb
+
+Example:
+
+    python perftests/bench_reshape.py -w /tmp/bench --src-pools 16,64 \
+        --tgt-pools 32,48,128 --processes 4,8,16 -k 20000 -o results.jsonl
+'''
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pertool import reshape
+from pertool.main import make_parser as make_pertool_parser
+from pertool.poolfiles import PoolFileSet
+
+from synth_pools import NKQ_DISTRIBUTIONS, generate_pool_files
+
+
+OPERATIONS = ['scan', 'scan_mp', 'reshape', 'reshape_mp']
+DEFAULT_SCHEDULERS = 'target'
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Benchmark pertool ' +
+        'scan and reshape operations on synthetic pool files.')
+
+    parser.add_argument('-w', '--workdir', required=True,
+        help='Scratch directory for the synthetic source and target files.  ' +
+             'Point this at the filesystem you want to measure.')
+
+    parser.add_argument('--src-pools', default='8',
+        help='Comma-separated list of source pool counts.  Default is 8.')
+
+    parser.add_argument('--tgt-pools', default='4,16',
+        help='Comma-separated list of target pool counts.  Default is 4,16.')
+
+    parser.add_argument('--processes', default='4',
+        help='Comma-separated list of --max-processes values for the ' +
+             'multiprocessing operations.  Default is 4.')
+
+    parser.add_argument('--schedulers', default=DEFAULT_SCHEDULERS,
+        help='Comma-separated list of reshape schedulers to time for ' +
+             f'reshape_mp.  Default is {DEFAULT_SCHEDULERS}.')
+
+    parser.add_argument('--ops', default=','.join(OPERATIONS),
+        help=f'Comma-separated list of operations to time, from {OPERATIONS}.  ' +
+             'Default is all of them.')
+
+    parser.add_argument('-k', '--nkpt', type=int, default=2000,
+        help='Total number of k-locations.  Default is 2000.')
+
+    parser.add_argument('--nkq-mean', type=int, default=1000,
+        help='Mean number of k-q pairs per k-location.  Default is 1000.')
+
+    parser.add_argument('--nkq-dist', choices=NKQ_DISTRIBUTIONS, default='lognormal',
+        help='Distribution of the number of k-q pairs per k-location.  ' +
+             'Default is lognormal.')
+
+    parser.add_argument('--dtype', default='float64',
+        help='NumPy dtype of the eph_g2 datasets.  Default is float64.')
+
+    parser.add_argument('--chunks', type=int,
+        help='Chunk length of the source datasets.  Default is contiguous.')
+
+    parser.add_argument('--compression', choices=['gzip', 'lzf'],
+        help='Compression filter for chunked source datasets.')
+
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+        help='Number of times to repeat each measurement.  Default is 1.')
+
+    parser.add_argument('-o', '--output',
+        help='File to append JSON-lines results to.  Default is standard output.')
+
+    return parser
+
+
+def parse_int_list(s):
+    return [int(v) for v in s.split(',') if v.strip()]
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_operation(op, src_dir, tgt_dir, tgt_pools, processes, scheduler):
+    '''
+    Run one operation, with its output discarded.  Returns the number of
+    files that were processed.
+    '''
+    sfset = PoolFileSet(src_dir)
+    sfset.find_files()
+
+    if op == 'scan':
+        sfset.scan_files()
+        sfset.close_all()
+        return sfset.num_pools
+
+    if op == 'scan_mp':
+        sfset.scan_files_mp(max_processes=processes)
+        sfset.close_all()
+        return sfset.num_pools
+
+    # Reshape operations start from an already-scanned source, so that only
+    # the write phase is timed.
+    sfset.scan_files()
+    args = make_pertool_parser().parse_args(['reshape', '-q', '-f', src_dir,
+        '-t', tgt_dir, '-p', str(tgt_pools), '-M', str(processes),
+        '--scheduler', scheduler] + (['--mp'] if op == 'reshape_mp' else []))
+
+    start = time.perf_counter()
+    if op == 'reshape':
+        reshape.write_new_target_files(args, sfset)
+    elif scheduler == 'source':
+        reshape.sm_write_new_target_files(args, sfset)
+    elif scheduler == 'batched':
+        reshape.batched_write_new_target_files(args, sfset)
+    else:
+        reshape.mp_write_new_target_files(args, sfset, max_processes=processes)
+    sfset.close_all()
+
+    return (sfset.num_pools + tgt_pools, time.perf_counter() - start)
+
+
+def measure_child(conn, op, src_dir, tgt_dir, tgt_pools, processes, scheduler):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        result = run_operation(op, src_dir, tgt_dir, tgt_pools, processes, scheduler)
+        seconds = time.perf_counter() - start
+
+    if isinstance(result, tuple):
+        (files, seconds) = result
+    else:
+        files = result
+
+    conn.send( (files, seconds, max_rss_mb(resource.RUSAGE_SELF),
+                max_rss_mb(resource.RUSAGE_CHILDREN)) )
+    conn.close()
+
+
+def measure(op, src_dir, tgt_dir, tgt_pools, processes, scheduler) -> tuple:
+    '''
+    Run one measurement in a fresh forked subprocess, returning the number
+    of files processed, the elapsed time, and the peak RSS of the process and
+    of its largest subprocess, in megabytes.
+    '''
+    if os.path.exists(tgt_dir):
+        shutil.rmtree(tgt_dir)
+
+    ctx = multiprocessing.get_context('fork')
+    (parent_conn, child_conn) = ctx.Pipe()
+    p = ctx.Process(target=measure_child,
+        args=(child_conn, op, src_dir, tgt_dir, tgt_pools, processes, scheduler))
+    p.start()
+
+    # Close the parent's copy of the child's end, so that recv() raises
+    # EOFError rather than hanging if the child dies without sending.
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    p.join()
+
+    if p.exitcode != 0 or result is None:
+        raise RuntimeError(f'Benchmark of {op} failed')
+
+    return result
+
+
+def main():
+    args = make_parser().parse_args()
+
+    ops = [op.strip() for op in args.ops.split(',') if op.strip()]
+    for op in ops:
+        if op not in OPERATIONS:
+            print(f'ERROR:  Unrecognized operation {op}')
+            sys.exit(1)
+
+    schedulers = [s.strip() for s in args.schedulers.split(',') if s.strip()]
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+
+    for src_pools in parse_int_list(args.src_pools):
+        src_dir = os.path.join(args.workdir, f'src-{src_pools}')
+        tgt_dir = os.path.join(args.workdir, 'target')
+
+        if os.path.exists(src_dir):
+            shutil.rmtree(src_dir)
+        print(f'Generating {src_pools} synthetic pool files in {src_dir}', file=sys.stderr)
+        generate_pool_files(src_dir, src_pools, args.nkpt, nkq_mean=args.nkq_mean,
+            nkq_dist=args.nkq_dist, dtype=args.dtype, chunks=args.chunks,
+            compression=args.compression)
+        nbytes = dir_size(src_dir)
+
+        # Build the list of (op, tgt_pools, processes, scheduler) cases
+        cases = []
+        for op in ops:
+            tgt_list = parse_int_list(args.tgt_pools) if op.startswith('reshape') else [0]
+            proc_list = parse_int_list(args.processes) if op.endswith('_mp') else [1]
+            sched_list = schedulers if op == 'reshape_mp' else ['target']
+            for tgt_pools in tgt_list:
+                for processes in proc_list:
+                    for scheduler in sched_list:
+                        cases.append( (op, tgt_pools, processes, scheduler) )
+
+        for (op, tgt_pools, processes, scheduler) in cases:
+            for _ in range(args.repeat):
+                (files, seconds, rss, child_rss) = measure(op, src_dir, tgt_dir,
+                    tgt_pools, processes, scheduler)
+
+                result = {
+                    'op': op,
+                    'src_pools': src_pools,
+                    'tgt_pools': tgt_pools or None,
+                    'processes': processes,
+                    'scheduler': scheduler if op == 'reshape_mp' else None,
+                    'nkpt': args.nkpt,
+                    'bytes': nbytes,
+                    'seconds': round(seconds, 6),
+                    'mb_per_s': round(nbytes / 1e6 / seconds, 3),
+                    'files_per_s': round(files / seconds, 3),
+                    'peak_rss_mb': round(rss, 1),
+                    'peak_child_rss_mb': round(child_rss, 1),
+                }
+                print(json.dumps(result), file=out, flush=True)
+
+    if os.path.exists(os.path.join(args.workdir, 'target')):
+        shutil.rmtree(os.path.join(args.workdir, 'target'))
+
+    if args.output:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''
+Generate a synthetic set of Perturbo eph_g2 pool files, for exercising the
+I/O-heavy analyze/reshape operations without running Perturbo.
+
+The files follow Perturbo's layout:  k-location ``k`` (zero-based) is stored
+in pool ``k % pools`` as the datasets ``eph_g2_{i}`` and ``bands_index_{i}``,
+where ``i = k // pools + 1``.  Both datasets have one row per k-q pair.
+
+Example:
+
+    python perftests/synth_pools.py -t /tmp/synth-64 -p 64 -k 20000 \
+        --nkq-dist lognormal --chunks 4096 --compression gzip
+'''
+
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pertool.poolfiles import make_pool_filename
+
+
+NKQ_DISTRIBUTIONS = ['uniform', 'lognormal', 'constant']
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Generate a synthetic set ' +
+        'of Perturbo eph_g2 pool files.')
+
+    parser.add_argument('-t', '--todir', required=True,
+        help='Directory to write the pool files to.  It must be empty or not exist.')
+
+    parser.add_argument('-p', '--pools', type=int, default=8,
+        help='Number of pool files to generate.  Default is 8.')
+
+    parser.add_argument('-k', '--nkpt', type=int, default=1000,
+        help='Total number of k-locations.  Default is 1000.')
+
+    parser.add_argument('--prefix', default='synth',
+        help='Pool file-name prefix.  Default is "synth".')
+
+    parser.add_argument('--nkq-mean', type=int, default=1000,
+        help='Mean number of k-q pairs per k-location.  Default is 1000.')
+
+    parser.add_argument('--nkq-dist', choices=NKQ_DISTRIBUTIONS, default='uniform',
+        help='Distribution of the number of k-q pairs per k-location.  ' +
+             '"lognormal" gives the skewed sizes seen in real runs.  ' +
+             'Default is uniform.')
+
+    parser.add_argument('--width', type=int, default=1,
+        help='Number of eph_g2 values per k-q pair.  Default is 1.')
+
+    parser.add_argument('--dtype', default='float64',
+        help='NumPy dtype of the eph_g2 datasets.  Default is float64.')
+
+    parser.add_argument('--chunks', type=int,
+        help='Chunk length (in k-q pairs) of each dataset.  Default is ' +
+             'contiguous storage.')
+
+    parser.add_argument('--compression', choices=['gzip', 'lzf'],
+        help='Compression filter to use for chunked datasets.')
+
+    parser.add_argument('--seed', type=int, default=0,
+        help='Random-number seed.  Default is 0.')
+
+    return parser
+
+
+def make_nkq(rng, nkpt, mean, dist):
+    if dist == 'constant':
+        return np.full(nkpt, mean, dtype=np.int64)
+
+    if dist == 'uniform':
+        return rng.integers(1, 2 * mean, size=nkpt)
+
+    # Lognormal with sigma 1 has mean exp(mu + 1/2)
+    return np.maximum(1, rng.lognormal(np.log(mean) - 0.5, 1.0, size=nkpt).astype(np.int64))
+
+
+def generate_pool_files(todir, pools, nkpt, prefix='synth', nkq_mean=1000,
+                        nkq_dist='uniform', width=1, dtype='float64', chunks=None,
+                        compression=None, seed=0) -> int:
+    '''
+    Generate the pool files, returning the total number of bytes of data
+    written.
+    '''
+    os.makedirs(todir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    nkq = make_nkq(rng, nkpt, nkq_mean, nkq_dist)
+
+    files = []
+    for pool in range(pools):
+        filename = os.path.join(todir, make_pool_filename(prefix, pool + 1))
+        files.append(h5py.File(filename, 'w'))
+
+    nbytes = 0
+    for i_kloc in range(nkpt):
+        n = int(nkq[i_kloc])
+        f = files[i_kloc % pools]
+        index = i_kloc // pools + 1
+
+        eph_g2 = rng.random((n, width) if width > 1 else n).astype(dtype)
+        bands_index = rng.integers(1, 100, size=n, dtype=np.int32)
+
+        eph_g2_layout = {}
+        bands_index_layout = {}
+        if chunks:
+            eph_g2_layout = {'chunks': (min(chunks, n),) + eph_g2.shape[1:],
+                             'compression': compression}
+            bands_index_layout = {'chunks': (min(chunks, n),),
+                                  'compression': compression}
+
+        f.create_dataset(f'eph_g2_{index}', data=eph_g2, **eph_g2_layout)
+        f.create_dataset(f'bands_index_{index}', data=bands_index, **bands_index_layout)
+
+        nbytes += eph_g2.nbytes + bands_index.nbytes
+
+    for f in files:
+        f.close()
+
+    return nbytes
+
+
+def main():
+    args = make_parser().parse_args()
+
+    if os.path.exists(args.todir) and os.listdir(args.todir):
+        print(f'ERROR:  Existing files found in {args.todir}, aborting.')
+        sys.exit(1)
+
+    nbytes = generate_pool_files(args.todir, args.pools, args.nkpt,
+        prefix=args.prefix, nkq_mean=args.nkq_mean, nkq_dist=args.nkq_dist,
+        width=args.width, dtype=args.dtype, chunks=args.chunks,
+        compression=args.compression, seed=args.seed)
+
+    print(f'Wrote {args.nkpt} k-locations ({nbytes / 1e6:.1f} MB) into ' +
+          f'{args.pools} pool files in {args.todir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
 import argparse
 import os
 import sys
+import time
+
+import numpy as np
 
 from .poolfiles import *
+from .manifest import ScanManifest
+from . import stats
+
+
+DEFAULT_MAX_IMBALANCE = 1.10
+
+# Number of recommended pool counts to report
+NUM_RECOMMENDED = 5
 
 
 def init_parser(subparsers):
@@ -18,6 +29,35 @@ def init_parser(subparsers):
     parser.add_argument('-M', '--max-processes', type=int, default=DEFAULT_MAX_PROCESSES,
         help=f'Specify maximum number of subprocesses to use.  Default is {DEFAULT_MAX_PROCESSES}.')
 
+    parser.add_argument('--pools', metavar='COUNTS',
+        help='Predict the load of each pool if the files were reshaped to ' +
+             'these pool counts, given as a comma-separated list (e.g. ' +
+             '"64,96,128") and/or ranges FIRST:LAST[:STEP] (e.g. "32:256:8"), ' +
+             'and recommend the best-balanced ones.')
+
+    parser.add_argument('--max-imbalance', type=float, default=DEFAULT_MAX_IMBALANCE,
+        help='Largest ratio of the most loaded pool\'s k-q pairs to the mean ' +
+             'for a pool count to be recommended with --pools.  Default is ' +
+             f'{DEFAULT_MAX_IMBALANCE}.')
+
+    parser.add_argument('--index', action='store_true',
+        help='Also build and save a k-location index of the pool files, for ' +
+             'tools that look up individual k-locations.')
+
+    parser.add_argument('--profile', action='store_true',
+        help='Report per-phase timings and the slowest files when finished.')
+
+    parser.add_argument('--stats-json', metavar='PATH',
+        help='Write per-phase and per-file timings and I/O statistics to ' +
+             'the specified JSON file when finished.')
+
+    parser.add_argument('--no-cache', action='store_true',
+        help='Always rescan every source file, ignoring and not writing the scan manifest.')
+
+    parser.add_argument('--cache-dir',
+        help='Directory to keep the scan manifest in.  Default is the source ' +
+             'directory, or the user cache directory if that isn\'t writable.')
+
 
 def check_args(args):
     # Check arguments
@@ -27,6 +67,17 @@ def check_args(args):
         print(f'ERROR:  {args.fromdir} is not a directory')
         sys.exit(1)
 
+    if args.max_imbalance < 1.0:
+        print(f'ERROR:  --max-imbalance can\'t be less than 1; got {args.max_imbalance}')
+        sys.exit(1)
+
+    if args.pools is not None:
+        try:
+            parse_pool_counts(args.pools)
+        except ValueError as e:
+            print(f'ERROR:  {e}')
+            sys.exit(1)
+
     if args.mp:
         print(f'\nUsing multiprocessing to speed up performance.  Max processes = {args.max_processes}.')
 
@@ -53,21 +104,131 @@ def scan_source_directory(args):
     print(f'Found {sfset.num_pools} files:')
 
     progress=lambda pool, f : file_scan_progress(pool, f, max_filename_len)
+    manifest = None
+    if not args.no_cache:
+        manifest = ScanManifest(args.fromdir, cache_dir=args.cache_dir)
+        manifest.load()
+
     if args.mp:
-        sfset.scan_files_mp(progress=progress, max_processes=args.max_processes)
+        sfset.scan_files_mp(progress=progress, max_processes=args.max_processes,
+            manifest=manifest)
     else:
-        sfset.scan_files(progress=progress)
+        sfset.scan_files(progress=progress, manifest=manifest)
+
+    if sfset.num_cached > 0:
+        print(f'Used cached scan results for {sfset.num_cached} of {sfset.num_pools} files.')
 
     return sfset
 
 
+def parse_pool_counts(spec) -> list:
+    '''
+    Parse a list of pool counts like "64,96,128" or "32:256:8" (inclusive)
+    into a sorted list of distinct counts.  Raises ``ValueError`` if it is
+    invalid.
+    '''
+    counts = set()
+    for part in spec.split(','):
+        values = [int(value) for value in part.split(':')]
+        if len(values) == 1:
+            counts.add(values[0])
+        elif len(values) in (2, 3):
+            step = values[2] if len(values) == 3 else 1
+            if step < 1:
+                raise ValueError(f'Pool-count range step must be positive; got {part}')
+            counts.update(range(values[0], values[1] + 1, step))
+        else:
+            raise ValueError(f'Expected a pool count or FIRST:LAST[:STEP]; got {part}')
+
+    if not counts or min(counts) < 1:
+        raise ValueError(f'Pool counts must be positive; got {spec}')
+    return sorted(counts)
+
+
+def predict_pool_loads(kloc_nkq, num_pools) -> np.ndarray:
+    '''
+    Return the number of k-q pairs each pool would hold if the k-locations
+    with the specified numbers of k-q pairs were divided between
+    ``num_pools`` pools, round-robin (see ``kloc_index_to_pool_index()``).
+    '''
+    pools = np.arange(len(kloc_nkq)) % num_pools
+    return np.bincount(pools, weights=kloc_nkq, minlength=num_pools).astype(np.int64)
+
+
+def pool_count_report(sfset, counts) -> list:
+    '''
+    Predict the per-pool load of the scanned pool-file set for each of the
+    specified pool counts, from the scan results alone.  Returns a list of
+    dictionaries, one per pool count, with the largest, smallest and mean
+    k-q pairs per pool, the imbalance (largest over mean), and the largest
+    number of bytes per pool.  Bytes are estimated from the source files'
+    sizes, in proportion to their numbers of k-q pairs.
+    '''
+    kloc_nkq = np.array(sfset.global_kloc_nkq(), dtype=np.int64)
+    total_bytes = sum(os.path.getsize(f.filename) for f in sfset.pool_files.values())
+    bytes_per_kq = total_bytes / max(1, sfset.nkq)
+
+    report = []
+    for num_pools in counts:
+        loads = predict_pool_loads(kloc_nkq, num_pools)
+        mean = loads.mean()
+        report.append({
+            'pools': num_pools,
+            'max_nkq': int(loads.max()),
+            'min_nkq': int(loads.min()),
+            'mean_nkq': float(mean),
+            'imbalance': float(loads.max() / mean) if mean > 0 else float('inf'),
+            'max_bytes': int(loads.max() * bytes_per_kq),
+        })
+    return report
+
+
+def print_pool_count_report(sfset, report, max_imbalance):
+    print(f'\nPredicted load per pool for {len(report)} pool count(s):')
+    print(f'  {"pools":>7}  {"max nkq":>12}  {"min nkq":>12}  {"mean nkq":>12}  ' +
+          f'{"max/mean":>8}  {"max MB":>10}')
+    for entry in report:
+        note = '  (more pools than k-locations)' if entry['pools'] > sfset.nkpt else ''
+        print(f'  {entry["pools"]:7}  {entry["max_nkq"]:12}  {entry["min_nkq"]:12}  ' +
+              f'{entry["mean_nkq"]:12.1f}  {entry["imbalance"]:8.3f}  ' +
+              f'{entry["max_bytes"] / 1e6:10.1f}{note}')
+
+    # Any balanced pool count is good enough, and among those, more pools
+    # means more MPI tasks sharing the work, so the largest are best.  (The
+    # most evenly balanced counts are usually trivially small ones.)
+    balanced = [entry for entry in report
+                if entry['imbalance'] <= max_imbalance and entry['pools'] <= sfset.nkpt]
+    if not balanced:
+        print(f'\nNone of these pool counts is balanced to within {max_imbalance:.2f}.')
+        return
+
+    best = sorted(balanced, key=lambda entry: (-entry['pools'], entry['imbalance']))
+    counts = ', '.join(str(entry['pools']) for entry in best[:NUM_RECOMMENDED])
+    print(f'\nRecommended pool counts (balanced to within {max_imbalance:.2f}, largest first):  {counts}')
+
+
 def main(args):
+    start = time.perf_counter()
     check_args(args)
 
-    sfset = scan_source_directory(args)
+    with stats.phase('stage_scan'):
+        sfset = scan_source_directory(args)
     print(f'\nTotal k-grid points:  {sfset.nkpt}\tTotal k-q pairs:  {sfset.nkq}')
 
     sfset.close_all()
+
+    report = None
+    if args.pools is not None:
+        report = pool_count_report(sfset, parse_pool_counts(args.pools))
+        print_pool_count_report(sfset, report, args.max_imbalance)
+
+    if args.index:
+        sfset.build_kloc_index(cache_dir=args.cache_dir)
+        print(f'Saved k-location index of {sfset.nkpt} k-locations.')
+
+    stats.emit(time.perf_counter() - start, args.profile, args.stats_json,
+        command='analyze', src_pools=sfset.num_pools, nkpt=sfset.nkpt, nkq=sfset.nkq,
+        pool_counts=report)
     sys.exit(0)
 
 if __name__ == '__main__':
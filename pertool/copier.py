@@ -0,0 +1,308 @@
+from typing import Optional
+
+import h5py
+import numpy as np
+
+# Optional:  registers extra HDF5 compression filters
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+COPY_MODES = ['auto', 'buffered', 'numpy']
+DEFAULT_COPY_MODE = 'auto'
+DEFAULT_COPY_BUFFER_MB = 64
+
+PRESERVE = 'preserve'
+BUILTIN_COMPRESSIONS = ['none', 'gzip', 'lzf']
+PLUGIN_COMPRESSIONS = ['zstd', 'lz4', 'blosc', 'bitshuffle']
+COMPRESSIONS = [PRESERVE] + BUILTIN_COMPRESSIONS + PLUGIN_COMPRESSIONS
+DEFAULT_GZIP_LEVEL = 4
+
+# The HDF5 filter IDs of the built-in compressions, and of the filters that
+# don't compress
+COMPRESSION_FILTERS = {'gzip': h5py.h5z.FILTER_DEFLATE, 'lzf': h5py.h5z.FILTER_LZF}
+NON_COMPRESSION_FILTERS = {h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_FLETCHER32,
+                           h5py.h5z.FILTER_SCALEOFFSET}
+
+
+def dataset_layout(ds, layout=None) -> dict:
+    '''
+    Return the storage layout of the dataset ``ds`` as a dictionary of
+    ``create_dataset()`` keyword arguments, so that a copy of the data can
+    be written with the same chunking and filters.  If an ``OutputLayout``
+    is specified, its settings override the dataset's own layout.
+    '''
+    if layout is not None and layout.changes_layout():
+        return layout.create_kwargs(ds)
+
+    if ds.chunks is None:
+        return {}
+
+    return {
+        'chunks': ds.chunks,
+        'compression': ds.compression,
+        'compression_opts': ds.compression_opts,
+        'shuffle': ds.shuffle,
+        'fletcher32': ds.fletcher32,
+    }
+
+
+class OutputLayout:
+    '''
+    The storage layout to write target datasets with.  Each setting may be
+    ``'preserve'`` to keep the source dataset's own setting:
+
+    *   ``compression`` - one of ``COMPRESSIONS``.  The plugin compressions
+        require the ``hdf5plugin`` package.
+
+    *   ``level`` - the compression level, or ``None`` for the filter's
+        default.
+
+    *   ``shuffle`` - ``True`` or ``False`` to enable or disable the byte
+        shuffle filter.
+
+    *   ``chunks`` - ``'auto'`` to let h5py choose a chunk shape, or the
+        number of rows (k-q pairs) per chunk as an integer.
+
+    Dataset types are always preserved.  Instances are plain objects so
+    that they can be passed to subprocesses.
+    '''
+
+    def __init__(self, compression=PRESERVE, level: Optional[int]=None,
+                 shuffle=PRESERVE, chunks=PRESERVE):
+        assert compression in COMPRESSIONS, f'Unrecognized compression {compression}'
+        if compression in PLUGIN_COMPRESSIONS and hdf5plugin is None:
+            raise ValueError(f'Compression {compression} requires the hdf5plugin package')
+
+        self.compression = compression
+        self.level = level
+        self.shuffle = shuffle
+        self.chunks = chunks
+
+    def changes_layout(self) -> bool:
+        '''
+        Report whether datasets written with this layout may be stored
+        differently from their sources, so they can't be copied verbatim.
+        '''
+        return (self.compression != PRESERVE or self.level is not None or
+                self.shuffle != PRESERVE or self.chunks != PRESERVE)
+
+    def params(self) -> dict:
+        '''
+        Return the settings as a dictionary of constructor arguments, e.g.
+        for recording in a reshape journal.
+        '''
+        return {'compression': self.compression, 'level': self.level,
+                'shuffle': self.shuffle, 'chunks': self.chunks}
+
+    def matches(self, ds) -> bool:
+        '''
+        Report whether the dataset ``ds`` is stored the way this layout
+        would write it.  Only the settings that aren't ``'preserve'`` are
+        checked, since the others depend on the source dataset.
+        '''
+        if len(ds.shape) == 0 or ds.size == 0:
+            return True
+
+        # The compression filters, by filter ID, with their parameters
+        dcpl = ds.id.get_create_plist()
+        filters = {}
+        for i in range(dcpl.get_nfilters()):
+            (code, _, values, _) = dcpl.get_filter(i)
+            if code not in NON_COMPRESSION_FILTERS:
+                filters[code] = values
+
+        if self.compression == 'none' and filters:
+            return False
+        if self.compression in COMPRESSION_FILTERS and \
+                set(filters) != {COMPRESSION_FILTERS[self.compression]}:
+            return False
+        if (self.compression in PLUGIN_COMPRESSIONS and
+                set(filters) != {self._plugin_filter(self.compression)['compression']}):
+            return False
+        if self.compression == 'gzip' and self.level is not None and \
+                filters[h5py.h5z.FILTER_DEFLATE][:1] != (self.level,):
+            return False
+
+        if self.shuffle != PRESERVE and ds.shuffle != self.shuffle:
+            return False
+
+        if isinstance(self.chunks, int) and (ds.chunks is None or
+                ds.chunks[0] != max(1, min(self.chunks, ds.shape[0]))):
+            return False
+
+        return True
+
+    def create_kwargs(self, ds) -> dict:
+        '''
+        Return the ``create_dataset()`` keyword arguments for writing a copy
+        of the dataset ``ds`` with this layout.
+        '''
+        # Empty and scalar datasets can't be chunked
+        if len(ds.shape) == 0 or ds.size == 0:
+            return {}
+
+        kwargs = {}
+
+        compression = self.compression
+        if compression == PRESERVE:
+            compression = ds.compression or 'none'
+            if self.level is None and ds.compression is not None:
+                kwargs['compression_opts'] = ds.compression_opts
+
+        if compression == 'gzip':
+            kwargs['compression'] = 'gzip'
+            kwargs['compression_opts'] = self.level if self.level is not None \
+                else kwargs.get('compression_opts', DEFAULT_GZIP_LEVEL)
+        elif compression == 'lzf':
+            kwargs['compression'] = 'lzf'
+        elif compression in PLUGIN_COMPRESSIONS:
+            kwargs.update(self._plugin_filter(compression))
+        elif compression not in ('none', PRESERVE):
+            # Another filter h5py knows, i.e. szip; keep it as it is.
+            kwargs['compression'] = ds.compression
+            kwargs['compression_opts'] = ds.compression_opts
+
+        shuffle = ds.shuffle if self.shuffle == PRESERVE else self.shuffle
+        if shuffle:
+            kwargs['shuffle'] = True
+
+        if ds.fletcher32:
+            kwargs['fletcher32'] = True
+
+        # Filters require chunked storage
+        chunks = self.chunks
+        if chunks == PRESERVE:
+            chunks = ds.chunks
+        if chunks is None and kwargs:
+            chunks = 'auto'
+
+        if chunks == 'auto':
+            kwargs['chunks'] = True
+        elif isinstance(chunks, int):
+            kwargs['chunks'] = (max(1, min(chunks, ds.shape[0])),) + ds.shape[1:]
+        elif chunks is not None:
+            kwargs['chunks'] = chunks
+
+        return kwargs
+
+    def _plugin_filter(self, compression) -> dict:
+        level = {} if self.level is None else {'clevel': self.level}
+        if compression == 'zstd':
+            return dict(hdf5plugin.Zstd(**level))
+        if compression == 'lz4':
+            return dict(hdf5plugin.LZ4())
+        if compression == 'bitshuffle':
+            return dict(hdf5plugin.Bitshuffle())
+        return dict(hdf5plugin.Blosc(cname='zstd', **level))
+
+
+class DatasetCopier:
+    '''
+    Copies datasets from one HDF5 group to another without ever holding a
+    whole dataset in memory.  The copy ``mode`` may be one of:
+
+    *   ``'auto'`` - copy the dataset object with ``H5Ocopy``.  The HDF5
+        library moves the raw (still-compressed) data across itself, a chunk
+        or a small block at a time, and the target keeps the source's layout.
+
+    *   ``'buffered'`` - chunked datasets are copied with direct chunk
+        reads/writes, so the data is never decompressed or recompressed;
+        other datasets are copied in slabs through a reusable buffer of at
+        most ``buffer_size`` bytes.
+
+    *   ``'numpy'`` - read the entire dataset into a NumPy array and write it
+        out again.  This is how reshape used to work, and is kept for
+        comparison.
+
+    If an ``OutputLayout`` that changes the storage layout is specified,
+    the data has to be decoded and re-encoded, so the ``'auto'`` and
+    ``'buffered'`` modes both copy it in slabs through the buffer, into a
+    dataset created with the new layout.
+
+    Instances are plain objects so that they can be passed to subprocesses.
+    '''
+
+    def __init__(self, mode: str=DEFAULT_COPY_MODE,
+                 buffer_size: int=DEFAULT_COPY_BUFFER_MB * 1024 * 1024,
+                 layout: Optional[OutputLayout]=None):
+        assert mode in COPY_MODES, f'Unrecognized copy mode {mode}'
+        assert buffer_size > 0, f'Copy buffer size must be positive; got {buffer_size}'
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.layout = layout
+        if layout is not None and not layout.changes_layout():
+            self.layout = None
+
+    def copy(self, src_group, src_name: str, tgt_group, tgt_name: str) -> int:
+        '''
+        Copy the dataset ``src_name`` in ``src_group`` to a new dataset
+        ``tgt_name`` in ``tgt_group``.  Returns the number of bytes of data
+        that were copied, as stored in the source file.
+        '''
+        if self.mode == 'auto' and self.layout is None:
+            h5py.h5o.copy(src_group.id, src_name.encode(), tgt_group.id, tgt_name.encode())
+            return tgt_group[tgt_name].id.get_storage_size()
+
+        src = src_group[src_name]
+        if self.mode == 'numpy':
+            tgt_group.create_dataset(tgt_name, data=src, **dataset_layout(src, self.layout))
+        elif self.layout is not None:
+            self._copy_slabs(src, tgt_group, tgt_name, **self.layout.create_kwargs(src))
+        elif src.chunks is not None:
+            self._copy_chunks(src, tgt_group, tgt_name)
+        else:
+            self._copy_slabs(src, tgt_group, tgt_name)
+
+        return src.id.get_storage_size()
+
+    def _copy_chunks(self, src, tgt_group, tgt_name):
+        '''
+        Copy a chunked dataset one raw chunk at a time, keeping the source's
+        creation properties (chunk shape, filters, fill value) so that the
+        chunks can be written back unchanged.
+        '''
+        src_id = src.id
+        tgt_id = h5py.h5d.create(tgt_group.id, tgt_name.encode(), src_id.get_type(),
+            src_id.get_space(), dcpl=src_id.get_create_plist())
+
+        for i in range(src_id.get_num_chunks()):
+            offset = src_id.get_chunk_info(i).chunk_offset
+            (filter_mask, data) = src_id.read_direct_chunk(offset)
+            tgt_id.write_direct_chunk(offset, data, filter_mask)
+
+        self._copy_attrs(src, tgt_group[tgt_name])
+
+    def _copy_slabs(self, src, tgt_group, tgt_name, **kwargs):
+        '''
+        Copy a dataset in slabs along its first axis, through a buffer of at
+        most ``buffer_size`` bytes.  Any keyword arguments are passed through
+        to ``create_dataset()`` for the target.
+        '''
+        tgt = tgt_group.create_dataset(tgt_name, shape=src.shape, dtype=src.dtype, **kwargs)
+        self._copy_attrs(src, tgt)
+
+        if src.size == 0:
+            return
+
+        if len(src.shape) == 0:
+            tgt[()] = src[()]
+            return
+
+        row_bytes = src.dtype.itemsize * (src.size // src.shape[0])
+        rows = max(1, min(src.shape[0], self.buffer_size // max(1, row_bytes)))
+        if tgt.chunks is not None and rows > tgt.chunks[0]:
+            # Write whole target chunks, so none is compressed twice
+            rows -= rows % tgt.chunks[0]
+        buf = np.empty((rows,) + src.shape[1:], dtype=src.dtype)
+
+        for start in range(0, src.shape[0], rows):
+            n = min(rows, src.shape[0] - start)
+            src.read_direct(buf, source_sel=np.s_[start:start + n], dest_sel=np.s_[0:n])
+            tgt.write_direct(buf, source_sel=np.s_[0:n], dest_sel=np.s_[start:start + n])
+
+    def _copy_attrs(self, src, tgt):
+        for (name, value) in src.attrs.items():
+            tgt.attrs[name] = value
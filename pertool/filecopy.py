@@ -0,0 +1,212 @@
+'''
+Copying the non-template files of a template directory into generated
+target directories, as copies, hard links, reflinks or symbolic links.
+
+The link mode of each file is chosen by the first matching rule of the
+config file's "copy_rules", which match file names with shell-style
+wildcards, or otherwise by --link-mode:
+
+    "copy_rules": [
+        {"pattern": "*.epr", "mode": "hardlink"},
+        {"pattern": "*.h5", "mode": "reflink"}
+    ]
+
+The modes are:
+
+*   ``copy`` - copy the file, with ``copy_file_range()`` where available, so
+    the filesystem can share or offload the copy.
+*   ``hardlink`` - hard-link the file, which takes no space but shares it:
+    changes to the file in one directory show up in all of them.
+*   ``reflink`` - clone the file with the FICLONE ioctl, on filesystems
+    like Btrfs and XFS that support it.  The clone shares the original's
+    storage until either is changed, so it is as safe as a copy.
+*   ``symlink`` - make a relative symbolic link to the file.
+*   ``auto`` - sym-link directories and files of at least
+    ``LARGE_FILE_THRESHOLD`` bytes, and reflink other files.
+
+A hard link or reflink that the filesystem doesn't support (e.g. across
+filesystems) falls back to a copy, and the failure is only reported once per
+pair of filesystems.
+'''
+
+import errno
+import fnmatch
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+LINK_MODES = ['auto', 'copy', 'hardlink', 'reflink', 'symlink']
+DEFAULT_LINK_MODE = 'auto'
+
+LARGE_FILE_THRESHOLD = 500_000_000
+
+# The FICLONE ioctl from <linux/fs.h>
+FICLONE = 0x40049409
+
+# The copy_file_range() errors that mean "not supported here", rather than
+# a real I/O error
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL,
+                      errno.EPERM, errno.ENOTTY, errno.EBADF}
+
+# The (mode, source device, target device) combinations that have failed, so
+# they aren't tried again
+_unsupported = set()
+
+VERBS = {
+    'copy': 'Copying',
+    'hardlink': 'Hard-linking',
+    'reflink': 'Reflinking',
+    'symlink': 'Sym-linking',
+}
+
+
+def parse_copy_rules(config: dict) -> list:
+    '''
+    Return the config file's "copy_rules" as a list of ``(pattern, mode)``
+    pairs.  Raises ``ValueError`` if they are malformed.
+    '''
+    rules = []
+    for rule in config.get('copy_rules', []):
+        if not isinstance(rule, dict) or 'pattern' not in rule or 'mode' not in rule:
+            raise ValueError(f'Bad copy rule {rule}:  expected "pattern" and "mode"')
+        if rule['mode'] not in LINK_MODES:
+            raise ValueError(f'Bad copy rule {rule}:  unknown mode "{rule["mode"]}"; ' +
+                             f'expected one of {LINK_MODES}')
+        rules.append( (rule['pattern'], rule['mode']) )
+    return rules
+
+
+def choose_link_mode(source_path: str, link_mode: str, rules=()) -> str:
+    '''
+    Return the link mode to use for the source file or directory:  the mode
+    of the first rule matching its name, or else ``link_mode``, with
+    ``auto`` resolved to a specific mode.
+    '''
+    name = os.path.basename(source_path)
+    for (pattern, mode) in rules:
+        if fnmatch.fnmatch(name, pattern):
+            link_mode = mode
+            break
+
+    if link_mode == 'auto':
+        if os.path.isdir(source_path) or os.path.getsize(source_path) >= LARGE_FILE_THRESHOLD:
+            return 'symlink'
+        return 'reflink'
+
+    return link_mode
+
+
+def copy_file_contents(source_file: str, target_file: str):
+    '''
+    Copy a file's contents and permissions, with ``copy_file_range()`` if
+    the platform and filesystem support it, or ``shutil.copyfile()``.
+    '''
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(source_file, 'rb') as src, open(target_file, 'wb') as dst:
+                size = os.fstat(src.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            if copied == size:
+                shutil.copymode(source_file, target_file)
+                return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+
+    shutil.copyfile(source_file, target_file)
+    shutil.copymode(source_file, target_file)
+
+
+def reflink_file(source_file: str, target_file: str):
+    '''
+    Clone a file with the FICLONE ioctl.  Raises ``OSError`` if the
+    platform or filesystem doesn't support it.
+    '''
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks aren\'t supported on this platform')
+
+    with open(source_file, 'rb') as src, open(target_file, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(source_file, target_file)
+
+
+def _replace_with(make, source_path: str, target_path: str):
+    # Make the target at a temporary name and rename it over any existing
+    # target, so that generating into an existing directory works.
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        make(source_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def place_file(source_file: str, target_file: str, mode: str) -> str:
+    '''
+    Copy or link a file to ``target_file`` with the specified mode (not
+    ``auto``), falling back to a copy if a hard link or reflink isn't
+    supported.  Returns the mode actually used.
+    '''
+    if mode == 'symlink':
+        rel_source_path = os.path.relpath(source_file, start=os.path.dirname(target_file))
+        _replace_with(lambda _, tmp: os.symlink(rel_source_path, tmp), source_file, target_file)
+        return mode
+
+    if mode in ('hardlink', 'reflink'):
+        key = (mode, os.stat(source_file).st_dev,
+               os.stat(os.path.dirname(os.path.abspath(target_file))).st_dev)
+        if key not in _unsupported:
+            make = os.link if mode == 'hardlink' else reflink_file
+            try:
+                _replace_with(make, source_file, target_file)
+                return mode
+            except OSError as e:
+                _unsupported.add(key)
+                print(f'NOTE:  Can\'t {mode} "{source_file}" ({e.strerror}); ' +
+                      'copying files instead')
+
+    _replace_with(copy_file_contents, source_file, target_file)
+    return 'copy'
+
+
+def copy_into_dir(source_path: str, target_dir: str, link_mode: str=DEFAULT_LINK_MODE,
+                  rules=()) -> str:
+    '''
+    Copy or link a file or directory into the target directory, with the
+    link mode chosen by ``choose_link_mode()``.  A directory is sym-linked,
+    or else copied recursively with each file placed the same way.  Returns
+    the mode used.
+    '''
+    target_path = os.path.join(target_dir, os.path.basename(source_path))
+    mode = choose_link_mode(source_path, link_mode, rules)
+
+    if os.path.isdir(source_path) and mode != 'symlink':
+        print(f'Copying directory "{source_path}" into output directory "{target_dir}"')
+
+        def copy_function(src, dst):
+            place_file(src, dst, choose_link_mode(src, mode, rules))
+
+        shutil.copytree(source_path, target_path, symlinks=True, dirs_exist_ok=True,
+                        copy_function=copy_function)
+        return mode
+
+    if os.path.isdir(target_path) and not os.path.islink(target_path):
+        raise ValueError(f'Can\'t sym-link "{source_path}" over existing directory ' +
+                         f'"{target_path}"')
+
+    kind = 'directory' if os.path.isdir(source_path) else 'file'
+    mode = place_file(source_path, target_path, mode)
+    print(f'{VERBS[mode]} {kind} "{source_path}" into output directory "{target_dir}"')
+    return mode
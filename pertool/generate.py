@@ -1,5 +1,8 @@
 import argparse
+import contextlib
+import io
 import json
+import multiprocessing
 import os
 import shutil
 import sys
@@ -10,11 +13,17 @@ import jinja2
 import pathvalidate
 import yaml
 
+from . import filecopy
+from . import sweep
+from .genstate import GENERATE_STATE_FILENAME, GenerateState, TemplateDigests, \
+    hash_inputs, source_signature
+from .run import write_run_steps
+
 
 DEFAULT_CONFIGFILE_JSON = 'mp_conf.json'
 DEFAULT_CONFIGFILE_YAML = 'mp_conf.yml'
 
-LARGE_FILE_THRESHOLD = 500_000_000
+DEFAULT_JOBS = 1
 
 
 def init_parser(subparsers) -> None:
@@ -62,7 +71,71 @@ def init_parser(subparsers) -> None:
              'run template generation for all combinations of all ' +
              'variables specified.\n\n' +
              'Using a parameterized value for --todir is recommended when ' +
-             'using this feature.')
+             'using this feature.\n\n' +
+             'Values may include inclusive numeric ranges "FIRST:LAST" or ' +
+             '"FIRST:LAST:STEP"; for example "gridsize=[100:200:50]" is the ' +
+             'same as "gridsize=[100,150,200]".')
+
+    parser.add_argument('--zip', action='append', default=[],
+        metavar='NAME1,NAME2=[A1,A2,...],[B1,B2,...]',
+        help='Specify several variables whose values change together, ' +
+             'rather than in all combinations:  the first generation uses ' +
+             'A1 and B1, the second A2 and B2, and so on.  The value lists ' +
+             'must be the same length, and may include ranges like --foreach.')
+
+    parser.add_argument('--where', action='append', default=[],
+        metavar='EXPR',
+        help='Only generate the combinations of variables for which the ' +
+             'Python expression EXPR is true, e.g. "mpi_tasks %% nodes == 0".  ' +
+             'Variable values that look like numbers are numbers in EXPR.  ' +
+             'If --where is specified multiple times, every expression must ' +
+             'be true.')
+
+    parser.add_argument('--sample', type=int,
+        metavar='N',
+        help='Only generate N of the combinations of variables, chosen with ' +
+             'the --sample-method.')
+
+    parser.add_argument('--sample-method', choices=sweep.SAMPLE_METHODS,
+        default=sweep.DEFAULT_SAMPLE_METHOD,
+        help='How to choose the --sample combinations:  "random" chooses ' +
+             'them uniformly from the combinations that meet the --where ' +
+             'constraints, and "lhs" uses Latin-hypercube sampling of the ' +
+             'variables, so that each variable\'s values are evenly covered, ' +
+             'and then applies the constraints, so fewer than N may remain.  ' +
+             f'Default is "{sweep.DEFAULT_SAMPLE_METHOD}".')
+
+    parser.add_argument('--seed', type=int,
+        help='Random seed for --sample, to choose the same combinations ' +
+             'each time.')
+
+    parser.add_argument('--link-mode', choices=filecopy.LINK_MODES,
+        default=filecopy.DEFAULT_LINK_MODE,
+        help='How to put the template directory\'s non-template files into ' +
+             'each target directory:  "copy" copies them, "hardlink" ' +
+             'hard-links them (the target directories then share the same ' +
+             'files), "reflink" clones them on filesystems that support it ' +
+             '(like a copy, but without using more space), and "symlink" ' +
+             'sym-links them.  Hard links and reflinks fall back to copies ' +
+             'where they aren\'t supported.  "auto" sym-links directories and ' +
+             f'files of at least {filecopy.LARGE_FILE_THRESHOLD // 1_000_000} MB, ' +
+             'and reflinks other files.  The config file\'s "copy_rules" can ' +
+             'choose the mode for files by name.  Default is ' +
+             f'"{filecopy.DEFAULT_LINK_MODE}".')
+
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help='Only regenerate the outputs whose inputs have changed since ' +
+             'they were last generated, leaving the others untouched.  Each ' +
+             'target directory records what its outputs were generated ' +
+             f'from in a "{GENERATE_STATE_FILENAME}" file.  Outputs that ' +
+             'were changed or removed since are regenerated too.')
+
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+        help='Number of processes to generate --foreach target directories ' +
+             'with in parallel.  Each process\'s output is printed in the ' +
+             'same order as with one process, and if any target directory ' +
+             'fails, the others are still generated.  Default is ' +
+             f'{DEFAULT_JOBS}.')
 
 """
 def generate_target_dir(template_dir, target_dirname_template, template_context,
@@ -98,38 +171,181 @@ def generate_target_dir(template_dir, target_dirname_template, template_context,
         copy_file_to_dir(f, target_dirname, symlink_large_files=symlink_large_files)
 """
 
-def foreach_generate_target_dir_contents(foreach_vars, args, config, input_vars=None):
-    if input_vars is None:
-        input_vars = {}
+def make_sweep(args, config, foreach_vars) -> sweep.Sweep:
+    '''
+    Make the sweep over the "foreach"-variables, the --zip variables and the
+    config file's "sweep" section, with the --where constraints and --sample
+    sampling.  Raises ``ValueError`` if they are malformed.
+    '''
+    sw = sweep.Sweep()
+    sweep.add_config_sweep(sw, config)
+
+    for (name, values) in foreach_vars:
+        sw.add_axis([name], [values])
+
+    for s in args.zip:
+        sw.add_axis(*sweep.parse_arg_zip(s))
+
+    for expr in args.where:
+        try:
+            sw.add_constraint(expr)
+        except SyntaxError as e:
+            raise ValueError(f'Bad --where expression "{expr}":  {e.msg}') from None
+
+    if args.sample is not None:
+        sw.set_sample(args.sample, args.sample_method, args.seed)
+
+    return sw
+
+
+def make_jinja_env(args, config) -> jinja2.Environment:
+    '''
+    Create the Jinja environment that all target directories are generated
+    with, and compile every template the config file uses, so that each
+    template is only parsed once.
+    '''
+    jinja_loader = jinja2.FileSystemLoader(args.fromdir)
+    jinja_env = jinja2.Environment(loader=jinja_loader, undefined=jinja2.StrictUndefined,
+        cache_size=-1, auto_reload=False)
+
+    for step_config in config.get('steps', []):
+        for tmpl in step_config.get('templates', []):
+            jinja_env.get_template(tmpl['input'])
+
+    return jinja_env
 
-    if not foreach_vars:
-        generate_target_dir_contents(args, config, input_vars)
-        return
 
-    # This invocation takes care of the "foreach"-variable at the
-    # start of the list.  Pull it off, then recursively call
-    # foreach_generate_target_dir() to handle the next one.
-    (name, lst) = foreach_vars[0]
-    tail_foreach_vars = foreach_vars[1:]
-    for value in lst:
-        vars = dict(input_vars)
-        vars[name] = value
-        foreach_generate_target_dir_contents(tail_foreach_vars, args, config, vars)
+# The state of a --jobs worker process, set by init_generate_worker()
+_worker = {}
 
+def init_generate_worker(args, config):
+    _worker['args'] = args
+    _worker['config'] = config
+    _worker['jinja_env'] = make_jinja_env(args, config)
+    # For --incremental, which hashes each template's sources once per worker
+    _worker['digests'] = TemplateDigests(_worker['jinja_env'])
 
-def generate_target_dir_contents(args, config, input_vars=None):
-    # Set up the variables for this target directory
+
+def run_generate_worker(vars) -> tuple[str, Optional[str]]:
+    '''
+    Generate one target directory in a --jobs worker process.  Returns the
+    output that would have been printed, and an error message if it failed.
+    '''
+    output = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            (input_vars, sweep_vars) = vars
+            generate_target_dir_contents(_worker['args'], _worker['config'],
+                _worker['jinja_env'], _worker['digests'], input_vars, sweep_vars)
+        except Exception as e:
+            error = f'{type(e).__name__}:  {e}'
+            print(f'ERROR:  {error}')
+
+    return (output.getvalue(), error)
+
+
+def foreach_generate_target_dir_contents(sw, args, config, input_vars=None):
+    '''
+    Generate a target directory for every selected combination of the
+    sweep's variables, with --jobs processes.  Target directories are
+    generated, and their output printed, in a fixed order, and if any fail,
+    the rest are still generated.  Returns the list of ``(target directory,
+    error message)`` pairs of the target directories that failed.
+    '''
+    fixed_vars = dict(input_vars or {})
+    fixed_vars.update(config.get('variables', {}))
+
+    # With several jobs, check up front that every combination has its own
+    # target directory, since parallel jobs writing to the same directory
+    # would clash.  Serially, combinations may share a directory, e.g. when
+    # only the output file names use the variables.  Only the selected
+    # combinations are held, never the whole sweep.
+    todirs = []
+    combinations = []
+    seen = set()
+    duplicates = set()
+    for vars in sw.bindings(fixed_vars):
+        all_vars = dict(fixed_vars)
+        all_vars.update(vars)
+        todir = make_template_filename(args.todir, all_vars)
+        if todir in seen:
+            duplicates.add(todir)
+        seen.add(todir)
+        todirs.append(todir)
+        combinations.append(vars)
+
+    if duplicates and args.jobs > 1:
+        raise ValueError('Several combinations of variables generate the target ' +
+            f'directories {", ".join(sorted(duplicates))}; use the variables in --todir, ' +
+            'or generate them with --jobs 1')
+
+    if sw.axes:
+        print(f'Sweep has {sw.size()} combinations of variables; ' +
+              f'{len(combinations)} selected')
+
+    if args.dryrun:
+        swept = sw.names()
+        for (todir, vars) in zip(todirs, combinations):
+            print(f'{todir}:  ' + ', '.join(f'{name}={vars[name]}' for name in swept))
+        return []
+
+    if not combinations:
+        print('WARNING:  No combinations of variables selected; nothing to generate')
+        return []
+
+    errors = []
+    if args.jobs == 1:
+        jinja_env = make_jinja_env(args, config)
+        digests = TemplateDigests(jinja_env)
+        for (todir, vars) in zip(todirs, combinations):
+            try:
+                generate_target_dir_contents(args, config, jinja_env, digests, input_vars, vars)
+            except Exception as e:
+                print(f'ERROR:  {type(e).__name__}:  {e}')
+                errors.append( (todir, f'{type(e).__name__}:  {e}') )
+        return errors
+
+    exec_pool = multiprocessing.Pool(min(args.jobs, len(combinations)),
+        initializer=init_generate_worker, initargs=(args, config))
+    try:
+        results = exec_pool.imap(run_generate_worker,
+            [(input_vars, vars) for vars in combinations])
+        for (todir, (output, error)) in zip(todirs, results):
+            print(output, end='')
+            if error is not None:
+                errors.append( (todir, error) )
+    finally:
+        exec_pool.close()
+        exec_pool.join()
+
+    return errors
+
+
+def generate_target_dir_contents(args, config, jinja_env, digests, input_vars=None,
+                                 sweep_vars=None):
+    # ``digests`` is the TemplateDigests of jinja_env's templates, which
+    # --incremental uses.
+
+    # Set up the variables for this target directory.  Swept variables
+    # override the config file's variables, since they vary on purpose.
 
     if input_vars is None:
         input_vars = {}
 
     global_vars = dict(input_vars)
     global_vars.update(config.get('variables', {}))
+    global_vars.update(sweep_vars or {})
 
     # Make the target directory to generate stuff into
 
     todir = make_target_dir(args, global_vars)
 
+    state = None
+    if args.incremental:
+        state = GenerateState(todir)
+        state.load()
+
     # Go through all specified generation steps, generating output files
     # for all specified template files.
 
@@ -140,9 +356,7 @@ def generate_target_dir_contents(args, config, input_vars=None):
         print('Configuration contains no steps!')
         return
 
-    jinja_loader = jinja2.FileSystemLoader(args.fromdir)
-    jinja_env = jinja2.Environment(loader=jinja_loader, undefined=jinja2.StrictUndefined)
-
+    run_steps = []
     step_i = 0
     for step_config in steps:
         step_i += 1
@@ -155,6 +369,19 @@ def generate_target_dir_contents(args, config, input_vars=None):
         vars = dict(global_vars)
         vars.update(step_config.get('variables', {}))
 
+        # Record the step's command for the run command.  By default each
+        # step depends on the one before it.
+        depends = step_config.get('depends', [run_steps[-1]['name']] if run_steps else [])
+        for dep in depends:
+            if dep not in [step['name'] for step in run_steps]:
+                raise RuntimeError(f'Step {step_i} depends on "{dep}", which isn\'t ' +
+                                   'an earlier step')
+        run_steps.append({
+            'name': step_name,
+            'runcmd': format_runcmd(step_name, step_config.get('runcmd'), vars),
+            'depends': depends,
+        })
+
         if args.verbose:
             print('\nVariables:')
             for (k, v) in vars.items():
@@ -172,19 +399,63 @@ def generate_target_dir_contents(args, config, input_vars=None):
                 output_file = make_template_filename(tmpl['output'], vars)
                 output_path = os.path.join(todir, output_file)
 
+                if state is not None:
+                    input_hash = digests.inputs_hash(input_template, vars)
+                    if state.is_current(output_file, input_hash):
+                        print(f'Up to date:  "{output_path}"')
+                        continue
+
                 print(f'Processing template "{input_template}" into "{output_path}"')
-                generate_template_to_file(args, jinja_env, input_template, vars, output_path)
+                generate_template_to_file(args, jinja_env, input_template, vars, output_path,
+                                          only_if_changed=args.incremental)
+                if state is not None:
+                    state.update(output_file, input_hash)
 
     # Finally, copy over all other non-template files from the source
     # directory into the target directory.
 
+    copy_rules = filecopy.parse_copy_rules(config)
     source_files = os.listdir(args.fromdir)
     for filename in source_files:
         # TODO:  Would be good to exclude config file as well
-        if filename in template_files:
+        if filename in template_files or filename.startswith('.pertool_'):
             continue
 
-        copy_file_to_dir(os.path.join(args.fromdir, filename), todir)
+        source_path = os.path.join(args.fromdir, filename)
+        if state is not None:
+            mode = filecopy.choose_link_mode(source_path, args.link_mode, copy_rules)
+            input_hash = hash_inputs(source_signature(source_path, mode), mode, copy_rules)
+            if state.is_current(filename, input_hash):
+                print(f'Up to date:  "{os.path.join(todir, filename)}"')
+                continue
+
+        filecopy.copy_into_dir(source_path, todir, args.link_mode, copy_rules)
+        if state is not None:
+            state.update(filename, input_hash)
+
+    write_run_steps(todir, run_steps)
+
+    if state is not None:
+        state.save()
+
+
+def format_runcmd(step_name, runcmd, vars) -> Optional[str]:
+    '''
+    Substitute the variables into a step's runcmd.  Literal braces must be
+    written as "{{" and "}}"; a runcmd that can't be formatted is recorded
+    as it is written, with a warning, rather than failing the target
+    directory.
+    '''
+    if runcmd is None:
+        return None
+
+    try:
+        return runcmd.format_map(vars)
+    except (KeyError, ValueError, IndexError) as e:
+        print(f'WARNING:  Can\'t substitute variables into the runcmd of step ' +
+              f'"{step_name}" ({type(e).__name__}:  {e}); recording it unchanged.  ' +
+              'Write literal braces as "{{" and "}}".')
+        return runcmd
 
 
 def make_target_dir(args, vars):
@@ -214,10 +485,19 @@ def make_template_filename(template_str: str, variables: dict) -> str:
     return result
 
 
-def generate_template_to_file(args, jinja_env, source_file, variables, output_path):
+def generate_template_to_file(args, jinja_env, source_file, variables, output_path,
+        only_if_changed=False):
     template = jinja_env.get_template(source_file)
     output_text = template.render(**variables)
 
+    # Leave an output that already has the same contents untouched, so that
+    # its modification time doesn't change
+    if only_if_changed and os.path.isfile(output_path) and not os.path.islink(output_path):
+        with open(output_path) as f:
+            if f.read() == output_text:
+                shutil.copymode(os.path.join(args.fromdir, source_file), output_path)
+                return
+
     # Generate the file
     with open(output_path, 'w') as f:
         f.write(output_text)
@@ -226,27 +506,6 @@ def generate_template_to_file(args, jinja_env, source_file, variables, output_pa
     shutil.copystat(os.path.join(args.fromdir, source_file), output_path)
 
 
-def copy_file_to_dir(source_filepath, target_dir, symlink_large_files=True):
-    target_file = os.path.join(target_dir, os.path.basename(source_filepath))
-
-    filesize = os.path.getsize(source_filepath)
-    if symlink_large_files and filesize >= LARGE_FILE_THRESHOLD:
-        print(f'Sym-linking large file "{source_filepath}" into output directory "{target_dir}"')
-        rel_source_path = os.path.relpath(source_filepath, start=target_dir)
-        os.symlink(rel_source_path, target_file)
-    else:
-        if os.path.isdir(source_filepath):
-            # TODO:  Figure out when to copy and when to symlink
-            # shutil.copytree(source_filepath, target_file)
-
-            print(f'Sym-linking directory "{source_filepath}" into output directory "{target_dir}"')
-            rel_source_path = os.path.relpath(source_filepath, start=target_dir)
-            os.symlink(rel_source_path, target_file)
-        else:
-            print(f'Copying file "{source_filepath}" into output directory "{target_dir}"')
-            shutil.copy(source_filepath, target_file)
-
-
 def parse_arg_setvar(s: str) -> tuple[str, str]:
     '''
     Parse a --set NAME=VALUE argument into a (name,value) tuple.
@@ -286,6 +545,11 @@ def parse_arg_foreach(s: str) -> tuple[str, list]:
     if len(values) == 0:
         raise RuntimeError(f'Bad --foreach argument "{s}":  no values found in list')
 
+    try:
+        values = sweep.expand_values(values)
+    except ValueError as e:
+        raise RuntimeError(f'Bad --foreach argument "{s}":  {e}') from None
+
     return (name, values)
 
 
@@ -297,6 +561,10 @@ def check_args(args):
         print(f'ERROR:  "{args.fromdir}" is not a directory')
         sys.exit(1)
 
+    if args.jobs < 1:
+        print(f'ERROR:  Number of jobs must be positive; got {args.jobs}')
+        sys.exit(1)
+
 
 def load_config_file(args) -> dict:
     '''
@@ -311,9 +579,9 @@ def load_config_file(args) -> dict:
     config_path = args.config
     if config_path is not None:
         # User has specified a config file.  Try to load as JSON or YAML.
-        for mod in [json, yaml]:
+        for try_load in [try_load_config_json, try_load_config_yaml]:
             try:
-                config = try_load_config_json(config_path)
+                config = try_load(config_path)
                 break
             except:
                 continue
@@ -348,7 +616,7 @@ def try_load_config_json(filepath) -> dict:
 
 def try_load_config_yaml(filepath) -> dict:
     with open(filepath) as f:
-        return yaml.load(f)
+        return yaml.safe_load(f)
 
 
 def main(args: Optional[argparse.Namespace]=None) -> None:
@@ -386,6 +654,29 @@ def main(args: Optional[argparse.Namespace]=None) -> None:
         all_vars.add(name)
         foreach_vars.append(name_lst)
 
-    foreach_generate_target_dir_contents(foreach_vars, args, config, input_vars=cmdline_vars)
+    try:
+        filecopy.parse_copy_rules(config)
+        sw = make_sweep(args, config, foreach_vars)
+    except ValueError as e:
+        print(f'ERROR:  {e}')
+        sys.exit(1)
+
+    for name in sw.names():
+        if name in cmdline_vars:
+            print(f'ERROR:  variable "{name}" specified multiple times')
+            sys.exit(1)
+
+    try:
+        errors = foreach_generate_target_dir_contents(sw, args, config,
+            input_vars=cmdline_vars)
+    except (ValueError, KeyError, jinja2.TemplateError) as e:
+        print(f'ERROR:  {type(e).__name__}:  {e}')
+        sys.exit(1)
+
+    if errors:
+        print(f'\nERROR:  {len(errors)} target directories failed:')
+        for (todir, error) in errors:
+            print(f' * {todir}:  {error}')
+        sys.exit(1)
 
     print('\nDone!')
@@ -0,0 +1,193 @@
+'''
+Incremental generation for the generate command.
+
+With --incremental, each generated target directory keeps a state file,
+``.pertool_generate.json``, recording a hash of the inputs of every output
+file:  for a template, the digest of its source and of the templates it
+includes, imports or extends, and the values of the variables it uses; for
+a copied file, its stat signature and link mode.  An output whose inputs
+are unchanged, and which hasn't been edited or removed since it was
+written, is left untouched, so a rerun over many target directories only
+rewrites what has changed.
+'''
+
+import hashlib
+import json
+import os
+
+import jinja2
+import jinja2.meta
+
+from .filecopy import choose_link_mode
+
+
+GENERATE_STATE_FILENAME = '.pertool_generate.json'
+GENERATE_STATE_VERSION = 1
+
+
+def output_signature(filename: str) -> list:
+    '''
+    Return the stat signature used to decide whether a generated output has
+    been changed or removed since it was generated:  its size, modification
+    time and inode.  Symbolic links aren't followed.
+    '''
+    st = os.lstat(filename)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def hash_inputs(*inputs) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class TemplateDigests:
+    '''
+    The digests of the templates in a template directory, each covering the
+    template's source and permissions and those of every template it
+    includes, imports or extends, and the names of the variables they use.
+    Templates aren't reloaded during a run, so each template's digest is
+    only computed once.
+    '''
+
+    def __init__(self, jinja_env: jinja2.Environment):
+        self.jinja_env = jinja_env
+        self.digests = {}
+        self.variables = {}
+
+    def _scan(self, name: str):
+        # Guard against cycles while the digest is being computed
+        self.digests[name] = ''
+        self.variables[name] = set()
+
+        (source, filename, _) = self.jinja_env.loader.get_source(self.jinja_env, name)
+        ast = self.jinja_env.parse(source)
+        referenced = sorted(r for r in jinja2.meta.find_referenced_templates(ast)
+                            if r is not None)
+
+        variables = jinja2.meta.find_undeclared_variables(ast)
+        for ref in referenced:
+            if ref not in self.digests:
+                self._scan(ref)
+            variables |= self.variables[ref]
+
+        self.digests[name] = hash_inputs(source, os.stat(filename).st_mode,
+                                         [self.digests[ref] for ref in referenced])
+        self.variables[name] = variables
+
+    def inputs_hash(self, name: str, variables: dict) -> str:
+        '''
+        Return the hash of the inputs of rendering the template with the
+        specified variables:  the template's digest and the values of the
+        variables it uses.
+        '''
+        if name not in self.digests:
+            self._scan(name)
+
+        used = {k: v for (k, v) in variables.items() if k in self.variables[name]}
+        return hash_inputs(self.digests[name], used)
+
+
+def source_signature(source_path: str, mode: str) -> list:
+    '''
+    Return the stat signatures of a file or directory copied into target
+    directories with the specified link mode.  A copied directory's
+    signature covers every file in it; a sym-linked one only needs to
+    exist.
+    '''
+    if mode == 'symlink':
+        return [os.path.abspath(source_path)]
+
+    if not os.path.isdir(source_path):
+        return [os.path.abspath(source_path), os.stat(source_path).st_mode,
+                output_signature(source_path)]
+
+    signatures = []
+    for (dirpath, dirnames, filenames) in os.walk(source_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            signatures.append(source_signature(path, choose_link_mode(path, mode)))
+    return signatures
+
+
+class GenerateState:
+    '''
+    A sidecar file in a generated target directory, recording for each
+    output file a hash of the inputs it was generated from (the template
+    sources and variables, or the signature of the copied file and how it
+    was copied) and the output's signature once written.  An output whose
+    inputs are unchanged, and which hasn't itself been changed since, doesn't
+    need to be generated again.
+
+    Only outputs that were checked or updated during a run are kept when the
+    state is saved, so outputs that are no longer generated are forgotten.
+    '''
+
+    def __init__(self, todir: str):
+        self.todir = todir
+        self.filename = os.path.join(todir, GENERATE_STATE_FILENAME)
+        self.entries = {}
+        self.seen = set()
+
+    def load(self):
+        '''
+        Load the state, if it exists.  A missing, unreadable or other-version
+        state is simply treated as empty.
+        '''
+        self.entries = {}
+        self.seen = set()
+        try:
+            with open(self.filename) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if contents.get('version') == GENERATE_STATE_VERSION:
+            self.entries = contents.get('outputs', {})
+
+    def is_current(self, output: str, input_hash: str) -> bool:
+        '''
+        Return whether the output (a path relative to the target directory)
+        was generated from inputs with the specified hash, and is unchanged
+        since.
+        '''
+        self.seen.add(output)
+        entry = self.entries.get(output)
+        if entry is None or entry['inputs'] != input_hash:
+            return False
+
+        try:
+            return entry['signature'] == output_signature(os.path.join(self.todir, output))
+        except OSError:
+            return False
+
+    def update(self, output: str, input_hash: str):
+        '''
+        Record that the output has just been generated from inputs with the
+        specified hash.
+        '''
+        self.seen.add(output)
+        self.entries[output] = {
+            'inputs': input_hash,
+            'signature': output_signature(os.path.join(self.todir, output)),
+        }
+
+    def save(self):
+        '''
+        Write the state out, through a temporary file renamed into place.
+        Failure to write the state isn't fatal; the outputs will just be
+        generated again next time.
+        '''
+        outputs = {output: entry for (output, entry) in self.entries.items()
+                   if output in self.seen}
+        contents = {'version': GENERATE_STATE_VERSION, 'outputs': outputs}
+        tmp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump(contents, f)
+            os.replace(tmp_filename, self.filename)
+        except OSError:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            print(f'WARNING:  Couldn\'t write generate state for {self.todir}')
@@ -0,0 +1,269 @@
+import json
+import os
+import shutil
+import time
+
+from typing import Optional, Tuple
+
+from .copier import OutputLayout
+from .poolfiles import PoolFile
+
+
+JOURNAL_DIRNAME = '.pertool_journal'
+JOURNAL_VERSION = 1
+PARTIAL_SUFFIX = '.partial'
+
+JOURNAL_CHECKPOINT_INTERVAL = 10.0 # in seconds
+
+
+def partial_filename(filename: str) -> str:
+    '''
+    Return the temporary name a target pool file is written under until it
+    is complete.  Complete files are renamed to their final name, so a file
+    with its final name is never partially written.
+    '''
+    return filename + PARTIAL_SUFFIX
+
+
+def write_json_atomic(filename: str, contents):
+    '''
+    Write ``contents`` to the specified file as JSON, through a temporary
+    file that is synced and then renamed into place, so that the file is
+    always either its old or its new contents.
+    '''
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(contents, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+class ReshapeJournal:
+    '''
+    A journal of the progress of a reshape, kept in a hidden subdirectory of
+    the target directory so that an interrupted reshape can be resumed.
+
+    The journal records the parameters of the reshape, and for each target
+    pool either the number of entries of its copy plan (see
+    ``plan_target_copies()``) that have been written and flushed to its
+    partial file, or that the target file is complete.  Every record is a
+    separate small file replaced atomically, so that subprocesses writing
+    different target pools never contend, and a crash never leaves a
+    half-written record.
+
+    Like the pool files, target pools are numbered from zero here.
+    '''
+
+    def __init__(self, todir: str):
+        self.todir = todir
+        self.path = os.path.join(todir, JOURNAL_DIRNAME)
+
+    def exists(self) -> bool:
+        return os.path.isfile(os.path.join(self.path, 'params.json'))
+
+    def _target_filename(self, tgt_pool) -> str:
+        return os.path.join(self.path, f'target_{tgt_pool}.json')
+
+    def create(self, params: dict):
+        '''
+        Start a new journal for a reshape with the specified parameters,
+        discarding any existing journal.
+        '''
+        self.remove()
+        os.makedirs(self.path)
+        write_json_atomic(os.path.join(self.path, 'params.json'),
+            {'version': JOURNAL_VERSION, 'params': params})
+
+    def load_params(self) -> Optional[dict]:
+        '''
+        Return the parameters the journal was created with, or ``None`` if
+        the journal is missing, unreadable or from another version.
+        '''
+        try:
+            with open(os.path.join(self.path, 'params.json')) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if contents.get('version') != JOURNAL_VERSION:
+            return None
+
+        return contents['params']
+
+    def layout(self) -> Optional[OutputLayout]:
+        '''
+        Return the output layout the journal's target files are written
+        with, or ``None`` if it doesn't record one.
+        '''
+        params = self.load_params()
+        if params is None or 'layout' not in params:
+            return None
+        return OutputLayout(**params['layout'])
+
+    def target_state(self, tgt_pool) -> dict:
+        '''
+        Return the recorded state of the specified target pool, as a
+        dictionary with ``done`` (the number of plan entries written) and
+        ``complete`` entries.  Targets with no record have done nothing.
+        '''
+        try:
+            with open(self._target_filename(tgt_pool)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'done': 0, 'complete': False}
+
+    def checkpoint(self, tgt_pool, done):
+        '''
+        Record that the first ``done`` plan entries of the specified target
+        pool have been written and flushed to its partial file.
+        '''
+        write_json_atomic(self._target_filename(tgt_pool),
+            {'done': done, 'complete': False})
+
+    def complete(self, tgt_pool, done):
+        '''
+        Record that the specified target pool's file is complete, with all
+        ``done`` plan entries, and has been renamed to its final name.
+        '''
+        write_json_atomic(self._target_filename(tgt_pool),
+            {'done': done, 'complete': True})
+
+    def remove(self):
+        '''
+        Remove the journal, e.g. once the reshape has finished.
+        '''
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Checkpointer:
+    '''
+    Helper for a target writer that records a checkpoint in the journal at
+    most every ``interval`` seconds.  The target file is flushed before each
+    checkpoint, so that everything the journal says is done is on disk.
+    '''
+
+    def __init__(self, journal: Optional[ReshapeJournal], tgt_f, tgt_pool,
+                 interval=JOURNAL_CHECKPOINT_INTERVAL):
+        self.journal = journal
+        self.tgt_f = tgt_f
+        self.tgt_pool = tgt_pool
+        self.interval = interval
+        self.last = time.time()
+
+    def update(self, done):
+        if self.journal is None:
+            return
+
+        t = time.time()
+        if (t - self.last) >= self.interval:
+            self.tgt_f.hdf5.flush()
+            self.journal.checkpoint(self.tgt_pool, done)
+            self.last = t
+
+
+def expected_kloc_nkq(plan, sfset) -> list:
+    '''
+    Return the number of k-q pairs each (zero-based) target index of a
+    target pool should hold, given its copy plan from
+    ``plan_target_copies()`` and the scanned source pool-file set.
+    '''
+    expected = [0] * len(plan)
+    for (src_pool, src_idx, tgt_idx) in plan:
+        expected[tgt_idx] = sfset.pool_files[src_pool + 1].kloc_nkq[src_idx]
+    return expected
+
+
+def verify_target_file(filename, pool, expected, layout: Optional[OutputLayout]=None) -> bool:
+    '''
+    Check that a complete target pool file holds exactly the k-locations
+    it should, with the ``expected`` number of k-q pairs in each, and if a
+    ``layout`` is specified, that its datasets are stored with that layout.
+    Only metadata is read.
+    '''
+    f = PoolFile(filename, pool)
+    try:
+        f.scan_contents()
+        if f.kloc_nkq != expected:
+            return False
+
+        if layout is not None:
+            for i in range(1, f.nk_loc + 1):
+                for name in (f'eph_g2_{i}', f'bands_index_{i}'):
+                    if not layout.matches(f.hdf5[name]):
+                        return False
+
+        return True
+    except (OSError, ValueError):
+        return False
+    finally:
+        f.close()
+
+
+def resume_partial_file(tgt_f, plan, done, expected):
+    '''
+    Open an existing partial target file to continue writing it.  The first
+    ``done`` entries of the plan must be present with the expected sizes,
+    and any datasets for later entries, which may have been written after
+    the last checkpoint, are deleted.  Raises ``ValueError`` if the file
+    doesn't match the journal.
+    '''
+    tgt_f.open('a')
+    for (_, _, tgt_idx) in plan[:done]:
+        for name in (f'eph_g2_{tgt_idx + 1}', f'bands_index_{tgt_idx + 1}'):
+            if name not in tgt_f.hdf5 or len(tgt_f.hdf5[name]) != expected[tgt_idx]:
+                raise ValueError(f'{name} is missing or incomplete in {tgt_f.filename}')
+
+    for (_, _, tgt_idx) in plan[done:]:
+        for name in (f'eph_g2_{tgt_idx + 1}', f'bands_index_{tgt_idx + 1}'):
+            if name in tgt_f.hdf5:
+                del tgt_f.hdf5[name]
+
+
+def open_target_file(filename, tgt_pool, plan, sfset,
+                     journal: Optional[ReshapeJournal]) -> Tuple[Optional[PoolFile], int]:
+    '''
+    Open the (zero-based) target pool's file for writing under its partial
+    name, returning the file and the number of entries of its copy ``plan``
+    that are already in it.  Without a journal, or with no usable partial
+    file, a new empty file is created.  If the target file is already
+    complete, ``(None, len(plan))`` is returned.
+    '''
+    expected = None
+    if journal is not None and os.path.exists(filename):
+        expected = expected_kloc_nkq(plan, sfset)
+        if verify_target_file(filename, tgt_pool + 1, expected, journal.layout()):
+            return (None, len(plan))
+
+        print(f'NOTE:  {filename} doesn\'t match the source files; rewriting it')
+        os.remove(filename)
+
+    tgt_f = PoolFile(partial_filename(filename), tgt_pool + 1)
+
+    done = journal.target_state(tgt_pool)['done'] if journal is not None else 0
+    if done > 0 and os.path.exists(tgt_f.filename):
+        if expected is None:
+            expected = expected_kloc_nkq(plan, sfset)
+        try:
+            resume_partial_file(tgt_f, plan, done, expected)
+            return (tgt_f, done)
+        except (OSError, ValueError) as e:
+            tgt_f.close()
+            print(f'NOTE:  Can\'t resume {tgt_f.filename} ({e}); rewriting it')
+
+    tgt_f.make_new()
+    return (tgt_f, 0)
+
+
+def finish_target_file(tgt_f, filename, tgt_pool, done,
+                       journal: Optional[ReshapeJournal]):
+    '''
+    Close a complete partial target file, rename it to its final name, and
+    record its completion in the journal.
+    '''
+    tgt_f.close()
+    os.replace(tgt_f.filename, filename)
+    tgt_f.filename = filename
+
+    if journal is not None:
+        journal.complete(tgt_pool, done)
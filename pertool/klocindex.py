@@ -0,0 +1,189 @@
+import hashlib
+import os
+
+from typing import Optional
+
+import h5py
+import numpy as np
+
+from .manifest import default_cache_dir, file_signature
+
+
+KLOC_INDEX_FILENAME = '.pertool_kindex.npz'
+KLOC_INDEX_VERSION = 1
+
+
+class KLocIndex:
+    '''
+    A compact index of every k-location in a pool-file set, so that any
+    k-location's data can be found without knowing the pool count or
+    scanning the files.  It holds one entry per global (zero-based)
+    k-location, as NumPy arrays:
+
+    *   ``pool`` - the pool number (one-based, like the file names)
+    *   ``local_index`` - the dataset index within the pool file (one-based,
+        like the dataset names)
+    *   ``nkq`` - the number of k-q pairs
+    *   ``eph_g2_offset`` / ``eph_g2_size`` and ``bands_index_offset`` /
+        ``bands_index_size`` - where each dataset's raw data is stored in its
+        file, for tools that read it directly.  The offset is -1 if the
+        dataset isn't stored contiguously (e.g. it is chunked), and the size
+        is then its total size in storage.
+
+    It also records each pool file's name, dtypes and stat signature (see
+    ``file_signature()``), so that it can restore a set's scan results and
+    can tell when it is out of date.
+
+    Like the scan manifest, the index is saved in the pool-file directory
+    itself, or in a cache directory if ``cache_dir`` is specified or the
+    pool-file directory isn't writable.
+    '''
+
+    ARRAYS = ['pool', 'local_index', 'nkq', 'eph_g2_offset', 'eph_g2_size',
+              'bands_index_offset', 'bands_index_size']
+
+    def __init__(self, path: str, cache_dir: Optional[str]=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.filenames = []
+        self.signatures = np.zeros((0, 3), dtype=np.int64)
+        self.eph_g2_dtypes = []
+        self.bands_index_dtypes = []
+        for name in self.ARRAYS:
+            setattr(self, name, np.zeros(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.pool)
+
+    def _cache_filename(self, cache_dir: str) -> str:
+        key = hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f'kindex-{key}.npz')
+
+    def _candidate_filenames(self) -> list:
+        if self.cache_dir is not None:
+            return [self._cache_filename(self.cache_dir)]
+
+        return [os.path.join(self.path, KLOC_INDEX_FILENAME),
+                self._cache_filename(default_cache_dir())]
+
+    def build(self, pfset):
+        '''
+        Build the index for a scanned pool-file set.  Each file is opened
+        to look up where its datasets are stored; no data is read.
+        '''
+        num_pools = pfset.num_pools
+        nkpt = pfset.nkpt
+
+        self.filenames = [os.path.basename(pfset.pool_files[pool].filename)
+                          for pool in range(1, num_pools + 1)]
+        self.signatures = np.array([file_signature(pfset.pool_files[pool].filename)
+                                    for pool in range(1, num_pools + 1)], dtype=np.int64)
+        self.eph_g2_dtypes = [pfset.pool_files[pool].eph_g2_dtype or ''
+                              for pool in range(1, num_pools + 1)]
+        self.bands_index_dtypes = [pfset.pool_files[pool].bands_index_dtype or ''
+                                   for pool in range(1, num_pools + 1)]
+
+        kloc = np.arange(nkpt, dtype=np.int64)
+        self.pool = kloc % num_pools + 1
+        self.local_index = kloc // num_pools + 1
+        self.nkq = np.array(pfset.global_kloc_nkq(), dtype=np.int64)
+
+        offsets = {}
+        for name in ('eph_g2', 'bands_index'):
+            offsets[f'{name}_offset'] = np.full(nkpt, -1, dtype=np.int64)
+            offsets[f'{name}_size'] = np.zeros(nkpt, dtype=np.int64)
+
+        for pool in range(1, num_pools + 1):
+            f = pfset.pool_files[pool]
+            with h5py.File(f.filename, 'r') as hdf5:
+                for i in range(f.nk_loc):
+                    k = i * num_pools + pool - 1
+                    for name in ('eph_g2', 'bands_index'):
+                        dsid = hdf5[f'{name}_{i + 1}'].id
+                        offset = dsid.get_offset()
+                        if offset is not None:
+                            offsets[f'{name}_offset'][k] = offset
+                        offsets[f'{name}_size'][k] = dsid.get_storage_size()
+
+        for (name, values) in offsets.items():
+            setattr(self, name, values)
+
+    def is_current(self) -> bool:
+        '''
+        Return whether the index describes the files currently in its
+        directory:  the same files, none of which have changed.
+        '''
+        try:
+            signatures = [file_signature(os.path.join(self.path, filename))
+                          for filename in self.filenames]
+        except OSError:
+            return False
+
+        return (len(self.filenames) > 0 and
+                np.array_equal(np.array(signatures, dtype=np.int64), self.signatures))
+
+    def load(self) -> bool:
+        '''
+        Load the saved index, returning whether a current one was found.  A
+        missing, unreadable, out-of-date or other-version index is ignored.
+        '''
+        for filename in self._candidate_filenames():
+            try:
+                with np.load(filename, allow_pickle=False) as contents:
+                    if int(contents['version']) != KLOC_INDEX_VERSION:
+                        continue
+
+                    self.filenames = [str(s) for s in contents['filenames']]
+                    self.signatures = contents['signatures']
+                    self.eph_g2_dtypes = [str(s) for s in contents['eph_g2_dtypes']]
+                    self.bands_index_dtypes = [str(s) for s in contents['bands_index_dtypes']]
+                    for name in self.ARRAYS:
+                        setattr(self, name, contents[name])
+            except (OSError, ValueError, KeyError):
+                continue
+
+            if self.is_current():
+                return True
+
+        return False
+
+    def save(self):
+        '''
+        Save the index, through a temporary file renamed into place.  Failure
+        to save the index isn't fatal.
+        '''
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        for filename in self._candidate_filenames():
+            tmp_filename = f'{filename}.{os.getpid()}.tmp.npz'
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                np.savez(tmp_filename, version=KLOC_INDEX_VERSION,
+                    filenames=np.array(self.filenames, dtype=str),
+                    signatures=self.signatures,
+                    eph_g2_dtypes=np.array(self.eph_g2_dtypes, dtype=str),
+                    bands_index_dtypes=np.array(self.bands_index_dtypes, dtype=str),
+                    **arrays)
+                os.replace(tmp_filename, filename)
+                return
+            except OSError:
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+
+        print(f'WARNING:  Couldn\'t write k-location index for {self.path}')
+
+    def scan_info(self, pool) -> dict:
+        '''
+        Return the scan results of the specified (one-based) pool's file, in
+        the form of ``PoolFile.get_scan_info()``.
+        '''
+        num_pools = len(self.filenames)
+        kloc_nkq = [int(n) for n in self.nkq[pool - 1::num_pools]]
+        return {
+            'nk_loc': len(kloc_nkq),
+            'nkq': sum(kloc_nkq),
+            'kloc_nkq': kloc_nkq,
+            'eph_g2_dtype': self.eph_g2_dtypes[pool - 1] or None,
+            'bands_index_dtype': self.bands_index_dtypes[pool - 1] or None,
+        }
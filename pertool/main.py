@@ -4,12 +4,16 @@ import sys
 from . import analyze
 from . import generate
 from . import reshape
+from . import run
+from . import verify
 
 
 COMMANDS = {
     'analyze': analyze,
     'generate': generate,
     'reshape': reshape,
+    'run': run,
+    'verify': verify,
 }
 
 
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+
+from typing import Optional
+
+
+MANIFEST_FILENAME = '.pertool_manifest.json'
+MANIFEST_VERSION = 1
+
+ORIGIN_FILENAME = '.pertool_origin.json'
+ORIGIN_VERSION = 1
+
+
+def default_cache_dir() -> str:
+    '''
+    Return the per-user cache directory that manifests are written to when
+    the pool-file directory itself isn't writable.
+    '''
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pertool')
+
+
+def file_signature(filename: str) -> list:
+    '''
+    Return the stat signature used to decide whether a pool file has changed
+    since it was last scanned:  its size, modification time and inode.
+    '''
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class ScanManifest:
+    '''
+    A sidecar file recording the scan results of each pool file in a
+    directory, keyed by the file's stat signature.  Perturbo never modifies
+    pool files after writing them, so a file whose signature is unchanged
+    doesn't need to be scanned again.
+
+    By default the manifest lives in the pool-file directory itself.  If
+    ``cache_dir`` is specified, or the pool-file directory isn't writable,
+    the manifest is kept in a cache directory instead, under a name derived
+    from the pool-file directory's absolute path.
+    '''
+
+    def __init__(self, path: str, cache_dir: Optional[str]=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.entries = {}
+        self.dirty = False
+
+    def _cache_filename(self, cache_dir: str) -> str:
+        key = hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f'manifest-{key}.json')
+
+    def _candidate_filenames(self) -> list:
+        if self.cache_dir is not None:
+            return [self._cache_filename(self.cache_dir)]
+
+        return [os.path.join(self.path, MANIFEST_FILENAME),
+                self._cache_filename(default_cache_dir())]
+
+    def load(self):
+        '''
+        Load the manifest, if one exists.  A missing, unreadable or
+        out-of-date manifest is simply treated as empty.
+        '''
+        self.entries = {}
+        self.dirty = False
+        for filename in self._candidate_filenames():
+            try:
+                with open(filename) as f:
+                    contents = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            if contents.get('version') == MANIFEST_VERSION:
+                self.entries = contents.get('files', {})
+                return
+
+    def lookup(self, filename: str) -> Optional[dict]:
+        '''
+        Return the cached scan info for the specified pool file, or ``None``
+        if there is no entry or the file's signature no longer matches.
+        '''
+        entry = self.entries.get(os.path.basename(filename))
+        if entry is None:
+            return None
+
+        try:
+            if entry['signature'] != file_signature(filename):
+                return None
+        except OSError:
+            return None
+
+        return entry['info']
+
+    def update(self, filename: str, info: dict):
+        '''
+        Record the scan info for the specified pool file.
+        '''
+        self.entries[os.path.basename(filename)] = {
+            'signature': file_signature(filename),
+            'info': info,
+        }
+        self.dirty = True
+
+    def save(self):
+        '''
+        Write the manifest out if it has changed.  The manifest is written to
+        a temporary file and renamed into place, so concurrent readers never
+        see a partial manifest.  Failure to write the manifest isn't fatal.
+        '''
+        if not self.dirty:
+            return
+
+        contents = {'version': MANIFEST_VERSION, 'files': self.entries}
+        for filename in self._candidate_filenames():
+            tmp_filename = f'{filename}.{os.getpid()}.tmp'
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with open(tmp_filename, 'w') as f:
+                    json.dump(contents, f)
+                os.replace(tmp_filename, filename)
+                self.dirty = False
+                return
+            except OSError:
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+
+        print(f'WARNING:  Couldn\'t write scan manifest for {self.path}')
+
+
+def files_fingerprint(filenames) -> str:
+    '''
+    Return a fingerprint of a set of pool files, from their names and stat
+    signatures, which changes if any of the files is replaced or modified.
+    '''
+    signatures = sorted([os.path.basename(filename), file_signature(filename)]
+                        for filename in filenames)
+    return hashlib.sha1(json.dumps(signatures).encode()).hexdigest()
+
+
+def origin_fingerprint(path: str, filenames) -> str:
+    '''
+    Return the fingerprint of the data the pool files in a directory hold.
+    For a directory written by a reshape, whose files haven't changed
+    since, this is the fingerprint recorded with ``write_origin()``, so that
+    every reshape of the same source files has the same origin as the source
+    files themselves.  Otherwise it is the files' own fingerprint.
+    '''
+    fingerprint = files_fingerprint(filenames)
+    try:
+        with open(os.path.join(path, ORIGIN_FILENAME)) as f:
+            contents = json.load(f)
+        if contents.get('version') == ORIGIN_VERSION and contents['files'] == fingerprint:
+            return contents['origin']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return fingerprint
+
+
+def write_origin(path: str, filenames, origin: str):
+    '''
+    Record, in a reshaped directory, the origin fingerprint of the source
+    files it was reshaped from (see ``origin_fingerprint()``), along with the
+    fingerprint of its own pool files.  Failure to write the record isn't
+    fatal; the directory just can't be reused.
+    '''
+    contents = {
+        'version': ORIGIN_VERSION,
+        'origin': origin,
+        'files': files_fingerprint(filenames),
+    }
+    filename = os.path.join(path, ORIGIN_FILENAME)
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_filename, 'w') as f:
+            json.dump(contents, f)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        print(f'WARNING:  Couldn\'t record the origin of {path}')
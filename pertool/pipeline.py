@@ -0,0 +1,479 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+
+from .poolfiles import *
+from .journal import *
+from .prefetch import RawReader, portable_record, read_dataset, write_dataset
+from .progress import advance, init_worker, make_counters
+from . import stats
+
+
+DEFAULT_QUEUE_DEPTH = 16
+BATCHES_PER_READER = 16
+PIPELINE_POLL_INTERVAL = 0.5 # in seconds
+
+
+def split_processes(max_processes, num_sources, num_targets) -> Tuple[int, int]:
+    '''
+    Divide the available subprocesses between source readers and target
+    writers.  Each side gets roughly half, but never more processes than it
+    has files to work on.
+    '''
+    num_writers = max(1, min(num_targets, max_processes // 2))
+    num_readers = max(1, min(num_sources, max_processes - num_writers))
+    return (num_readers, num_writers)
+
+
+def round_robin_owners(num_tgt_pools, num_writers) -> list:
+    '''
+    Assign target pools to writer processes round-robin.  Returns a list
+    mapping each (zero-based) target pool to the writer that owns it; each
+    target file is owned by exactly one writer.
+    '''
+    return [tgt_pool % num_writers for tgt_pool in range(num_tgt_pools)]
+
+
+def target_pool_nkq(sfset, num_tgt_pools) -> list:
+    '''
+    Return the total number of k-q pairs that will end up in each target
+    pool, computed from the scan results of the source pool-file set (and
+    its selection of k-locations, if any).
+    '''
+    tgt_nkq = [0] * num_tgt_pools
+    if sfset.selection is not None:
+        global_nkq = sfset.global_kloc_nkq()
+        for (i, i_kloc) in enumerate(sfset.selection):
+            tgt_nkq[i % num_tgt_pools] += global_nkq[i_kloc]
+        return tgt_nkq
+
+    for (pool, f) in sfset.pool_files.items():
+        for (src_idx, nkq) in enumerate(f.kloc_nkq):
+            i_kloc = src_idx * sfset.num_pools + pool - 1
+            tgt_nkq[i_kloc % num_tgt_pools] += nkq
+    return tgt_nkq
+
+
+def balanced_owners(tgt_nkq, num_writers) -> list:
+    '''
+    Assign target pools to writer processes so that each writer has a
+    similar number of k-q pairs to write.  Targets are handed out largest
+    first, each to the writer with the least work so far.  Returns a list
+    mapping each (zero-based) target pool to its writer.
+    '''
+    owners = [0] * len(tgt_nkq)
+    loads = [0] * num_writers
+    for tgt_pool in sorted(range(len(tgt_nkq)), key=lambda t: -tgt_nkq[t]):
+        writer = loads.index(min(loads))
+        owners[tgt_pool] = writer
+        loads[writer] += tgt_nkq[tgt_pool]
+    return owners
+
+
+def make_kloc_batches(sfset, batch_nkq) -> list:
+    '''
+    Divide the source k-locations into batches of consecutive k-locations
+    within a single source pool, each holding about ``batch_nkq`` k-q pairs.
+    Returns a list of ``(src_pool, start, stop)`` tuples of zero-based
+    indexes, ordered by source pool so that consecutive batches read the
+    same file sequentially.
+    '''
+    batches = []
+    for pool in sorted(sfset.pool_files.keys()):
+        f = sfset.pool_files[pool]
+        start = 0
+        nkq = 0
+        for (src_idx, kloc_nkq) in enumerate(f.kloc_nkq):
+            nkq += kloc_nkq
+            if nkq >= batch_nkq:
+                batches.append( (pool - 1, start, src_idx + 1) )
+                start = src_idx + 1
+                nkq = 0
+
+        if start < f.nk_loc:
+            batches.append( (pool - 1, start, f.nk_loc) )
+
+    return batches
+
+
+def read_kloc_record(src_f, src_index, tgt_pool, tgt_index, raw_reader, layout=None) -> tuple:
+    '''
+    Read the eph_g2 and bands_index datasets for one k-location with
+    ``prefetch.read_dataset()``, and package them up into a record that can
+    be sent to a writer.  Unless an ``OutputLayout`` changes the storage
+    layout, the datasets' raw chunks are sent as they are stored, so they
+    are never decompressed and recompressed.
+    '''
+    with stats.phase('read', src_f.filename):
+        eph_g2 = read_dataset(src_f.get_eph_g2(src_index), raw_reader, layout)
+        bands_index = read_dataset(src_f.get_bands_index(src_index), raw_reader, layout)
+        record = (tgt_pool, tgt_index, portable_record(eph_g2), portable_record(bands_index))
+
+    stats.add('bytes_read', eph_g2[2] + bands_index[2], src_f.filename)
+    stats.add('datasets_read', 2)
+    return record
+
+
+def write_kloc_record(tgt_f, record):
+    '''
+    Write a record produced by ``read_kloc_record()`` into its target file.
+    '''
+    (_, tgt_index, eph_g2, bands_index) = record
+    with stats.phase('write', tgt_f.filename):
+        write_dataset(tgt_f.hdf5, f'eph_g2_{tgt_index}', eph_g2)
+        write_dataset(tgt_f.hdf5, f'bands_index_{tgt_index}', bands_index)
+
+    stats.add('bytes_written', eph_g2[2] + bands_index[2], tgt_f.filename)
+    stats.add('datasets_written', 2)
+
+
+def send_record(writer_queues, owners, record):
+    '''
+    Send a record to the writer that owns its target pool.  Time spent
+    blocked here means the writers can't keep up with the readers.
+    '''
+    with stats.phase('queue_put'):
+        writer_queues[owners[record[0]]].put(record)
+
+
+def finish_reader(writer_queues, stats_queue):
+    '''
+    Send the ``None`` sentinel to every writer, and this reader's statistics
+    to the parent process.
+    '''
+    for q in writer_queues:
+        q.put(None)
+
+    stats_queue.put(stats.snapshot())
+
+
+def source_reader(reader, num_readers, sfset, num_tgt_pools, owners, writer_queues,
+                  stats_queue, layout=None):
+    '''
+    Subprocess function for a source-major reader.  The reader owns every
+    source pool whose zero-based index is congruent to ``reader`` modulo
+    ``num_readers``.  Each owned file is opened once and its k-locations are
+    read in order, and each one is sent to the writer that owns its target
+    pool according to ``owners``; k-locations whose target pool has no owner
+    are skipped.  When the reader is finished it sends a ``None`` sentinel
+    to every writer.
+    '''
+    stats.reset()
+    raw_reader = RawReader()
+    for src_pool in range(reader, sfset.num_pools, num_readers):
+        src_f = sfset.pool_files[src_pool + 1]
+        src_f.open('r')
+
+        for src_idx in range(src_f.nk_loc):
+            i_kloc = src_idx * sfset.num_pools + src_pool
+            (tgt_pool, tgt_idx) = kloc_index_to_pool_index(i_kloc, num_tgt_pools)
+
+            if owners[tgt_pool] is None:
+                continue
+
+            record = read_kloc_record(src_f, src_idx + 1, tgt_pool, tgt_idx + 1,
+                                      raw_reader, layout)
+            send_record(writer_queues, owners, record)
+
+        src_f.close()
+        raw_reader.close()
+
+    finish_reader(writer_queues, stats_queue)
+
+
+def batch_reader(sfset, num_tgt_pools, owners, batch_queue, writer_queues, stats_queue,
+                 layout=None):
+    '''
+    Subprocess function for a batched reader.  The reader repeatedly takes
+    a ``(src_pool, start, stop)`` batch from the shared ``batch_queue``,
+    reads those k-locations in order, and sends each one to the writer that
+    owns its target pool.  Since batches are handed out on demand, readers
+    that finish early simply take more work.  A ``None`` batch means there
+    is no more work; the reader then sends a ``None`` sentinel to every
+    writer.
+
+    The most recently used source file is kept open between batches, since
+    consecutive batches usually come from the same file.
+    '''
+    stats.reset()
+    raw_reader = RawReader()
+    src_f = None
+    while True:
+        with stats.phase('batch_wait'):
+            batch = batch_queue.get()
+        if batch is None:
+            break
+
+        (src_pool, start, stop) = batch
+        if src_f is not sfset.pool_files[src_pool + 1]:
+            if src_f is not None:
+                src_f.close()
+                raw_reader.close()
+            src_f = sfset.pool_files[src_pool + 1]
+            src_f.open('r')
+
+        for src_idx in range(start, stop):
+            i_kloc = src_idx * sfset.num_pools + src_pool
+            (tgt_pool, tgt_idx) = kloc_index_to_pool_index(i_kloc, num_tgt_pools)
+
+            if owners[tgt_pool] is None:
+                continue
+
+            record = read_kloc_record(src_f, src_idx + 1, tgt_pool, tgt_idx + 1,
+                                      raw_reader, layout)
+            send_record(writer_queues, owners, record)
+
+    if src_f is not None:
+        src_f.close()
+    raw_reader.close()
+
+    finish_reader(writer_queues, stats_queue)
+
+
+def target_writer(writer, tgt_pools, num_readers, todir, prefix, in_queue, counters,
+                  stats_queue, journal=None):
+    '''
+    Subprocess function for a pipeline writer.  The writer creates and owns
+    the (zero-based) target pools in ``tgt_pools``, and writes the records
+    it receives into them until every reader has sent its ``None``
+    sentinel.  Each record written is counted in the writer's slot of the
+    shared ``counters``, and the writer's statistics are sent to the parent
+    through ``stats_queue`` when it finishes.
+
+    Target files are written under their partial names and renamed when
+    they are complete.  Records arrive in no particular order, so the only
+    checkpoint recorded in the ``journal`` is each target's completion.
+    '''
+    stats.reset()
+    init_worker(counters)
+    tgt_files = {}
+    for tgt_pool in tgt_pools:
+        filename = os.path.join(todir, make_pool_filename(prefix, tgt_pool + 1))
+        tgt_files[tgt_pool] = PoolFile(partial_filename(filename), tgt_pool + 1)
+        tgt_files[tgt_pool].make_new()
+
+    finished_readers = 0
+    while finished_readers < num_readers:
+        with stats.phase('queue_wait'):
+            record = in_queue.get()
+        if record is None:
+            finished_readers += 1
+            continue
+
+        write_kloc_record(tgt_files[record[0]], record)
+        tgt_files[record[0]].nk_loc += 1
+        advance(writer)
+
+    for (tgt_pool, f) in tgt_files.items():
+        filename = os.path.join(todir, make_pool_filename(prefix, tgt_pool + 1))
+        finish_target_file(f, filename, tgt_pool, f.nk_loc, journal)
+
+    stats_queue.put(stats.snapshot())
+
+
+def run_source_major(sfset, todir, num_tgt_pools, max_processes=DEFAULT_MAX_PROCESSES,
+                     queue_depth=DEFAULT_QUEUE_DEPTH, progress=None, journal=None,
+                     layout=None):
+    '''
+    Reshape the scanned source pool-file set ``sfset`` into ``num_tgt_pools``
+    target files in ``todir``, reading each source file exactly once.
+
+    Reader subprocesses own the source files and writer subprocesses own
+    the target files; k-location records are streamed from readers to
+    writers through bounded queues of ``queue_depth`` records, so that the
+    number of file opens is O(sources + targets), and both sides see
+    sequential access.
+
+    The optional ``progress(count: int)`` callback is called periodically
+    with the total number of k-locations written so far.  If any subprocess
+    fails, all of them are terminated and a ``RuntimeError`` is raised.
+
+    If a ``journal`` is given, target files it records as complete are
+    verified and skipped, and all other target files are written from
+    scratch.  If an ``OutputLayout`` is given, the target datasets are
+    written with it instead of their source datasets' layouts.
+    '''
+    (num_readers, num_writers) = split_processes(max_processes,
+        sfset.num_pools, num_tgt_pools)
+    owners = round_robin_owners(num_tgt_pools, num_writers)
+    skipped = skip_complete_targets(sfset, todir, num_tgt_pools, owners, journal)
+
+    # The source files can't be pickled while they are open.
+    sfset.close_all()
+
+    writer_queues = [multiprocessing.Queue(queue_depth) for _ in range(num_writers)]
+    stats_queue = multiprocessing.Queue()
+
+    counters = make_counters(num_writers)
+    processes = make_writer_processes(owners, num_readers, todir, sfset.prefix,
+        writer_queues, counters, stats_queue, journal)
+
+    for reader in range(num_readers):
+        processes.append(multiprocessing.Process(target=source_reader,
+            args=(reader, num_readers, sfset, num_tgt_pools, owners, writer_queues,
+                  stats_queue, layout)))
+
+    run_pipeline_processes(processes, counters, stats_queue,
+        offset_progress(progress, skipped))
+
+
+def run_batched(sfset, todir, num_tgt_pools, max_processes=DEFAULT_MAX_PROCESSES,
+                queue_depth=DEFAULT_QUEUE_DEPTH, batch_nkq=None, progress=None,
+                journal=None, layout=None):
+    '''
+    Reshape the scanned source pool-file set ``sfset`` into ``num_tgt_pools``
+    target files in ``todir``, handing out k-location batches dynamically to
+    a fixed set of reader subprocesses.
+
+    Batches hold about ``batch_nkq`` k-q pairs each; if unspecified, the
+    batch size is chosen so that each reader gets many batches.  Target
+    files are assigned to writer subprocesses so that each writer has about
+    the same number of k-q pairs to write, and each target file is only
+    written by its one owner.  This keeps all processes busy when the
+    number of k-q pairs per k-location varies widely.
+
+    See ``run_source_major()`` for ``queue_depth``, ``progress``,
+    ``journal`` and ``layout``.
+    '''
+    (num_readers, num_writers) = split_processes(max_processes,
+        sfset.num_pools, num_tgt_pools)
+
+    # Batches aren't tied to source files, so readers can use any processes
+    # the writers don't need.
+    num_readers = max(1, max_processes - num_writers)
+
+    if not batch_nkq:
+        batch_nkq = max(1, sfset.nkq // (num_readers * BATCHES_PER_READER))
+
+    owners = balanced_owners(target_pool_nkq(sfset, num_tgt_pools), num_writers)
+    skipped = skip_complete_targets(sfset, todir, num_tgt_pools, owners, journal)
+
+    # The source files can't be pickled while they are open.
+    sfset.close_all()
+
+    batch_queue = multiprocessing.Queue()
+    for batch in make_kloc_batches(sfset, batch_nkq):
+        batch_queue.put(batch)
+    for _ in range(num_readers):
+        batch_queue.put(None)
+
+    writer_queues = [multiprocessing.Queue(queue_depth) for _ in range(num_writers)]
+    stats_queue = multiprocessing.Queue()
+
+    counters = make_counters(num_writers)
+    processes = make_writer_processes(owners, num_readers, todir, sfset.prefix,
+        writer_queues, counters, stats_queue, journal)
+
+    for reader in range(num_readers):
+        processes.append(multiprocessing.Process(target=batch_reader,
+            args=(sfset, num_tgt_pools, owners, batch_queue, writer_queues,
+                  stats_queue, layout)))
+
+    run_pipeline_processes(processes, counters, stats_queue,
+        offset_progress(progress, skipped))
+
+
+def skip_complete_targets(sfset, todir, num_tgt_pools, owners, journal) -> int:
+    '''
+    Find the target pools that the ``journal`` records as complete and whose
+    files check out, and remove their owners so that they aren't written
+    again.  Returns the number of k-locations in the skipped targets.
+    '''
+    if journal is None:
+        return 0
+
+    skipped = 0
+    for tgt_pool in range(num_tgt_pools):
+        if not journal.target_state(tgt_pool)['complete']:
+            continue
+
+        filename = os.path.join(todir, make_pool_filename(sfset.prefix, tgt_pool + 1))
+        expected = expected_kloc_nkq(plan_target_copies(tgt_pool, num_tgt_pools, sfset), sfset)
+        if verify_target_file(filename, tgt_pool + 1, expected, journal.layout()):
+            owners[tgt_pool] = None
+            skipped += len(expected)
+
+    return skipped
+
+
+def offset_progress(progress, offset):
+    '''
+    Wrap a progress callback so that it counts ``offset`` k-locations that
+    were already written.
+    '''
+    if progress is None or offset == 0:
+        return progress
+    return lambda count: progress(count + offset)
+
+
+def make_writer_processes(owners, num_readers, todir, prefix, writer_queues,
+                          counters, stats_queue, journal=None) -> list:
+    '''
+    Create (but don't start) one writer subprocess per writer queue, each
+    owning the target pools assigned to it in ``owners``.
+    '''
+    processes = []
+    for (writer, in_queue) in enumerate(writer_queues):
+        tgt_pools = [t for (t, w) in enumerate(owners) if w == writer]
+        processes.append(multiprocessing.Process(target=target_writer,
+            args=(writer, tgt_pools, num_readers, todir, prefix, in_queue, counters,
+                  stats_queue, journal)))
+    return processes
+
+
+def run_pipeline_processes(processes, counters, stats_queue, progress=None):
+    '''
+    Start the pipeline subprocesses and wait for them to finish, reporting
+    the total of the shared ``counters`` as progress along the way, and
+    collecting the subprocesses' statistics.  If any subprocess fails, all
+    of them are terminated and a ``RuntimeError`` is raised.
+    '''
+    for p in processes:
+        p.start()
+
+    failed = False
+    while True:
+        # Wake up as soon as any subprocess exits, or periodically to report
+        # progress.
+        running = [p.sentinel for p in processes if p.exitcode is None]
+        if running:
+            multiprocessing.connection.wait(running, timeout=PIPELINE_POLL_INTERVAL)
+
+        # Statistics must be drained as they arrive, since a subprocess
+        # can't exit until everything it has queued has been consumed.
+        drain_stats_queue(stats_queue)
+
+        if progress:
+            progress(sum(counters))
+
+        failed = any(p.exitcode not in (None, 0) for p in processes)
+        if failed or all(p.exitcode is not None for p in processes):
+            break
+
+    if failed:
+        for p in processes:
+            p.terminate()
+
+    for p in processes:
+        p.join()
+
+    if failed:
+        raise RuntimeError('A reshape pipeline subprocess failed')
+
+    # Pick up any statistics that were sent after the last poll.
+    drain_stats_queue(stats_queue)
+
+    if progress:
+        progress(sum(counters))
+
+
+def drain_stats_queue(stats_queue):
+    '''
+    Merge all statistics snapshots currently in the statistics queue.
+    '''
+    while True:
+        try:
+            stats.merge(stats_queue.get_nowait())
+        except queue.Empty:
+            return
@@ -1,19 +1,45 @@
+import collections
+import math
 import multiprocessing
 import os
 import re
+import time
 import traceback
 
-from typing import Tuple
+from typing import Any, Optional, Tuple
 
 import h5py
+import numpy as np
+
+from .klocindex import KLocIndex
+from . import stats
 
 
 DEFAULT_FROMDIR = './tmp'
 FILE_REGEX = re.compile(r'([^_]+)_eph_g2_p(\d+)\.h5')
+DATASET_REGEX = re.compile(r'(bands_index|eph_g2)_(\d+)')
 
 DEFAULT_MAX_PROCESSES = 20
 SUBPROCESS_REPORT_INTERVAL = 3.0 # in seconds
 
+DEFAULT_MAX_OPEN_FILES = 64
+
+# Size of the chunk cache of each pool file this process opens, in bytes, or
+# None for the HDF5 library's default (1 MB).  See set_chunk_cache_size().
+chunk_cache_nbytes = None
+
+
+def set_chunk_cache_size(nbytes: Optional[int]):
+    '''
+    Set the size of the raw-data chunk cache of every pool file opened
+    after this call, in bytes, or ``None`` for the HDF5 library's default.
+    Each open file has its own cache, so this bounds the memory used per
+    open file.
+    '''
+    global chunk_cache_nbytes
+    assert nbytes is None or nbytes >= 0, f'Cache size must be nonnegative; got {nbytes}'
+    chunk_cache_nbytes = nbytes
+
 
 def make_pool_filename(prefix: str, pool: int) -> str:
     '''
@@ -35,6 +61,110 @@ def kloc_index_to_pool_index(kloc, npools) -> Tuple[int, int]:
     return (kloc % npools, kloc // npools)
 
 
+def reshape_ratio(num_src_pools, num_tgt_pools) -> Optional[Tuple[str, int]]:
+    '''
+    Report whether a reshape has an integer ratio between its pool counts.
+    Returns ``('split', m)`` if each source pool is split across ``m`` target
+    pools, ``('merge', m)`` if each target pool is merged from ``m`` source
+    pools, or ``None`` if neither pool count divides the other.  Reshaping to
+    the same number of pools is reported as a split with ``m == 1``.
+    '''
+    if num_tgt_pools % num_src_pools == 0:
+        return ('split', num_tgt_pools // num_src_pools)
+
+    if num_src_pools % num_tgt_pools == 0:
+        return ('merge', num_src_pools // num_tgt_pools)
+
+    return None
+
+
+def source_pools_for_target(tgt_pool, num_src_pools, num_tgt_pools) -> list:
+    '''
+    Return the (zero-based) source pools that contain any k-locations for
+    the specified (zero-based) target pool.  With round-robin assignment,
+    a k-location ``k`` lives in source pool ``k % S`` and target pool
+    ``k % T``, so the target pool's sources are exactly those congruent to it
+    modulo ``gcd(S, T)``.  For a split this is a single source pool.
+    '''
+    g = math.gcd(num_src_pools, num_tgt_pools)
+    return list(range(tgt_pool % g, num_src_pools, g))
+
+
+def plan_target_copies(tgt_pool, num_tgt_pools, sfset) -> list:
+    '''
+    Return the list of ``(src_pool, src_idx, tgt_idx)`` copies (all
+    zero-based) needed to populate the specified target pool from the
+    scanned source pool-file set ``sfset``.  The copies are grouped by source
+    pool, in increasing order of source index, so that each source file only
+    needs to be opened once and is read sequentially.
+
+    Rather than mapping every k-location, the source indexes for each source
+    pool are computed directly:  k-location ``j*S + s`` maps to target pool
+    ``t`` exactly when ``j*S = t - s (mod T)``, which gives one arithmetic
+    progression of ``j`` per source pool.
+
+    If only some k-locations of the source set are selected (see
+    ``PoolFileSet.select_klocs()``), the selected k-locations are numbered
+    from zero in order and assigned to the target pools round-robin instead.
+    '''
+    num_src_pools = sfset.num_pools
+    if sfset.selection is not None:
+        plan = []
+        for (tgt_idx, i_kloc) in enumerate(sfset.selection[tgt_pool::num_tgt_pools]):
+            (src_pool, src_idx) = kloc_index_to_pool_index(i_kloc, num_src_pools)
+            plan.append( (src_pool, src_idx, tgt_idx) )
+        plan.sort()
+        return plan
+
+    g = math.gcd(num_src_pools, num_tgt_pools)
+    src_step = num_src_pools // g
+    tgt_step = num_tgt_pools // g
+
+    plan = []
+    for src_pool in source_pools_for_target(tgt_pool, num_src_pools, num_tgt_pools):
+        start = ((tgt_pool - src_pool) // g * pow(src_step, -1, tgt_step)) % tgt_step
+        for src_idx in range(start, sfset.pool_files[src_pool + 1].nk_loc, tgt_step):
+            i_kloc = src_idx * num_src_pools + src_pool
+            plan.append( (src_pool, src_idx, i_kloc // num_tgt_pools) )
+
+    return plan
+
+
+def parse_kloc_selection(krange: Optional[str], klist: Optional[str], nkpt: int) -> list:
+    '''
+    Parse a selection of k-locations from the command line into a sorted
+    list of global (zero-based) k-locations.  On the command line
+    k-locations are numbered from 1, like the datasets.  ``krange`` is
+    ``'FIRST:LAST'`` or ``'FIRST:LAST:STEP'``, inclusive; ``klist`` is a
+    comma-separated list, or ``'@FILE'`` to read whitespace- or
+    comma-separated numbers from a file.  The selected k-locations are
+    combined.  Raises ``ValueError`` if the selection is invalid or empty,
+    or includes k-locations past ``nkpt``.
+    '''
+    klocs = set()
+    if krange:
+        parts = [int(part) for part in krange.split(':')]
+        if (len(parts) not in (2, 3) or parts[0] < 1 or parts[1] < parts[0] or
+                (len(parts) == 3 and parts[2] < 1)):
+            raise ValueError(f'Expected FIRST:LAST[:STEP] with 1 <= FIRST <= LAST; got {krange}')
+        step = parts[2] if len(parts) == 3 else 1
+        klocs.update(range(parts[0] - 1, parts[1], step))
+
+    if klist:
+        text = klist
+        if text.startswith('@'):
+            with open(text[1:]) as f:
+                text = f.read()
+        klocs.update(int(value) - 1 for value in re.split(r'[\s,]+', text.strip()) if value)
+
+    selection = sorted(klocs)
+    if not selection:
+        raise ValueError('No k-locations are selected')
+    if selection[0] < 0 or selection[-1] >= nkpt:
+        raise ValueError(f'K-locations must be in the range 1 to {nkpt}')
+    return selection
+
+
 class PoolFile:
     '''
     A single HDF5 file in the set of pool data files.
@@ -48,6 +178,9 @@ class PoolFile:
         # These values are generated by scanning the file
         self.nk_loc = 0
         self.nkq = 0
+        self.kloc_nkq = []
+        self.eph_g2_dtype = None
+        self.bands_index_dtype = None
 
     def __repr__(self):
         return self.filename
@@ -61,7 +194,9 @@ class PoolFile:
         closing it in between.
         '''
         assert self.hdf5 is None, f'HDF5 file {self.filename} is already open'
-        self.hdf5 = h5py.File(self.filename, mode)
+        with stats.phase('hdf5_open', self.filename):
+            self.hdf5 = h5py.File(self.filename, mode, rdcc_nbytes=chunk_cache_nbytes)
+        stats.add('files_opened')
 
     def close(self):
         '''
@@ -73,15 +208,38 @@ class PoolFile:
         self.hdf5.close()
         self.hdf5 = None
 
-    def scan_contents(self):
+    def scan_contents(self, fast=True):
         '''
         Scan the pool file's contents to verify that it appears to be
         correctly structured, and also to count the number of k-grid locations
         and k-q pairs the file contains.
+
+        By default the scan walks the file's link table once, parsing the
+        k-location indexes out of the dataset names and reading dataset
+        shapes from metadata only; any gaps or mismatches are reported
+        together in a single ``ValueError``.  If ``fast`` is ``False`` then
+        the original key-by-key probing scan is used instead.
         '''
         self.open('r')
         self.nk_loc = 0
         self.nkq = 0
+        self.kloc_nkq = []
+        self.eph_g2_dtype = None
+        self.bands_index_dtype = None
+
+        with stats.phase('scan', self.filename):
+            if fast:
+                self._scan_links()
+            else:
+                self._scan_probe()
+
+        stats.add('klocs_scanned', self.nk_loc)
+
+    def _scan_probe(self):
+        '''
+        Scan the file by probing for "bands_index_{i}" / "eph_g2_{i}" one
+        k-location at a time, until neither key is found.
+        '''
         while True:
             i = self.nk_loc + 1
             bnd_idx = f'bands_index_{i}'
@@ -101,6 +259,100 @@ class PoolFile:
             # of entries
             self.nk_loc += 1
             self.nkq += len(self.hdf5[bnd_idx])
+            self.kloc_nkq.append(len(self.hdf5[bnd_idx]))
+
+            if self.eph_g2_dtype is None:
+                self.eph_g2_dtype = self.hdf5[eph_g2].dtype.str
+                self.bands_index_dtype = self.hdf5[bnd_idx].dtype.str
+
+    def _scan_links(self):
+        '''
+        Scan the file by iterating over the root group's links once.  Each
+        dataset is opened with the low-level API just long enough to read its
+        shape and type from the object header; no data is read.
+        '''
+        # Maps 'eph_g2' / 'bands_index' to {index: (shape, dtype-string)}
+        found = {'eph_g2': {}, 'bands_index': {}}
+        gid = self.hdf5.id
+
+        def visit(name):
+            match = DATASET_REGEX.fullmatch(name.decode())
+            if match:
+                dsid = h5py.h5d.open(gid, name)
+                found[match.group(1)][int(match.group(2))] = \
+                    (dsid.shape, dsid.dtype.str)
+            # Returning None continues the iteration
+
+        gid.links.iterate(visit)
+
+        eph_g2 = found['eph_g2']
+        bands_index = found['bands_index']
+        nk_loc = max(max(eph_g2, default=0), max(bands_index, default=0))
+
+        problems = []
+        missing = []
+        dtypes = {'eph_g2': set(), 'bands_index': set()}
+        for i in range(1, nk_loc + 1):
+            if i not in eph_g2 and i not in bands_index:
+                missing.append(i)
+                continue
+
+            if i not in eph_g2 or i not in bands_index:
+                problems.append(f'Only found one of bands_index_{i} / eph_g2_{i}')
+                continue
+
+            (eph_shape, eph_dtype) = eph_g2[i]
+            (bnd_shape, bnd_dtype) = bands_index[i]
+            dtypes['eph_g2'].add(eph_dtype)
+            dtypes['bands_index'].add(bnd_dtype)
+
+            if len(eph_shape) == 0 or len(bnd_shape) == 0 or eph_shape[0] != bnd_shape[0]:
+                problems.append(f'Lengths of bands_index_{i} and eph_g2_{i} differ')
+                continue
+
+            self.kloc_nkq.append(bnd_shape[0])
+
+        if missing:
+            problems.append(f'{len(missing)} k-location(s) missing entirely, ' +
+                f'e.g. index {missing[0]}')
+
+        for (name, found_dtypes) in dtypes.items():
+            if len(found_dtypes) > 1:
+                problems.append(f'Multiple {name} dtypes found:  {sorted(found_dtypes)}')
+
+        if problems:
+            raise ValueError(f'{len(problems)} problem(s) found in file {self.filename}:\n  ' +
+                '\n  '.join(problems))
+
+        self.nk_loc = nk_loc
+        self.nkq = sum(self.kloc_nkq)
+        if nk_loc > 0:
+            self.eph_g2_dtype = eph_g2[1][1]
+            self.bands_index_dtype = bands_index[1][1]
+
+    def get_scan_info(self) -> dict:
+        '''
+        Return the results of ``scan_contents()`` as a plain dictionary, so
+        that they can be sent back from a subprocess.
+        '''
+        return {
+            'nk_loc': self.nk_loc,
+            'nkq': self.nkq,
+            'kloc_nkq': list(self.kloc_nkq),
+            'eph_g2_dtype': self.eph_g2_dtype,
+            'bands_index_dtype': self.bands_index_dtype,
+        }
+
+    def set_scan_info(self, info: dict):
+        '''
+        Restore the results of a scan previously returned by
+        ``get_scan_info()``.
+        '''
+        self.nk_loc = info['nk_loc']
+        self.nkq = info['nkq']
+        self.kloc_nkq = list(info['kloc_nkq'])
+        self.eph_g2_dtype = info['eph_g2_dtype']
+        self.bands_index_dtype = info['bands_index_dtype']
 
     def get_eph_g2(self, index):
         '''
@@ -119,39 +371,141 @@ class PoolFile:
     def make_new(self):
         self.open('w')
 
-    def set_eph_g2(self, index, data):
+    def set_eph_g2(self, index, data, **kwargs):
         '''
         Create an eph_g2 dataset for the specified index.  The dataset's
-        name will be "eph_g2_{index}" in the HDF5 file.
+        name will be "eph_g2_{index}" in the HDF5 file.  Any keyword
+        arguments are passed through to ``create_dataset()``.
         '''
-        return self.hdf5.create_dataset(f'eph_g2_{index}', data=data)
+        return self.hdf5.create_dataset(f'eph_g2_{index}', data=data, **kwargs)
 
-    def set_bands_index(self, index, data):
+    def set_bands_index(self, index, data, **kwargs):
         '''
         Create a bands_index dataset for the specified index.  The
-        dataset's name will be "bands_index_{index}" in the HDF5 file.
+        dataset's name will be "bands_index_{index}" in the HDF5 file.  Any
+        keyword arguments are passed through to ``create_dataset()``.
+        '''
+        return self.hdf5.create_dataset(f'bands_index_{index}', data=data, **kwargs)
+
+    def copy_kloc_from(self, src_f, src_index, index, copier) -> int:
+        '''
+        Copy both the eph_g2 and bands_index datasets for the k-location
+        ``src_index`` in the pool file ``src_f`` into this file, with the
+        index ``index``.  The ``copier`` is a ``DatasetCopier`` that performs
+        the actual data movement.  Returns the number of bytes copied.
+        '''
+        with stats.phase('copy', self.filename):
+            nbytes = copier.copy(src_f.hdf5, f'eph_g2_{src_index}',
+                self.hdf5, f'eph_g2_{index}')
+            nbytes += copier.copy(src_f.hdf5, f'bands_index_{src_index}',
+                self.hdf5, f'bands_index_{index}')
+
+        stats.add('bytes_read', nbytes, src_f.filename)
+        stats.add('bytes_written', nbytes, self.filename)
+        stats.add('datasets_copied', 2)
+        return nbytes
+
+    def link_kloc_from(self, src_filename, src_index, index):
+        '''
+        Create HDF5 external links for the eph_g2 and bands_index datasets
+        with the index ``index``, pointing at the k-location ``src_index`` in
+        the pool file ``src_filename``.  No data is copied.  A relative
+        ``src_filename`` is resolved by HDF5 relative to this file's
+        directory.
+        '''
+        self.hdf5[f'eph_g2_{index}'] = h5py.ExternalLink(src_filename, f'/eph_g2_{src_index}')
+        self.hdf5[f'bands_index_{index}'] = h5py.ExternalLink(src_filename, f'/bands_index_{src_index}')
+        stats.add('datasets_linked', 2)
+
+    def has_external_links(self) -> bool:
+        '''
+        Report whether this pool file's datasets are external links, as
+        written by a virtual reshape.  Only the first k-location is checked,
+        since a virtual pool file links all of them.  The file must be open.
         '''
-        return self.hdf5.create_dataset(f'bands_index_{index}', data=data)
+        link = self.hdf5.get('eph_g2_1', getlink=True)
+        return isinstance(link, h5py.ExternalLink)
+
+    def external_links(self) -> list:
+        '''
+        Return the ``(name, filename, path)`` of every external link in this
+        pool file.  The file must be open.
+        '''
+        links = []
+        for name in self.hdf5:
+            link = self.hdf5.get(name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                links.append( (name, link.filename, link.path) )
+        return links
+
+    def materialize_links(self, copier) -> int:
+        '''
+        Replace every external link in this pool file with a real copy of
+        the dataset it points to, using the ``DatasetCopier`` ``copier``.
+        The file must be open for writing.  Returns the number of links
+        that were replaced.
+
+        Each dataset is copied under a temporary name and then moved over
+        its link, so a failed copy leaves the link in place.
+        '''
+        links = self.external_links()
+
+        src_files = {}
+        try:
+            for (name, src_filename, src_path) in links:
+                if not os.path.isabs(src_filename):
+                    src_filename = os.path.join(os.path.dirname(self.filename), src_filename)
+
+                if src_filename not in src_files:
+                    src_files[src_filename] = h5py.File(src_filename, 'r')
+
+                # A leftover from an interrupted run
+                tmp_name = f'{name}.materializing'
+                if tmp_name in self.hdf5:
+                    del self.hdf5[tmp_name]
+
+                with stats.phase('copy', self.filename):
+                    try:
+                        nbytes = copier.copy(src_files[src_filename], src_path,
+                                             self.hdf5, tmp_name)
+                    except BaseException:
+                        if tmp_name in self.hdf5:
+                            del self.hdf5[tmp_name]
+                        raise
+
+                    del self.hdf5[name]
+                    self.hdf5.move(tmp_name, name)
+                stats.add('bytes_read', nbytes, src_filename)
+                stats.add('bytes_written', nbytes, self.filename)
+                stats.add('datasets_copied')
+        finally:
+            for f in src_files.values():
+                f.close()
+
+        return len(links)
 
 
 # Define the function that runs in the subprocess
-def mp_scan_perturbo_hdf5_file(filename, pool):
+def mp_scan_perturbo_hdf5_file(filename, pool, fast=True):
     '''
     This is the subprocess function that scans a Perturbo pool HDF5 file to
     verify that everything looks correct, and to determine some essential
     details of the pool file.
 
-    The process receives a pipe ``conn`` from the parent process, to which
-    it sends back the number of k-grid locations, and the number of k-q
-    pairs, in the file.
+    The scan results are returned as a dictionary (see
+    ``PoolFile.get_scan_info()``), along with a snapshot of the statistics
+    recorded while scanning.
 
     NOTE:  It seems like this needs to be a top-level function so it can
            be pickled and passed to the subprocess.  There may be a better
            way to do this in the long run, but this'll do for now.
     '''
-    f = PoolFile(filename, pool)
-    f.scan_contents()
-    return (f.nk_loc, f.nkq)
+    stats.reset()
+    with stats.phase('task'):
+        f = PoolFile(filename, pool)
+        f.scan_contents(fast=fast)
+        f.close()
+    return (f.get_scan_info(), stats.snapshot())
 
 
 class PoolFileSet:
@@ -166,6 +520,13 @@ class PoolFileSet:
         self.prefix = None
         self.nkpt = 0
         self.nkq = 0
+        self.num_cached = 0
+        self.kloc_index = None
+        self.file_cache = PoolFileCache()
+
+        # The global (zero-based) k-locations to reshape, in order, or None
+        # for all of them
+        self.selection = None
 
     def find_files(self):
         '''
@@ -201,7 +562,7 @@ class PoolFileSet:
             if i not in self.pool_files:
                 raise ValueError(f'Can\'t find file for pool {i} ,in {self.num_pools} pools')
 
-    def scan_files(self, progress=None):
+    def scan_files(self, progress=None, fast=True, manifest=None, keep_open=True):
         '''
         Open each HDF5 pool data file found by the ``find_files`` method,
         and scan its contents to see if they make sense, and to see how many
@@ -212,18 +573,44 @@ class PoolFileSet:
         is called after the file ``f`` has been scanned by the operation.
         Files are scanned, and will be reported to the progress function, in
         order of increasing pool-number.
+
+        If ``fast`` is ``False`` then the slower key-by-key probing scan is
+        used; see ``PoolFile.scan_contents()`` for details.
+
+        If a ``ScanManifest`` is provided as ``manifest``, files whose cached
+        scan results are still valid are not rescanned, and the manifest is
+        updated and saved with the results of any files that were scanned.
+
+        The files are left open afterward, unless ``keep_open`` is ``False``.
         '''
         self.nkpt = 0
         self.nkq = 0
+        self.num_cached = 0
         for pool in sorted(self.pool_files.keys()):
             f = self.pool_files[pool]
-            f.scan_contents()
+
+            info = manifest.lookup(f.filename) if manifest else None
+            if info is not None:
+                f.set_scan_info(info)
+                if keep_open:
+                    f.open('r')
+                self.num_cached += 1
+            else:
+                f.scan_contents(fast=fast)
+                if not keep_open:
+                    f.close()
+                if manifest:
+                    manifest.update(f.filename, f.get_scan_info())
+
             self.nkpt += f.nk_loc
             self.nkq += f.nkq
 
             if progress:
                 progress(pool, f)
 
+        if manifest:
+            manifest.save()
+
     def scan_files_mp(self, progress=None, **kwargs):
         '''
         Open each HDF5 pool data file found by the ``find_files`` method,
@@ -242,59 +629,109 @@ class PoolFileSet:
         Because of the use of multiple process, files are scanned in no
         specific order, but they are still reported to the progress function
         in order of increasing pool-number.
+
+        A ``ScanManifest`` may be provided with the ``manifest`` keyword
+        argument, and ``keep_open`` likewise; see ``scan_files()`` for
+        details.
         '''
 
         max_processes = kwargs.get('max_processes', DEFAULT_MAX_PROCESSES)
+        fast = kwargs.get('fast', True)
+        manifest = kwargs.get('manifest')
+        keep_open = kwargs.get('keep_open', True)
 
         self.nkpt = 0
         self.nkq = 0
+        self.num_cached = 0
+
+        # Files with valid cached results don't need to be scanned at all, so
+        # look them up first; if every file is cached, no subprocesses are
+        # started.
+        results: list[tuple[PoolFile, Any]] = []
+        for pool in sorted(self.pool_files.keys()):
+            f = self.pool_files[pool]
+            info = manifest.lookup(f.filename) if manifest else None
+            if info is not None:
+                self.num_cached += 1
+            results.append( (f, info) )
 
         # Spin up a subprocess for each input file to scan.  This way we can
         # scan them concurrently.
 
         # Unfortunately we have "multiprocessing.Pool" and also the
         # Perturbo pool files...
-        exec_pool = multiprocessing.Pool(max_processes)
-        results: list[tuple[PoolFile, multiprocessing.pool.AsyncResult]] = []
+        num_uncached = len(results) - self.num_cached
+        num_processes = min(max_processes, num_uncached)
+        exec_pool = multiprocessing.Pool(num_processes) if num_uncached > 0 else None
 
-        # Queue up the scans of all the pool files for execution.
-        for pool in sorted(self.pool_files.keys()):
-            f = self.pool_files[pool]
-            r = exec_pool.apply_async(mp_scan_perturbo_hdf5_file, (f.filename, pool) )
-            results.append( (f, r) )
+        # Queue up the scans of the remaining pool files for execution.
+        for (i, (f, info)) in enumerate(results):
+            if info is None:
+                r = exec_pool.apply_async(mp_scan_perturbo_hdf5_file, (f.filename, f.pool, fast) )
+                results[i] = (f, r)
 
-        exec_pool.close()
+        if exec_pool is not None:
+            exec_pool.close()
 
         # Wait for results to come back in order so our output looks nice.
+        start = time.perf_counter()
+        busy = 0.0
 
         errors = 0
         for (f, r) in results:
             try:
-                value = r.get()
+                if isinstance(r, dict):
+                    value = r
+                else:
+                    (value, snap) = r.get()
+                    busy += snap['phases'].get('task', 0.0)
+                    stats.merge(snap)
+                    if manifest:
+                        manifest.update(f.filename, value)
 
                 # Seems like things worked - unpack the result
-                (nk_loc, nkq) = value
-                f.nk_loc = nk_loc
-                f.nkq = nkq
-                self.nkpt += nk_loc
-                self.nkq += nkq
+                f.set_scan_info(value)
+                self.nkpt += f.nk_loc
+                self.nkq += f.nkq
 
                 if progress:
-                    progress(pool, f)
+                    progress(f.pool, f)
 
             except BaseException as err:
                 print(f'ERROR:  exception while scanning pool-file {f.pool}:')
                 traceback.print_exception(err)
                 errors += 1
 
-        exec_pool.join()
+        if exec_pool is not None:
+            exec_pool.join()
+
+        # Worker idle time is the time the workers weren't running tasks,
+        # over the span of the scan.
+        stats.add_time('worker_idle', max(0.0,
+            num_processes * (time.perf_counter() - start) - busy))
+
+        if manifest:
+            manifest.save()
 
         if not errors:
-            self.open_all('r')
+            if keep_open:
+                self.open_all('r')
         else:
             raise RuntimeError(f'{errors} error(s) detected during pool-file scans')
 
 
+    def global_kloc_nkq(self) -> list:
+        '''
+        Return the number of k-q pairs at each global (zero-based) k-location
+        of the scanned file set, undoing the round-robin assignment of
+        k-locations to pools.  Two pool-file sets with the same result hold
+        the same k-locations, whatever their pool counts.
+        '''
+        result = [0] * self.nkpt
+        for (pool, f) in self.pool_files.items():
+            result[pool - 1::self.num_pools] = f.kloc_nkq
+        return result
+
     def make_new_pool_files(self, prefix, num_pools):
         '''
         Generate a set of new pool data files with the specified file-prefix.
@@ -320,11 +757,142 @@ class PoolFileSet:
             f.make_new()
             self.pool_files[pool] = f
 
+    def select_klocs(self, klocs):
+        '''
+        Select the global (zero-based) k-locations of the scanned file set
+        that a reshape should copy, or ``None`` to select them all.  They
+        are sorted, and duplicates are ignored.  Raises ``ValueError`` if
+        any k-location is out of range.
+        '''
+        if klocs is None:
+            self.selection = None
+            return
+
+        selection = sorted(set(klocs))
+        if selection and (selection[0] < 0 or selection[-1] >= self.nkpt):
+            raise ValueError(f'K-locations must be in the range [0, {self.nkpt}); ' +
+                f'got {selection[0]} to {selection[-1]}')
+        self.selection = selection
+
+    def num_selected(self) -> int:
+        '''
+        Return the number of k-locations a reshape of this set will copy.
+        '''
+        return self.nkpt if self.selection is None else len(self.selection)
+
+    def load_kloc_index(self, cache_dir=None) -> bool:
+        '''
+        Load the saved k-location index of the pool files found by the
+        ``find_files`` method (see ``KLocIndex``), returning whether a
+        current one was found.  The index holds the files' scan results, so
+        if one is loaded the files don't need to be scanned.
+        '''
+        index = KLocIndex(self.path, cache_dir)
+        if not index.load():
+            return False
+
+        filenames = [os.path.basename(self.pool_files[pool].filename)
+                     for pool in range(1, self.num_pools + 1)]
+        if index.filenames != filenames:
+            return False
+
+        self.kloc_index = index
+        self.nkpt = 0
+        self.nkq = 0
+        for pool in range(1, self.num_pools + 1):
+            f = self.pool_files[pool]
+            f.set_scan_info(index.scan_info(pool))
+            self.nkpt += f.nk_loc
+            self.nkq += f.nkq
+
+        return True
+
+    def build_kloc_index(self, cache_dir=None):
+        '''
+        Build the k-location index of the scanned file set, and save it for
+        later ``load_kloc_index()`` calls.
+        '''
+        index = KLocIndex(self.path, cache_dir)
+        with stats.phase('build_kloc_index'):
+            index.build(self)
+        index.save()
+        self.kloc_index = index
+
+    def get_kloc(self, kloc) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Return the ``(eph_g2, bands_index)`` data of the specified global
+        (zero-based) k-location.  The k-location index is loaded, or built,
+        the first time this is called, and the set's files are scanned first
+        if no index can be loaded.  A newly built index is saved in the
+        pool-file directory as ``.pertool_kindex.npz`` (or in the cache
+        directory if that isn't writable; see ``KLocIndex``).  Files are kept
+        open between calls, up to a limit, until ``close_all()`` is called.
+        '''
+        if self.kloc_index is None and not self.load_kloc_index():
+            if self.nkpt == 0:
+                self.scan_files(keep_open=False)
+            self.build_kloc_index()
+
+        index = self.kloc_index
+        assert 0 <= kloc < len(index), \
+            f'k-location must be in the range [0, {len(index)}); got {kloc}'
+
+        f = self.file_cache.get(self.pool_files[int(index.pool[kloc])])
+        i = int(index.local_index[kloc])
+        return (f.get_eph_g2(i)[()], f.get_bands_index(i)[()])
+
     def open_all(self, mode):
         for f in self.pool_files.values():
             f.open(mode)
 
     def close_all(self):
+        self.file_cache.close_all()
         for f in self.pool_files.values():
             f.close()
 
+
+class PoolFileCache:
+    '''
+    A cache of open pool files, which keeps at most ``max_open`` of them
+    open at a time.  When another file has to be opened, the least recently
+    used one is closed.
+    '''
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_FILES, mode='r'):
+        assert max_open >= 1, f'Must allow at least 1 open file; got {max_open}'
+        self.max_open = max_open
+        self.mode = mode
+        self.files = collections.OrderedDict()
+
+    def get(self, f: PoolFile) -> PoolFile:
+        '''
+        Return the pool file ``f``, opening it if it isn't already open.
+        '''
+        if f.hdf5 is not None:
+            # Open already, possibly by someone else, e.g. left open after
+            # scanning; it is cached from now on.
+            if f.filename not in self.files:
+                self._make_room()
+                self.files[f.filename] = f
+            self.files.move_to_end(f.filename)
+            return f
+
+        # Closed by someone else
+        self.files.pop(f.filename, None)
+
+        self._make_room()
+        f.open(self.mode)
+        self.files[f.filename] = f
+        return f
+
+    def _make_room(self):
+        # Close the least recently used files until another one can be opened
+        while len(self.files) >= self.max_open:
+            (_, old_f) = self.files.popitem(last=False)
+            old_f.close()
+            stats.add('files_evicted')
+
+    def close_all(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
@@ -0,0 +1,311 @@
+'''
+Read-ahead for reshape workers.
+
+h5py serializes all calls into the HDF5 library behind one lock, so a
+second thread making h5py calls doesn't overlap I/O with the first.  The
+read-ahead thread here therefore only uses h5py to look up where each
+dataset's raw data lives in its file, which is quick, and then reads the
+bytes itself with ``os.pread()``, which runs without holding the lock or the
+GIL.  Meanwhile the calling thread writes the previous k-locations to the
+target file through h5py, so source reads and target writes overlap.
+
+Contiguous datasets are read as a single block, and chunked datasets are
+read chunk by chunk and written back with direct chunk writes, so that
+compressed data is never decompressed.  Datasets that can't be read this way
+(e.g. compact or variable-length ones), and all datasets when the output
+layout is being changed, are read through h5py instead.
+'''
+
+import os
+import threading
+
+import h5py
+import numpy as np
+
+from .poolfiles import *
+from .copier import dataset_layout
+from . import stats
+
+
+DEFAULT_PREFETCH_DEPTH = 0
+DEFAULT_PREFETCH_MB = 256
+
+
+class PrefetchBuffer:
+    '''
+    A FIFO buffer between the read-ahead thread and the writer, which holds
+    at most ``max_items`` items and ``max_bytes`` bytes.  An item larger than
+    ``max_bytes`` is still accepted when the buffer is empty, so that no
+    k-location can stall the pipeline.
+    '''
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = []
+        self.nbytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item, nbytes) -> bool:
+        '''
+        Add an item, waiting for space if necessary.  Returns ``False`` if
+        the buffer was closed by the consumer, in which case the producer
+        should stop.
+        '''
+        with self.cond:
+            while not self.closed and self.items and \
+                    (len(self.items) >= self.max_items or self.nbytes + nbytes > self.max_bytes):
+                self.cond.wait()
+
+            if self.closed:
+                return False
+
+            self.items.append( (item, nbytes) )
+            self.nbytes += nbytes
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        '''
+        Remove and return the oldest item, waiting for one if necessary.
+        '''
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+
+            (item, nbytes) = self.items.pop(0)
+            self.nbytes -= nbytes
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        '''
+        Tell the producer to stop, e.g. because the consumer failed.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class RawReader:
+    '''
+    Reads the raw bytes of datasets with ``os.pread()``, keeping a file
+    descriptor open for each file that is read from.
+    '''
+
+    def __init__(self):
+        self.fds = {}
+
+    def pread(self, filename, offset, size) -> bytes:
+        if filename not in self.fds:
+            self.fds[filename] = os.open(filename, os.O_RDONLY)
+
+        data = os.pread(self.fds[filename], size, offset)
+        if len(data) != size:
+            raise OSError(f'Short read of {size} bytes at offset {offset} in {filename}')
+        return data
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+def read_dataset(ds, raw_reader, layout=None) -> tuple:
+    '''
+    Read a dataset for writing to another file.  Returns a tuple of the way
+    it was read, the data, and the number of bytes read:
+
+    *   ``('chunks', (type, space, dcpl, chunks, attrs), nbytes)`` - the raw
+        chunks of a chunked dataset, as ``(offset, filter_mask, bytes)``
+        tuples, with the source's type, dataspace and creation properties.
+
+    *   ``('raw', (type, space, dcpl, array, attrs), nbytes)`` - the raw
+        contents of a contiguous dataset as a NumPy array, likewise.
+
+    *   ``('array', (array, create_kwargs, attrs), nbytes)`` - the
+        dataset's contents as a NumPy array, with the keyword arguments for
+        ``create_dataset()``.
+
+    Raw reads are only used when the output ``layout`` doesn't change the
+    storage layout.
+    '''
+    dsid = ds.id
+    attrs = dict(ds.attrs)
+    raw = ((layout is None or not layout.changes_layout()) and
+           ds.dtype.kind != 'O' and ds.size > 0)
+
+    # The data may be in another file, if this is an external link.
+    filename = ds.file.filename
+
+    if raw and ds.chunks is not None:
+        chunks = []
+        nbytes = 0
+        infos = [dsid.get_chunk_info(i) for i in range(dsid.get_num_chunks())]
+        for info in infos:
+            data = raw_reader.pread(filename, info.byte_offset, info.size)
+            chunks.append( (info.chunk_offset, info.filter_mask, data) )
+            nbytes += info.size
+        return ('chunks', (dsid.get_type(), dsid.get_space(), dsid.get_create_plist(),
+                           chunks, attrs), nbytes)
+
+    offset = dsid.get_offset() if raw else None
+    if offset is not None:
+        data = raw_reader.pread(filename, offset, dsid.get_storage_size())
+        array = np.frombuffer(data, dtype=ds.dtype).reshape(ds.shape)
+        return ('raw', (dsid.get_type(), dsid.get_space(), dsid.get_create_plist(),
+                        array, attrs), len(data))
+
+    array = ds[()]
+    return ('array', (array, dataset_layout(ds, layout), attrs), array.nbytes)
+
+
+def encode_dcpl(dcpl, dtype) -> tuple:
+    '''
+    Describe a dataset creation property list in a form that can be
+    pickled:  its chunk shape (or ``None``), filter pipeline and fill value
+    (or ``None``), which is all that a raw copy of the dataset needs.
+    '''
+    chunks = dcpl.get_chunk() if dcpl.get_layout() == h5py.h5d.CHUNKED else None
+    filters = [dcpl.get_filter(i)[:3] for i in range(dcpl.get_nfilters())]
+
+    fill_value = None
+    if dcpl.fill_value_defined() == h5py.h5d.FILL_VALUE_USER_DEFINED:
+        fill_value = np.zeros((1,), dtype=dtype)
+        dcpl.get_fill_value(fill_value)
+
+    return (chunks, filters, fill_value)
+
+
+def decode_dcpl(encoded):
+    '''
+    Recreate a dataset creation property list described by ``encode_dcpl()``.
+    '''
+    (chunks, filters, fill_value) = encoded
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    if chunks is not None:
+        dcpl.set_chunk(chunks)
+    for (code, flags, values) in filters:
+        dcpl.set_filter(code, flags, values)
+    if fill_value is not None:
+        dcpl.set_fill_value(fill_value)
+    return dcpl
+
+
+def portable_record(record) -> tuple:
+    '''
+    Convert a record from ``read_dataset()`` into one that can be pickled
+    and sent to another process, e.g. through a ``multiprocessing.Queue``.
+    ``write_dataset()`` accepts either form.
+    '''
+    (kind, data, nbytes) = record
+    if kind in ('chunks', 'raw'):
+        (type_id, space_id, dcpl, contents, attrs) = data
+        data = (type_id, space_id, encode_dcpl(dcpl, type_id.dtype), contents, attrs)
+    return (kind, data, nbytes)
+
+
+def write_dataset(tgt_group, name, record):
+    '''
+    Write a dataset read by ``read_dataset()`` into ``tgt_group``.
+    '''
+    # The low-level API is used where possible, since with many small
+    # datasets the high-level API's overhead is significant.
+    (kind, data, _) = record
+    if kind in ('chunks', 'raw'):
+        (type_id, space_id, dcpl, contents, attrs) = data
+        if not isinstance(dcpl, h5py.h5p.PropDCID):
+            dcpl = decode_dcpl(dcpl)
+        tgt_id = h5py.h5d.create(tgt_group.id, name.encode(), type_id, space_id, dcpl=dcpl)
+
+    if kind == 'chunks':
+        for (offset, filter_mask, chunk) in contents:
+            tgt_id.write_direct_chunk(offset, chunk, filter_mask)
+    elif kind == 'raw':
+        tgt_id.write(h5py.h5s.ALL, h5py.h5s.ALL, contents)
+    else:
+        (array, kwargs, attrs) = data
+        tgt_group.create_dataset(name, data=array, **kwargs)
+
+    for (attr_name, value) in attrs.items():
+        tgt_group[name].attrs[attr_name] = value
+
+
+def prefetch_plan(plan, sfset, buffer, layout, errors):
+    '''
+    Read-ahead thread function:  read both datasets of each ``(src_pool,
+    src_idx, tgt_idx)`` plan entry in order, and put them in the buffer.
+    A ``None`` item marks the end.  Any exception is appended to ``errors``.
+    '''
+    raw_reader = RawReader()
+    src_f = None
+    try:
+        for (src_pool, src_idx, tgt_idx) in plan:
+            if src_f is not sfset.pool_files[src_pool + 1]:
+                if src_f is not None:
+                    src_f.close()
+                src_f = sfset.pool_files[src_pool + 1]
+                src_f.open('r')
+
+            with stats.phase('prefetch_read', src_f.filename):
+                eph_g2 = read_dataset(src_f.get_eph_g2(src_idx + 1), raw_reader, layout)
+                bands_index = read_dataset(src_f.get_bands_index(src_idx + 1), raw_reader, layout)
+
+            nbytes = eph_g2[2] + bands_index[2]
+            stats.add('bytes_read', nbytes, src_f.filename)
+            with stats.phase('prefetch_wait'):
+                if not buffer.put((tgt_idx, eph_g2, bands_index), nbytes):
+                    return
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        if src_f is not None:
+            src_f.close()
+        raw_reader.close()
+        buffer.put(None, 0)
+
+
+def copy_plan_prefetched(tgt_f, plan, sfset, depth, max_bytes, layout=None,
+                         on_copied=None):
+    '''
+    Copy the k-locations in ``plan`` (a list of ``(src_pool, src_idx,
+    tgt_idx)`` entries, all zero-based) from the source pool-file set into
+    the open target file ``tgt_f``, with a read-ahead thread keeping up to
+    ``depth`` k-locations and ``max_bytes`` bytes buffered.  The source
+    files must not be open.
+
+    If ``on_copied(i: int)`` is provided, it is called after each plan
+    entry has been written, with the number of entries written so far.
+    '''
+    buffer = PrefetchBuffer(max(1, depth), max_bytes)
+    errors = []
+    thread = threading.Thread(target=prefetch_plan,
+        args=(plan, sfset, buffer, layout, errors), daemon=True)
+    thread.start()
+
+    try:
+        count = 0
+        while True:
+            with stats.phase('queue_wait'):
+                item = buffer.get()
+            if item is None:
+                break
+
+            (tgt_idx, eph_g2, bands_index) = item
+            with stats.phase('write', tgt_f.filename):
+                write_dataset(tgt_f.hdf5, f'eph_g2_{tgt_idx + 1}', eph_g2)
+                write_dataset(tgt_f.hdf5, f'bands_index_{tgt_idx + 1}', bands_index)
+
+            stats.add('bytes_written', eph_g2[2] + bands_index[2], tgt_f.filename)
+            stats.add('datasets_copied', 2)
+
+            count += 1
+            if on_copied:
+                on_copied(count)
+    finally:
+        buffer.close()
+        thread.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,87 @@
+'''
+Progress reporting from subprocesses through shared-memory counters.
+
+The parent process allocates one counter slot per task with
+``make_counters()``, and hands the counters to its subprocesses, either
+through ``make_pool()`` or as a ``multiprocessing.Process`` argument.  Each
+task only ever increments its own slot with ``advance()``, so no locking or
+message passing is needed; the parent simply polls the total.
+'''
+
+import multiprocessing
+import multiprocessing.sharedctypes
+
+from .poolfiles import DEFAULT_MAX_PROCESSES
+
+
+PROGRESS_POLL_INTERVAL = 0.25 # in seconds
+
+
+_counters = None
+
+
+def make_counters(num_slots):
+    '''
+    Allocate a zeroed shared-memory array of ``num_slots`` counters.
+    '''
+    return multiprocessing.sharedctypes.RawArray('q', num_slots)
+
+
+def init_worker(counters):
+    '''
+    Make ``counters`` the counters that ``advance()`` updates in this
+    process.  This is used as a ``multiprocessing.Pool`` initializer, since
+    shared-memory arrays can't be passed to pool tasks as arguments.
+    '''
+    global _counters
+    _counters = counters
+
+
+def advance(slot, n=1):
+    '''
+    Add ``n`` to the specified counter slot, if this process has counters.
+    '''
+    if _counters is not None:
+        _counters[slot] += n
+
+
+def make_pool(counters, max_processes=DEFAULT_MAX_PROCESSES):
+    '''
+    Create a ``multiprocessing.Pool`` whose workers report progress to
+    ``counters``.
+    '''
+    return multiprocessing.Pool(max_processes, initializer=init_worker,
+        initargs=(counters,))
+
+
+def wait_for_results(results, counters, progress=None, on_result=None):
+    '''
+    Wait for a list of ``AsyncResult`` objects to complete, calling
+    ``progress(total: int)`` with the sum of the counters as it changes.
+
+    As each task completes, its result is fetched, so that an exception in
+    any task is raised here immediately instead of being lost.  If
+    ``on_result(i: int, value)`` is provided, it is called with the index and
+    value of each completed task, in order of completion.
+    '''
+    pending = dict(enumerate(results))
+    last_total = -1
+    while True:
+        for (i, r) in list(pending.items()):
+            if r.ready():
+                value = r.get()
+                del pending[i]
+                if on_result:
+                    on_result(i, value)
+
+        total = sum(counters)
+        if progress and total != last_total:
+            progress(total)
+            last_total = total
+
+        if not pending:
+            break
+
+        # Waiting on any one pending result wakes us up as soon as it
+        # completes; the others are checked on the next pass.
+        next(iter(pending.values())).wait(PROGRESS_POLL_INTERVAL)
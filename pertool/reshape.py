@@ -1,7 +1,10 @@
 import argparse
+import hashlib
+import math
 import multiprocessing
 import os
 import re
+import shutil
 import sys
 import time
 
@@ -9,6 +12,20 @@ import progressbar
 
 # Support for Perturbo eph_g2 pool files
 from .poolfiles import *
+from .manifest import ScanManifest, files_fingerprint, origin_fingerprint, write_origin
+from .copier import *
+from .journal import *
+from .prefetch import *
+from .pipeline import DEFAULT_QUEUE_DEPTH, run_batched, run_source_major
+from . import progress
+from . import stats
+from . import verify
+
+
+SCHEDULERS = ['target', 'source', 'batched']
+DEFAULT_SCHEDULER = 'target'
+
+DEFAULT_WAVE_SIZE = 8
 
 
 def init_parser(subparsers):
@@ -21,8 +38,27 @@ def init_parser(subparsers):
     parser.add_argument('-t', '--todir', required=True,
         help='Target directory to write reshaped eph_g2_p*.h5 files to.')
 
-    parser.add_argument('-p', '--pools', type=int, required=True,
-        help='Number of pools to generate in the target directory.')
+    parser.add_argument('-p', '--pools', type=int,
+        help='Number of pools to generate in the target directory.  ' +
+             'Required unless --materialize is specified.')
+
+    parser.add_argument('--reuse', action='append', default=[], metavar='DIR',
+        help='An existing reshaped directory of the same source data to ' +
+             'consider reading from instead of the source directory.  May be ' +
+             'given more than once; the directory whose pool count needs the ' +
+             'fewest files per target file is used.')
+
+    parser.add_argument('--krange', metavar='FIRST:LAST[:STEP]',
+        help='Only copy the k-locations from FIRST to LAST inclusive, ' +
+             'numbered from 1, optionally taking every STEP-th one, e.g. to ' +
+             'make a small test input.  The selected k-locations are ' +
+             'renumbered in order.')
+
+    parser.add_argument('--klist', metavar='LIST',
+        help='Only copy the listed k-locations, numbered from 1, given as ' +
+             'a comma-separated list, or as @FILE to read whitespace- or ' +
+             'comma-separated numbers from a file.  May be combined with ' +
+             '--krange.')
 
     parser.add_argument('-n', '--dryrun', action='store_true',
         help='Perform a dry-run; don\'t write any target files out.')
@@ -30,12 +66,152 @@ def init_parser(subparsers):
     parser.add_argument('-q', '--quiet', action='store_true',
         help='Run in "quiet mode," with a minimum of output.')
 
+    parser.add_argument('--resume', action='store_true',
+        help='Resume an interrupted reshape into the target directory, ' +
+             'skipping target files that were completed and continuing ' +
+             'partially written ones from their last checkpoint.  The ' +
+             'source directory and pool count must be the same as before.')
+
+    parser.add_argument('--verify', action='store_true',
+        help='When finished, checksum every dataset of the source and ' +
+             'target files and check that they hold the same data.  See ' +
+             'also the verify command.')
+
     parser.add_argument('--mp', action='store_true',
         help='Use multiprocessing to speed up reshape operations.')
 
+    parser.add_argument('--mpi', action='store_true',
+        help='Run the reshape across all the ranks of an MPI job, e.g. when ' +
+             'started with mpirun or srun.  Requires the mpi4py package.')
+
+    parser.add_argument('--streaming', action='store_true',
+        help='Reshape serially in bounded memory, for very large pool ' +
+             'counts or small machines:  source files are closed after ' +
+             'scanning, at most --max-open-files files are open at once, ' +
+             'and target files are written in waves of --wave-size files.')
+
+    parser.add_argument('--max-open-files', type=int, default=DEFAULT_MAX_OPEN_FILES,
+        metavar='N',
+        help='Maximum number of HDF5 files open at once with --streaming, ' +
+             f'including the target files of a wave.  Default is {DEFAULT_MAX_OPEN_FILES}.')
+
+    parser.add_argument('--wave-size', type=int, default=DEFAULT_WAVE_SIZE, metavar='N',
+        help='Number of target files written at once with --streaming.  ' +
+             f'Default is {DEFAULT_WAVE_SIZE}.')
+
+    parser.add_argument('--chunk-cache-mb', type=int, metavar='MB',
+        help='Size of the HDF5 chunk cache of each open file, in megabytes.  ' +
+             'Default is the HDF5 library\'s default of 1 MB.')
+
+    parser.add_argument('--virtual', action='store_true',
+        help='Write target files whose datasets are HDF5 external links into ' +
+             'the source files, instead of copies of the data.  This takes ' +
+             'seconds and no extra disk space, but the source files must be ' +
+             'kept.  See also --materialize.')
+
+    parser.add_argument('--materialize', action='store_true',
+        help='Replace the external links in an existing virtual target ' +
+             'directory (specified with -t) with real copies of the data.  ' +
+             'No source directory or pool count is needed.')
+
     parser.add_argument('-M', '--max-processes', type=int, default=DEFAULT_MAX_PROCESSES,
         help=f'Specify maximum number of subprocesses to use.  Default is {DEFAULT_MAX_PROCESSES}.')
 
+    parser.add_argument('--scheduler', choices=SCHEDULERS, default=DEFAULT_SCHEDULER,
+        help='How --mp work is divided between subprocesses.  "target" runs ' +
+             'one task per target file, each reading from all source files.  ' +
+             '"source" has reader processes read each source file once and ' +
+             'stream k-locations to writer processes that own the target ' +
+             'files.  "batched" hands out batches of k-locations, sized by ' +
+             'their number of k-q pairs, to reader processes on demand, ' +
+             'with target files divided evenly by size between writer ' +
+             f'processes.  Default is {DEFAULT_SCHEDULER}.')
+
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+        help='Maximum number of k-locations buffered for each writer process ' +
+             f'with --scheduler=source or batched.  Default is {DEFAULT_QUEUE_DEPTH}.')
+
+    parser.add_argument('--batch-nkq', type=int,
+        help='Approximate number of k-q pairs in each batch with ' +
+             '--scheduler=batched.  Default is chosen from the total size ' +
+             'of the source files.')
+
+    parser.add_argument('--copy-mode', choices=COPY_MODES, default=DEFAULT_COPY_MODE,
+        help='How dataset contents are copied.  "auto" uses HDF5 object ' +
+             'copies, "buffered" copies raw chunks or slabs through a ' +
+             'bounded buffer, and "numpy" reads each dataset fully into ' +
+             'memory.  Doesn\'t apply to --scheduler=source or batched.  ' +
+             f'Default is {DEFAULT_COPY_MODE}.')
+
+    parser.add_argument('--copy-buffer', type=int, default=DEFAULT_COPY_BUFFER_MB,
+        metavar='MB',
+        help='Size of the per-process copy buffer for --copy-mode=buffered, ' +
+             f'in megabytes.  Default is {DEFAULT_COPY_BUFFER_MB}.')
+
+    parser.add_argument('--prefetch', type=int, default=DEFAULT_PREFETCH_DEPTH, metavar='K',
+        help='Number of k-locations for a separate thread to read ahead of ' +
+             'the writes, so that reads and writes overlap.  Applies to the ' +
+             'serial, --scheduler=target and --mpi reshapes.  Default is ' +
+             f'{DEFAULT_PREFETCH_DEPTH}, for no read-ahead.')
+
+    parser.add_argument('--prefetch-mb', type=int, default=DEFAULT_PREFETCH_MB, metavar='MB',
+        help='Maximum amount of data each --prefetch thread may buffer, in ' +
+             f'megabytes.  Default is {DEFAULT_PREFETCH_MB}.')
+
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=PRESERVE,
+        help='Compression filter for the target datasets.  "zstd", "lz4", ' +
+             '"blosc" and "bitshuffle" require the hdf5plugin package.  ' +
+             'Default is "preserve", to keep each source dataset\'s filters.')
+
+    parser.add_argument('--compression-level', type=int,
+        help='Compression level for gzip, zstd and blosc.  Default is the ' +
+             'source dataset\'s level, or the filter\'s default.')
+
+    parser.add_argument('--shuffle', choices=[PRESERVE, 'on', 'off'], default=PRESERVE,
+        help='Whether to apply the byte-shuffle filter before compression.  ' +
+             'Default is "preserve".')
+
+    parser.add_argument('--chunks', default=PRESERVE,
+        help='Chunking of the target datasets:  "preserve", "auto" to let ' +
+             'h5py choose, or the number of k-q pairs per chunk.  Compressed ' +
+             'datasets are always chunked.  Default is "preserve".')
+
+    parser.add_argument('--profile', action='store_true',
+        help='Report per-phase timings, bytes read and written, and the ' +
+             'slowest files when finished.')
+
+    parser.add_argument('--stats-json', metavar='PATH',
+        help='Write per-phase and per-file timings and I/O statistics to ' +
+             'the specified JSON file when finished.')
+
+    parser.add_argument('--no-cache', action='store_true',
+        help='Always rescan every source file, ignoring and not writing the scan manifest.')
+
+    parser.add_argument('--cache-dir',
+        help='Directory to keep the scan manifest in.  Default is the source ' +
+             'directory, or the user cache directory if that isn\'t writable.')
+
+
+def check_materialize_args(args):
+    # Check arguments for --materialize
+
+    print(f'Materializing virtual pool files in {args.todir}')
+    if not os.path.isdir(args.todir):
+        print(f'ERROR:  {args.todir} is not a directory')
+        sys.exit(1)
+
+    if args.virtual:
+        print('ERROR:  --virtual and --materialize can\'t be used together')
+        sys.exit(1)
+
+    if args.copy_buffer < 1:
+        print(f'ERROR:  Copy buffer size must be positive; got {args.copy_buffer}')
+        sys.exit(1)
+
+    make_layout(args)
+
+    if args.mp:
+        print(f'\nUsing multiprocessing to speed up performance.  Max processes = {args.max_processes}.')
 
 def check_args(args):
     # Check arguments
@@ -45,15 +221,90 @@ def check_args(args):
         print(f'ERROR:  {args.fromdir} is not a directory')
         sys.exit(1)
 
+    if args.pools is None:
+        print('ERROR:  Number of pools must be specified with -p')
+        sys.exit(1)
+
     if args.pools < 1:
         print(f'ERROR:  Number of pools must be positive; got {args.pools}')
         sys.exit(1)
 
+    for reuse_dir in args.reuse:
+        if not os.path.isdir(reuse_dir):
+            print(f'ERROR:  {reuse_dir} is not a directory')
+            sys.exit(1)
+
+        if os.path.abspath(reuse_dir) == os.path.abspath(args.todir):
+            print('ERROR:  The target directory can\'t also be reused as a source')
+            sys.exit(1)
+
+    if args.mp and args.mpi:
+        print('ERROR:  --mp and --mpi can\'t be used together')
+        sys.exit(1)
+
+    if args.scheduler != 'target' and not args.mp:
+        print(f'ERROR:  --scheduler={args.scheduler} requires --mp')
+        sys.exit(1)
+
+    if (args.krange or args.klist) and args.scheduler != 'target':
+        print(f'ERROR:  --krange and --klist can\'t be used with --scheduler={args.scheduler}')
+        sys.exit(1)
+
+    if args.copy_mode != DEFAULT_COPY_MODE and args.mp and args.scheduler != 'target':
+        print(f'ERROR:  --copy-mode can\'t be used with --scheduler={args.scheduler}, ' +
+              'which always sends raw chunks between processes')
+        sys.exit(1)
+
+    if args.batch_nkq is not None and args.batch_nkq < 1:
+        print(f'ERROR:  Batch size must be positive; got {args.batch_nkq}')
+        sys.exit(1)
+
+    if args.queue_depth < 1:
+        print(f'ERROR:  Queue depth must be positive; got {args.queue_depth}')
+        sys.exit(1)
+
+    if args.copy_buffer < 1:
+        print(f'ERROR:  Copy buffer size must be positive; got {args.copy_buffer}')
+        sys.exit(1)
+
+    if args.prefetch < 0 or args.prefetch_mb < 1:
+        print('ERROR:  --prefetch must be nonnegative and --prefetch-mb positive')
+        sys.exit(1)
+
+    if args.streaming:
+        if args.mp or args.mpi:
+            print('ERROR:  --streaming is a serial mode, and can\'t be used with --mp or --mpi')
+            sys.exit(1)
+
+        if args.prefetch > 0:
+            print('ERROR:  --prefetch can\'t be used with --streaming')
+            sys.exit(1)
+
+        if args.wave_size < 1 or args.max_open_files <= args.wave_size:
+            print('ERROR:  --wave-size must be positive, and --max-open-files ' +
+                  'must be greater than --wave-size')
+            sys.exit(1)
+
+    layout = make_layout(args)
+    if args.virtual and layout.changes_layout():
+        print('ERROR:  --virtual links to the source datasets, so their layout can\'t be changed')
+        sys.exit(1)
+
+    if args.resume and args.virtual:
+        print('ERROR:  --resume can\'t be used with --virtual')
+        sys.exit(1)
+
     print(f'Writing {args.pools} pool files to {args.todir}')
-    if os.path.exists(args.todir):
+    if args.resume:
+        if not ReshapeJournal(args.todir).exists():
+            print(f'ERROR:  No reshape journal found in {args.todir}; nothing to resume.')
+            sys.exit(1)
+    elif os.path.exists(args.todir):
         existing_files = os.listdir(args.todir)
         if len(existing_files) > 0:
             print(f'ERROR:  Existing files found in {args.todir}, aborting.')
+            if ReshapeJournal(args.todir).exists():
+                print('An interrupted reshape was found there; use --resume to continue it.')
             sys.exit(1)
 
     if args.mp:
@@ -68,13 +319,20 @@ def file_scan_progress(pool, f, max_filename_len):
 
     print(f' * {out_filename}nk_loc = {f.nk_loc}\tnkq = {f.nkq}')
 
-def scan_source_directory(args):
-    print(f'\nScanning source directory {args.fromdir}')
+def scan_source_directory(args, path=None, what='source', required=True):
+    # If the directory isn't required, finding no pool files in it raises
+    # ValueError rather than exiting.
+    if path is None:
+        path = args.fromdir
 
-    sfset = PoolFileSet(args.fromdir)
+    print(f'\nScanning {what} directory {path}')
+
+    sfset = PoolFileSet(path)
     sfset.find_files()
     if sfset.num_pools == 0:
-        print('ERROR:  Found no pool data files in source directory, aborting.')
+        if not required:
+            raise ValueError('found no pool data files')
+        print(f'ERROR:  Found no pool data files in {what} directory, aborting.')
         sys.exit(1)
 
     max_filename_len = max([len(f.filename) for f in sfset.pool_files.values()])
@@ -86,10 +344,21 @@ def scan_source_directory(args):
     if not args.quiet:
         progress=lambda pool, f : file_scan_progress(pool, f, max_filename_len)
 
+    manifest = None
+    if not args.no_cache:
+        manifest = ScanManifest(path, cache_dir=args.cache_dir)
+        manifest.load()
+
+    # In streaming mode, source files are only opened as they are needed.
+    keep_open = not args.streaming
     if args.mp:
-        sfset.scan_files_mp(progress=progress, max_processes=args.max_processes)
+        sfset.scan_files_mp(progress=progress, max_processes=args.max_processes,
+            manifest=manifest, keep_open=keep_open)
     else:
-        sfset.scan_files(progress=progress)
+        sfset.scan_files(progress=progress, manifest=manifest, keep_open=keep_open)
+
+    if sfset.num_cached > 0:
+        print(f'Used cached scan results for {sfset.num_cached} of {sfset.num_pools} files.')
 
     if not args.quiet:
         print(f'Total k-grid points:  {sfset.nkpt}\tTotal k-q pairs:  {sfset.nkq}')
@@ -97,71 +366,451 @@ def scan_source_directory(args):
     return sfset
 
 
-def write_new_target_files(args, sfset):
+def is_virtual_set(pfset) -> bool:
+    # Whether a scanned pool-file set was written by a virtual reshape.  Its
+    # files may have been left closed after scanning.
+    f = pfset.pool_files[1]
+    if f.hdf5 is not None:
+        return f.has_external_links()
+
+    f.open('r')
+    try:
+        return f.has_external_links()
+    finally:
+        f.close()
+
+
+def pool_set_origin(pfset) -> str:
+    # The fingerprint of the data in a pool-file set; see origin_fingerprint()
+    return origin_fingerprint(pfset.path, [f.filename for f in pfset.pool_files.values()])
+
+
+def record_origin(args, sfset):
+    '''
+    Record in the target directory that its files were reshaped from the
+    source set, so that later reshapes of the same source files can reuse
+    it.  Nothing is recorded for a selection of k-locations.
+    '''
+    if sfset.selection is not None:
+        return
+
+    tfset = PoolFileSet(args.todir)
+    tfset.find_files()
+    write_origin(args.todir, [f.filename for f in tfset.pool_files.values()],
+                 pool_set_origin(sfset))
+
+
+def scan_reuse_directories(args, sfset, scan=scan_source_directory) -> list:
+    '''
+    Scan the directories specified with --reuse, returning the pool-file
+    sets that were reshaped from the source set's files, unchanged since,
+    and hold exactly the same k-locations.  Other directories are reported
+    and ignored.  The ``scan`` function is called like
+    ``scan_source_directory()`` to scan each directory.
+    '''
+    expected = sfset.global_kloc_nkq()
+    origin = pool_set_origin(sfset)
+
+    reuse_sets = []
+    for reuse_dir in args.reuse:
+        try:
+            pfset = scan(args, reuse_dir, 'reused', required=False)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f'WARNING:  Can\'t reuse {reuse_dir}:  {e}')
+            continue
+
+        if pfset.prefix != sfset.prefix or pfset.global_kloc_nkq() != expected:
+            print(f'WARNING:  {reuse_dir} doesn\'t hold the same k-locations as ' +
+                  f'{args.fromdir}; not reusing it.')
+            pfset.close_all()
+        elif pool_set_origin(pfset) != origin:
+            print(f'WARNING:  {reuse_dir} wasn\'t reshaped from the current files in ' +
+                  f'{args.fromdir}, or has changed since; not reusing it.')
+            pfset.close_all()
+        elif is_virtual_set(pfset):
+            print(f'WARNING:  {reuse_dir} is a virtual reshape; materialize it ' +
+                  'before reusing it.')
+            pfset.close_all()
+        else:
+            reuse_sets.append(pfset)
+
+    return reuse_sets
+
+
+def reshape_cost(pfset, num_tgt_pools) -> tuple:
+    # Every target file reads from the same number of files of a pool-file
+    # set, so that is the main cost.  Among equals, a set with the target
+    # pool count is best, since its files can be copied whole.
+    files_per_target = len(source_pools_for_target(0, pfset.num_pools, num_tgt_pools))
+    return (files_per_target, pfset.num_pools != num_tgt_pools)
+
+
+def choose_source_set(args, sfset, reuse_sets):
+    '''
+    Choose the cheapest pool-file set to read the target files from, out of
+    the source set and the reused sets.  The source set wins ties.
+    '''
+    best = min([sfset] + reuse_sets, key=lambda pfset: reshape_cost(pfset, args.pools))
+    if best is not sfset:
+        print(f'\nReading from {best.path} ({best.num_pools} pools) instead of ' +
+              f'{sfset.path} ({sfset.num_pools} pools).')
+    return best
+
+
+def make_layout(args) -> OutputLayout:
+    chunks = args.chunks
+    if chunks not in (PRESERVE, 'auto'):
+        try:
+            chunks = int(chunks)
+        except ValueError:
+            chunks = 0
+        if chunks < 1:
+            print(f'ERROR:  --chunks must be "preserve", "auto" or a positive integer; got {args.chunks}')
+            sys.exit(1)
+
+    shuffle = {PRESERVE: PRESERVE, 'on': True, 'off': False}[args.shuffle]
+
+    try:
+        return OutputLayout(args.compression, args.compression_level, shuffle, chunks)
+    except ValueError as e:
+        print(f'ERROR:  {e}')
+        sys.exit(1)
+
+
+def make_copier(args):
+    return DatasetCopier(args.copy_mode, args.copy_buffer * 1024 * 1024, make_layout(args))
+
+
+def make_prefetch(args):
+    # The (depth, max_bytes) read-ahead settings, or None for no read-ahead
+    if args.prefetch == 0:
+        return None
+    return (args.prefetch, args.prefetch_mb * 1024 * 1024)
+
+
+def select_klocs(args, sfset, read_set):
+    '''
+    Apply the --krange/--klist selection, if any, to the source set and
+    the set chosen to read from, and report it.
+    '''
+    if not args.krange and not args.klist:
+        return
+
+    try:
+        selection = parse_kloc_selection(args.krange, args.klist, sfset.nkpt)
+    except (OSError, ValueError) as e:
+        print(f'ERROR:  Invalid k-location selection:  {e}')
+        sys.exit(1)
+
+    if len(selection) < args.pools:
+        print(f'ERROR:  Only {len(selection)} k-locations are selected; ' +
+              f'can\'t fill {args.pools} pools')
+        sys.exit(1)
+
+    sfset.select_klocs(selection)
+    read_set.select_klocs(selection)
+    print(f'Copying {len(selection)} of the {sfset.nkpt} k-locations.')
+
+
+def reshape_params(args, sfset) -> dict:
+    # The parameters a resumed reshape must match
+    params = {
+        'fromdir': os.path.abspath(args.fromdir),
+        'prefix': sfset.prefix,
+        'src_pools': sfset.num_pools,
+        'tgt_pools': args.pools,
+        'nkpt': sfset.nkpt,
+        'nkq': sfset.nkq,
+        'layout': make_layout(args).params(),
+        # Detects source files rewritten with the same numbers of k-q pairs
+        'files': files_fingerprint([f.filename for f in sfset.pool_files.values()]),
+    }
+    if sfset.selection is not None:
+        params['selection'] = hashlib.sha1(str(sfset.selection).encode()).hexdigest()
+    return params
+
+
+def start_journal(args, sfset) -> ReshapeJournal:
+    '''
+    Create the reshape journal in the target directory, or check that the
+    existing one matches this reshape if it is being resumed.
+    '''
+    journal = ReshapeJournal(args.todir)
+    params = reshape_params(args, sfset)
+
+    if args.resume:
+        if journal.load_params() != params:
+            print(f'ERROR:  The reshape journal in {args.todir} is for a different ' +
+                  'source directory, pool count, k-location selection or output ' +
+                  'layout, or the source files have changed.')
+            sys.exit(1)
+        print(f'\nResuming the interrupted reshape in {args.todir}')
+    else:
+        if not os.path.exists(args.todir):
+            print(f'NOTE:  {args.todir} doesn\'t exist; creating')
+            os.makedirs(args.todir)
+        journal.create(params)
+
+    return journal
+
+
+def copy_whole_target_file(src_f, filename, journal=None):
+    # Copy the source pool file to the target file of the same pool, unless
+    # the journal says it has already been done.
+    pool = src_f.pool
+    if (journal is not None and journal.target_state(pool - 1)['complete'] and
+            verify_target_file(filename, pool, src_f.kloc_nkq, journal.layout())):
+        return
+
+    tgt_f = PoolFile(partial_filename(filename), pool)
+    with stats.phase('copy', filename):
+        shutil.copyfile(src_f.filename, tgt_f.filename)
+
+    nbytes = os.path.getsize(tgt_f.filename)
+    stats.add('bytes_read', nbytes, src_f.filename)
+    stats.add('bytes_written', nbytes, filename)
+    stats.add('files_copied')
+
+    finish_target_file(tgt_f, filename, pool - 1, src_f.nk_loc, journal)
+
+
+def copy_whole_target_files(args, sfset, journal=None):
+    '''
+    Write the target files when the pool counts are the same, by copying
+    each source file as a whole.  K-location ``i`` of each source pool is
+    already k-location ``i`` of the same target pool.
+    '''
+    print(f'\nCopying pool files from {sfset.path} to directory {args.todir}')
+    print('The source and target pool counts are the same; copying whole files.')
+
+    if not os.path.exists(args.todir):
+        print(f'NOTE:  {args.todir} doesn\'t exist; creating')
+        os.makedirs(args.todir)
+
+    sfset.close_all()
+
+    count = 0
+    if not args.quiet:
+        bar = progressbar.ProgressBar(max_value=sfset.nkpt)
+        bar.start()
+    for pool in sorted(sfset.pool_files.keys()):
+        src_f = sfset.pool_files[pool]
+        filename = os.path.join(args.todir, make_pool_filename(sfset.prefix, pool))
+        copy_whole_target_file(src_f, filename, journal)
+
+        count += src_f.nk_loc
+        if not args.quiet:
+            bar.update(count)
+
+    if not args.quiet:
+        bar.finish()
+
+
+def copy_target_plan(tgt_f, plan, done, sfset, copier, prefetch=None, on_copied=None):
+    '''
+    Copy the entries of a target file's copy ``plan`` after the first
+    ``done`` into the open target file.  If ``on_copied(i: int)`` is
+    provided, it is called after each entry with the number of plan entries
+    now done.
+
+    Only the source files that actually feed this target are opened, one at
+    a time, and each is read sequentially.  For integer-ratio reshapes this
+    is a single source file (split) or a small fixed set (merge).  If
+    ``prefetch`` is a ``(depth, max_bytes)`` tuple, the source files are
+    read ahead by a separate thread while the target file is written.
+    '''
+    if prefetch:
+        (depth, max_bytes) = prefetch
+        copy_plan_prefetched(tgt_f, plan[done:], sfset, depth, max_bytes, copier.layout,
+            lambda n: on_copied(done + n) if on_copied else None)
+        return
+
+    src_f = None
+    for (i, (src_pool, src_idx, tgt_idx)) in enumerate(plan[done:], done):
+        if src_f is not sfset.pool_files[src_pool + 1]:
+            if src_f is not None:
+                src_f.close()
+            src_f = sfset.pool_files[src_pool + 1]
+            src_f.open('r')
+
+        tgt_f.copy_kloc_from(src_f, src_idx + 1, tgt_idx + 1, copier)
+
+        if on_copied:
+            on_copied(i + 1)
+
+    if src_f is not None:
+        src_f.close()
+
+
+def write_new_target_files(args, sfset, journal=None):
     print(f'\nWriting new set of pool files to directory {args.todir}')
 
     if not os.path.exists(args.todir):
         print(f'NOTE:  {args.todir} doesn\'t exist; creating')
         os.makedirs(args.todir)
 
-    tfset = PoolFileSet(args.todir)
-    tfset.make_new_pool_files(sfset.prefix, args.pools)
+    copier = make_copier(args)
+    prefetch = make_prefetch(args)
+
+    # Source files are opened as they are needed.
+    sfset.close_all()
 
-    bar = progressbar.ProgressBar(max_value=sfset.nkpt)
+    # Populate one target file at a time, reading each of its source files
+    # sequentially.
+    count = 0
+    bar = progressbar.ProgressBar(max_value=sfset.num_selected())
     bar.start()
-    for i_kloc in range(sfset.nkpt):
-        (src_pool, src_idx) = kloc_index_to_pool_index(i_kloc, sfset.num_pools)
-        (tgt_pool, tgt_idx) = kloc_index_to_pool_index(i_kloc, tfset.num_pools)
+    for tgt_pool in range(args.pools):
+        filename = os.path.join(args.todir, make_pool_filename(sfset.prefix, tgt_pool + 1))
+        plan = plan_target_copies(tgt_pool, args.pools, sfset)
 
-        src_f = sfset.pool_files[src_pool + 1]
-        tgt_f = tfset.pool_files[tgt_pool + 1]
+        (tgt_f, done) = open_target_file(filename, tgt_pool, plan, sfset, journal)
+        bar.update(count + done)
+        if tgt_f is not None:
+            checkpointer = Checkpointer(journal, tgt_f, tgt_pool)
 
-        tgt_f.set_eph_g2(tgt_idx + 1, src_f.get_eph_g2(src_idx + 1))
-        tgt_f.set_bands_index(tgt_idx + 1, src_f.get_bands_index(src_idx + 1))
+            def copied(i):
+                bar.update(count + i)
+                checkpointer.update(i)
 
-        bar.update(i_kloc + 1)
+            copy_target_plan(tgt_f, plan, done, sfset, copier, prefetch, copied)
+            finish_target_file(tgt_f, filename, tgt_pool, len(plan), journal)
+
+        count += len(plan)
     bar.finish()
-    tfset.close_all()
-    return tfset
 
 
-def mp_generate_perturbo_hdf5_file(filename, pool, num_pools, sfset, queue):
-    sfset.open_all('r')
+class WaveTarget:
+    '''
+    A target file being written as part of a wave in streaming mode.
+    '''
+
+    def __init__(self, tgt_f, filename, tgt_pool, plan, done, journal):
+        self.tgt_f = tgt_f
+        self.filename = filename
+        self.tgt_pool = tgt_pool
+        self.num_entries = len(plan)
+        self.done = done
+        self.checkpointer = Checkpointer(journal, tgt_f, tgt_pool)
+
+
+def plan_target_waves(num_src_pools, num_tgt_pools, wave_size) -> list:
+    '''
+    Divide the (zero-based) target pools into waves of at most
+    ``wave_size`` pools.  Target pools that read from the same source pools
+    (see ``source_pools_for_target()``) are put in the same or adjacent
+    waves.
+    '''
+    g = math.gcd(num_src_pools, num_tgt_pools)
+    order = sorted(range(num_tgt_pools), key=lambda t: (t % g, t))
+    return [order[i:i + wave_size] for i in range(0, num_tgt_pools, wave_size)]
+
+
+def write_target_wave(args, sfset, wave, sources, copier, journal, on_copied):
+    '''
+    Write a wave of target files at once, reading each of their source
+    files once, in order, through the ``sources`` file cache.  Calls
+    ``on_copied(n: int)`` after every ``n`` k-locations written or skipped.
+    '''
+    targets = {}
+    entries = []
+    try:
+        for tgt_pool in wave:
+            filename = os.path.join(args.todir, make_pool_filename(sfset.prefix, tgt_pool + 1))
+            plan = plan_target_copies(tgt_pool, args.pools, sfset)
+
+            (tgt_f, done) = open_target_file(filename, tgt_pool, plan, sfset, journal)
+            on_copied(done)
+            if tgt_f is None:
+                continue
+
+            targets[tgt_pool] = WaveTarget(tgt_f, filename, tgt_pool, plan, done, journal)
+            entries.extend((src_pool, src_idx, tgt_pool, tgt_idx)
+                           for (src_pool, src_idx, tgt_idx) in plan[done:])
+
+        # Each plan is ordered by source pool and index, so this order keeps
+        # every target's entries in plan order, as the journal requires.
+        entries.sort()
+
+        for (src_pool, src_idx, tgt_pool, tgt_idx) in entries:
+            src_f = sources.get(sfset.pool_files[src_pool + 1])
+            target = targets[tgt_pool]
+            target.tgt_f.copy_kloc_from(src_f, src_idx + 1, tgt_idx + 1, copier)
+
+            target.done += 1
+            target.checkpointer.update(target.done)
+            on_copied(1)
+
+        for target in targets.values():
+            finish_target_file(target.tgt_f, target.filename, target.tgt_pool,
+                target.num_entries, journal)
+    finally:
+        for target in targets.values():
+            target.tgt_f.close()
+
+
+def stream_write_new_target_files(args, sfset, journal=None):
+    '''
+    Write the target files serially with a bounded number of open files,
+    and so bounded memory.  Target files are written in waves of
+    ``--wave-size`` files, and the source files are opened through a cache
+    that keeps the rest of ``--max-open-files`` open, so that each wave
+    reads each of its source files once, and source files shared with the
+    previous wave are usually still open.
+    '''
+    print(f'\nWriting new set of pool files to directory {args.todir}')
+    print(f'Streaming in waves of {args.wave_size} target files, with at most ' +
+          f'{args.max_open_files} files open.')
 
-    tgt_f = PoolFile(filename, pool + 1)
-    tgt_f.open('w')
-    tgt_f.nk_loc = 0
+    if not os.path.exists(args.todir):
+        print(f'NOTE:  {args.todir} doesn\'t exist; creating')
+        os.makedirs(args.todir)
+
+    copier = make_copier(args)
+    sfset.close_all()
+    sources = PoolFileCache(args.max_open_files - args.wave_size)
 
     count = 0
-    t = time.time()
-    for i_kloc in range(pool, sfset.nkpt, num_pools):
-        (src_pool, src_idx) = kloc_index_to_pool_index(i_kloc, sfset.num_pools)
-        (tgt_pool, tgt_idx) = kloc_index_to_pool_index(i_kloc, num_pools)
+    bar = progressbar.ProgressBar(max_value=sfset.num_selected())
+    bar.start()
 
-        # All of the k-grid indexes we are traversing should map to this
-        # specific target file.
-        assert tgt_pool == pool, f'k-grid index {i_kloc} maps to {tgt_pool}, not expected pool {pool}'
+    def copied(n):
+        nonlocal count
+        count += n
+        bar.update(count)
 
-        src_f = sfset.pool_files[src_pool + 1]
+    try:
+        for wave in plan_target_waves(sfset.num_pools, args.pools, args.wave_size):
+            write_target_wave(args, sfset, wave, sources, copier, journal, copied)
+    finally:
+        sources.close_all()
+    bar.finish()
+
+
+def mp_generate_perturbo_hdf5_file(filename, pool, num_pools, sfset, copier, journal=None,
+                                   prefetch=None):
+    stats.reset()
+    task_start = time.perf_counter()
+
+    plan = plan_target_copies(pool, num_pools, sfset)
+    (tgt_f, done) = open_target_file(filename, pool, plan, sfset, journal)
+    progress.advance(pool, done)
 
-        tgt_f.set_eph_g2(tgt_idx + 1, src_f.get_eph_g2(src_idx + 1))
-        tgt_f.set_bands_index(tgt_idx + 1, src_f.get_bands_index(src_idx + 1))
+    if tgt_f is not None:
+        checkpointer = Checkpointer(journal, tgt_f, pool)
 
-        tgt_f.nk_loc += 1
+        def copied(i):
+            progress.advance(pool)
+            checkpointer.update(i)
 
-        count += 1
-        t2 = time.time()
-        if (t2 - t) >= SUBPROCESS_REPORT_INTERVAL:
-            queue.put( (pool, count) )
-            count = 0
-            t = t2
+        copy_target_plan(tgt_f, plan, done, sfset, copier, prefetch, copied)
+        finish_target_file(tgt_f, filename, pool, len(plan), journal)
 
-    queue.put( (pool, count) )
-    queue.put( (pool, None) )
-    queue.close()
+    stats.add_time('task', time.perf_counter() - task_start)
+    return stats.snapshot()
 
 
-def mp_write_new_target_files(args, sfset, **kwargs):
+def mp_write_new_target_files(args, sfset, journal=None, **kwargs):
     print(f'\nWriting new set of pool files to directory {args.todir}')
 
     if not os.path.exists(args.todir):
@@ -174,10 +823,14 @@ def mp_write_new_target_files(args, sfset, **kwargs):
     # the HDF5 files since we can't pickle them.
     sfset.close_all()
 
-    exec_pool = multiprocessing.Pool(max_processes)
-    tasks = {}
-    manager = multiprocessing.Manager()
-    queue = manager.Queue()
+    copier = make_copier(args)
+    prefetch = make_prefetch(args)
+
+    # Each task counts the k-locations it has written in its own slot of a
+    # shared-memory array, which we poll for progress.
+    counters = progress.make_counters(args.pools)
+    exec_pool = progress.make_pool(counters, max_processes)
+    results = []
 
     # Queue up a task for each target file we are writing.
     for tgt_pool in range(args.pools):
@@ -185,53 +838,293 @@ def mp_write_new_target_files(args, sfset, **kwargs):
         tgt_filename = os.path.join(args.todir, tgt_filename)
 
         r = exec_pool.apply_async(mp_generate_perturbo_hdf5_file,
-            (tgt_filename, tgt_pool, args.pools, sfset, queue))
+            (tgt_filename, tgt_pool, args.pools, sfset, copier, journal, prefetch))
 
-        tasks[tgt_pool] = r
+        results.append(r)
 
     exec_pool.close()
 
     # Monitor the subprocesses for their completion.
 
+    update = None
+    if not args.quiet:
+        bar = progressbar.ProgressBar(max_value=sfset.num_selected())
+        bar.start()
+        update = bar.update
+
+    start = time.perf_counter()
+    busy = 0.0
+
+    def task_finished(tgt_pool, snap):
+        nonlocal busy
+        busy += snap['phases'].get('task', 0.0)
+        stats.merge(snap)
+
+    try:
+        progress.wait_for_results(results, counters, update, task_finished)
+    except BaseException:
+        # Don't leave the other workers running if one of them failed.
+        exec_pool.terminate()
+        exec_pool.join()
+        raise
+
+    if not args.quiet:
+        bar.finish()
+
+    # Clean up the executor pool.
+    exec_pool.join()
+
+    # Worker idle time is the time the workers weren't running tasks, over
+    # the span of the reshape.
+    stats.add_time('worker_idle', max(0.0,
+        max_processes * (time.perf_counter() - start) - busy))
+
+
+def sm_write_new_target_files(args, sfset, journal=None):
+    print(f'\nWriting new set of pool files to directory {args.todir}')
+    print('Using source-major scheduling; each source file is read once.')
+
+    if not os.path.exists(args.todir):
+        print(f'NOTE:  {args.todir} doesn\'t exist; creating')
+        os.makedirs(args.todir)
+
+    update = None
+    if not args.quiet:
+        bar = progressbar.ProgressBar(max_value=sfset.nkpt)
+        bar.start()
+        update = bar.update
+
+    run_source_major(sfset, args.todir, args.pools, max_processes=args.max_processes,
+        queue_depth=args.queue_depth, progress=update, journal=journal,
+        layout=make_layout(args))
+
+    if not args.quiet:
+        bar.finish()
+
+
+def batched_write_new_target_files(args, sfset, journal=None):
+    print(f'\nWriting new set of pool files to directory {args.todir}')
+    print('Using batched scheduling with dynamic load balancing.')
+
+    if not os.path.exists(args.todir):
+        print(f'NOTE:  {args.todir} doesn\'t exist; creating')
+        os.makedirs(args.todir)
+
+    update = None
     if not args.quiet:
         bar = progressbar.ProgressBar(max_value=sfset.nkpt)
         bar.start()
+        update = bar.update
+
+    run_batched(sfset, args.todir, args.pools, max_processes=args.max_processes,
+        queue_depth=args.queue_depth, batch_nkq=args.batch_nkq, progress=update,
+        journal=journal, layout=make_layout(args))
+
+    if not args.quiet:
+        bar.finish()
+
+
+def write_virtual_target_files(args, sfset):
+    print(f'\nWriting new set of virtual pool files to directory {args.todir}')
+
+    if not os.path.exists(args.todir):
+        print(f'NOTE:  {args.todir} doesn\'t exist; creating')
+        os.makedirs(args.todir)
+
+    # Only links are written, so the source files don't need to be open.
+    sfset.close_all()
+
+    tfset = PoolFileSet(args.todir)
+    tfset.make_new_pool_files(sfset.prefix, args.pools)
+
+    # Link targets are stored relative to the target directory, so that the
+    # source and target directories can be moved together.
+    src_filenames = {}
+    for (pool, f) in sfset.pool_files.items():
+        src_filenames[pool] = os.path.relpath(os.path.abspath(f.filename),
+            start=os.path.abspath(args.todir))
+
+    for tgt_pool in range(tfset.num_pools):
+        tgt_f = tfset.pool_files[tgt_pool + 1]
+        for (src_pool, src_idx, tgt_idx) in plan_target_copies(tgt_pool, tfset.num_pools, sfset):
+            tgt_f.link_kloc_from(src_filenames[src_pool + 1], src_idx + 1, tgt_idx + 1)
+
+    tfset.close_all()
+    return tfset
+
+
+def mp_materialize_perturbo_hdf5_file(filename, pool, copier):
+    stats.reset()
+    f = PoolFile(filename, pool)
+    f.open('a')
+    try:
+        return (f.materialize_links(copier), stats.snapshot())
+    finally:
+        f.close()
 
+
+def count_target_links(tfset) -> int:
+    # The number of links --materialize would replace, for --dryrun
     count = 0
-    while len(tasks) > 0:
-        (tgt_pool, value) = queue.get()
+    for f in tfset.pool_files.values():
+        f.open('r')
+        try:
+            count += len(f.external_links())
+        finally:
+            f.close()
+    return count
 
-        if value is None:
-            # Finished processing specified pool.
-            # TODO:  Not sure if this is necessary.  tasks[tgt_pool].get()
-            del tasks[tgt_pool]
-        else:
-            count += value
 
+def materialize_target_files(args):
+    tfset = PoolFileSet(args.todir)
+    tfset.find_files()
+    if tfset.num_pools == 0:
+        print('ERROR:  Found no pool data files in target directory, aborting.')
+        sys.exit(1)
+
+    if args.dryrun:
+        print('\nDry-run requested, not writing output files.')
+        print(f'Would materialize {count_target_links(tfset)} linked datasets in ' +
+              f'{tfset.num_pools} files.')
+        return
+
+    copier = make_copier(args)
+
+    if not args.quiet:
+        bar = progressbar.ProgressBar(max_value=tfset.num_pools)
+        bar.start()
+
+    count = 0
+    if args.mp:
+        exec_pool = multiprocessing.Pool(args.max_processes)
+        results = []
+        for pool in sorted(tfset.pool_files.keys()):
+            f = tfset.pool_files[pool]
+            results.append(exec_pool.apply_async(mp_materialize_perturbo_hdf5_file,
+                (f.filename, pool, copier)))
+        exec_pool.close()
+
+        for (i, r) in enumerate(results):
+            (n, snap) = r.get()
+            count += n
+            stats.merge(snap)
+            if not args.quiet:
+                bar.update(i + 1)
+
+        exec_pool.join()
+    else:
+        for pool in sorted(tfset.pool_files.keys()):
+            f = tfset.pool_files[pool]
+            f.open('a')
+            count += f.materialize_links(copier)
+            f.close()
             if not args.quiet:
-                bar.update(count)
+                bar.update(pool)
 
     if not args.quiet:
         bar.finish()
 
-    # Clean up the executor pool.
-    exec_pool.join()
+    print(f'Materialized {count} linked datasets in {tfset.num_pools} files.')
+
+
+def report_reshape_ratio(args, sfset):
+    ratio = reshape_ratio(sfset.num_pools, args.pools)
+    if ratio is None:
+        num_sources = len(source_pools_for_target(0, sfset.num_pools, args.pools))
+        print(f'\nReshaping {sfset.num_pools} pools into {args.pools}; each target ' +
+              f'file reads from {num_sources} source file(s).')
+    elif ratio[0] == 'split':
+        print(f'\nReshaping {sfset.num_pools} pools into {args.pools}:  integer-ratio ' +
+              f'split, each source file is partitioned into {ratio[1]} target file(s).')
+    else:
+        print(f'\nReshaping {sfset.num_pools} pools into {args.pools}:  integer-ratio ' +
+              f'merge, each target file is built from {ratio[1]} whole source files.')
 
 
 def main(args):
+    # This applies to every file opened from here on, in any mode.
+    if args.chunk_cache_mb is not None:
+        if args.chunk_cache_mb < 0:
+            print(f'ERROR:  Chunk cache size must be nonnegative; got {args.chunk_cache_mb}')
+            sys.exit(1)
+        set_chunk_cache_size(args.chunk_cache_mb * 1024 * 1024)
+
+    if args.mpi:
+        # Imported here, since the MPI backend is built on this module.
+        from . import reshape_mpi
+        reshape_mpi.main(args)
+        sys.exit(0)
+
+    start = time.perf_counter()
+
+    if args.materialize:
+        check_materialize_args(args)
+        with stats.phase('stage_materialize'):
+            materialize_target_files(args)
+        stats.emit(time.perf_counter() - start, args.profile, args.stats_json,
+            command='reshape --materialize')
+        print('\nDone!')
+        sys.exit(0)
+
     check_args(args)
 
-    sfset = scan_source_directory(args)
+    with stats.phase('stage_scan'):
+        sfset = scan_source_directory(args)
+        reuse_sets = scan_reuse_directories(args, sfset)
+
+    # The target files may be cheaper to produce from a previous reshape of
+    # the same data.
+    read_set = choose_source_set(args, sfset, reuse_sets)
+    report_reshape_ratio(args, read_set)
+    select_klocs(args, sfset, read_set)
 
+    write_start = time.perf_counter()
     if not args.dryrun:
-        if args.mp:
-            mp_write_new_target_files(args, sfset, max_processes=args.max_processes)
+        if args.virtual:
+            write_virtual_target_files(args, read_set)
         else:
-            write_new_target_files(args, sfset)
+            # The journal is only needed until every target file is complete.
+            journal = start_journal(args, sfset)
+            if (read_set.num_pools == args.pools and read_set.selection is None and
+                    not make_layout(args).changes_layout()):
+                copy_whole_target_files(args, read_set, journal)
+            elif args.mp and args.scheduler == 'source':
+                sm_write_new_target_files(args, read_set, journal)
+            elif args.mp and args.scheduler == 'batched':
+                batched_write_new_target_files(args, read_set, journal)
+            elif args.mp:
+                mp_write_new_target_files(args, read_set, journal,
+                    max_processes=args.max_processes)
+            elif args.streaming:
+                stream_write_new_target_files(args, read_set, journal)
+            else:
+                write_new_target_files(args, read_set, journal)
+            journal.remove()
+            record_origin(args, sfset)
     else:
         print('\nDry-run requested, not writing output files.')
+    stats.add_time('stage_write', time.perf_counter() - write_start)
 
     sfset.close_all()
+    for pfset in reuse_sets:
+        pfset.close_all()
+
+    # The target files are checked against the original source files, even
+    # if they were read from a reused directory.
+    matched = True
+    if args.verify and not args.dryrun:
+        tfset = verify.scan_pool_directory(args, args.todir, 'target', use_manifest=False)
+        matched = verify.verify_pool_sets(args, sfset, tfset,
+            verify.DEFAULT_VERIFY_BUFFER_MB * 1024 * 1024)
+
+    stats.emit(time.perf_counter() - start, args.profile, args.stats_json,
+        command='reshape',
+        scheduler=args.scheduler if args.mp else 'streaming' if args.streaming else 'serial',
+        src_pools=sfset.num_pools, tgt_pools=args.pools, nkpt=sfset.nkpt, nkq=sfset.nkq,
+        read_from=read_set.path)
+
+    if not matched:
+        sys.exit(1)
 
     print('\nDone!')
     sys.exit(0)
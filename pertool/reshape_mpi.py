@@ -0,0 +1,341 @@
+'''
+MPI backend for the reshape command, for running one reshape across many
+nodes with ``mpirun``/``srun``, e.g.:
+
+    srun -n 256 python -m pertool reshape --mpi -f ./tmp -t ./tmp-128 -p 128
+
+The source files are scanned by all ranks, each taking every N-th file, and
+the scan results are shared with every rank.  Target files are then divided
+between the ranks so that each rank has a similar number of k-q pairs to
+write, and each rank writes its own target files, reading only the source
+files that feed them.  Every file is only ever opened by one rank at a time
+with HDF5's default driver, so parallel HDF5 isn't needed:  with thousands
+of small datasets per file, the collective metadata operations that a
+shared file opened with the "mpio" driver requires would cost more than
+they save.
+
+Only rank 0 prints output.  If any rank fails, the whole job is aborted.
+'''
+
+import os
+import sys
+import time
+import traceback
+
+# Optional:  only needed with --mpi
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+from .poolfiles import *
+from .manifest import ScanManifest
+from .journal import *
+from .pipeline import balanced_owners, target_pool_nkq
+from . import reshape
+from . import stats
+from . import verify
+
+
+def scan_directory(comm, args, path=None, what='source', required=True, use_manifest=True):
+    '''
+    Scan a pool-file directory with all ranks, and return the scanned
+    ``PoolFileSet`` on every rank.  Called like
+    ``reshape.scan_source_directory()``.  The scan manifest is only used if
+    ``use_manifest`` is true.
+    '''
+    if path is None:
+        path = args.fromdir
+
+    print(f'\nScanning {what} directory {path} with {comm.size} ranks')
+
+    pfset = PoolFileSet(path)
+    pfset.find_files()
+    if pfset.num_pools == 0:
+        if not required:
+            raise ValueError('found no pool data files')
+        print(f'ERROR:  Found no pool data files in {what} directory, aborting.')
+        sys.exit(1)
+
+    manifest = None
+    if use_manifest and not args.no_cache:
+        manifest = ScanManifest(path, cache_dir=args.cache_dir)
+        manifest.load()
+
+    # Each rank scans every N-th file that isn't in the manifest.  A rank
+    # that fails to scan a file still takes part in the allgather, and
+    # reports the error so that every rank raises it together; otherwise
+    # the other ranks would wait for it forever.
+    infos = {}
+    scanned = {}
+    error = None
+    for (i, pool) in enumerate(sorted(pfset.pool_files.keys())):
+        f = pfset.pool_files[pool]
+        info = manifest.lookup(f.filename) if manifest else None
+        if info is not None:
+            infos[pool] = info
+            pfset.num_cached += 1
+        elif i % comm.size == comm.rank:
+            try:
+                f.scan_contents(fast=True)
+            except Exception as e:
+                error = f'Can\'t scan {f.filename}:  {e}'
+                break
+            finally:
+                f.close()
+            scanned[pool] = f.get_scan_info()
+
+    parts = comm.allgather( (scanned, error) )
+    errors = [error for (_, error) in parts if error is not None]
+    if errors:
+        raise ValueError(errors[0])
+
+    for (part, _) in parts:
+        infos.update(part)
+        if manifest and comm.rank == 0:
+            for (pool, info) in part.items():
+                manifest.update(pfset.pool_files[pool].filename, info)
+
+    if manifest and comm.rank == 0:
+        manifest.save()
+
+    for pool in sorted(pfset.pool_files.keys()):
+        f = pfset.pool_files[pool]
+        f.set_scan_info(infos[pool])
+        pfset.nkpt += f.nk_loc
+        pfset.nkq += f.nkq
+
+    # The files are left closed; target files open the sources they need.
+    if pfset.num_cached > 0:
+        print(f'Used cached scan results for {pfset.num_cached} of {pfset.num_pools} files.')
+
+    if not args.quiet:
+        print(f'Total k-grid points:  {pfset.nkpt}\tTotal k-q pairs:  {pfset.nkq}')
+
+    return pfset
+
+
+def start_journal(comm, args, sfset) -> ReshapeJournal:
+    '''
+    Create or check the reshape journal on rank 0, as
+    ``reshape.start_journal()`` does, and make every rank exit if it fails.
+    '''
+    code = 0
+    if comm.rank == 0:
+        try:
+            reshape.start_journal(args, sfset)
+        except SystemExit as e:
+            code = e.code
+
+    # This also keeps the other ranks from writing until the target
+    # directory and journal exist.
+    code = comm.bcast(code, root=0)
+    if code:
+        sys.exit(code)
+
+    return ReshapeJournal(args.todir)
+
+
+def write_target_files(comm, args, sfset, journal):
+    '''
+    Write this rank's share of the target files.  Target files are assigned
+    to ranks so that every rank writes a similar number of k-q pairs.
+    '''
+    print(f'\nWriting new set of pool files to directory {args.todir} ' +
+          f'from {comm.size} ranks')
+
+    owners = balanced_owners(target_pool_nkq(sfset, args.pools), comm.size)
+    whole_files = (sfset.num_pools == args.pools and sfset.selection is None and
+                   not reshape.make_layout(args).changes_layout())
+    copier = reshape.make_copier(args)
+    if whole_files:
+        print('The source and target pool counts are the same; copying whole files.')
+
+    sfset.close_all()
+
+    # Each target file's task starts with fresh statistics, so collect them
+    # all and combine them at the end.
+    snaps = [stats.snapshot()]
+    for tgt_pool in range(args.pools):
+        if owners[tgt_pool] != comm.rank:
+            continue
+
+        filename = os.path.join(args.todir, make_pool_filename(sfset.prefix, tgt_pool + 1))
+        if whole_files:
+            stats.reset()
+            reshape.copy_whole_target_file(sfset.pool_files[tgt_pool + 1], filename, journal)
+            snaps.append(stats.snapshot())
+        else:
+            snaps.append(reshape.mp_generate_perturbo_hdf5_file(filename, tgt_pool,
+                args.pools, sfset, copier, journal, reshape.make_prefetch(args)))
+
+    stats.reset()
+    for snap in snaps:
+        stats.merge(snap)
+
+
+def verify_target_files(comm, args, sfset) -> bool:
+    '''
+    Check the target files against the source files, as
+    ``verify.verify_pool_sets()`` does, with each rank checksumming every
+    N-th file of both sets.  Returns whether they matched on every rank.
+    '''
+    tfset = scan_directory(comm, args, args.todir, 'target', use_manifest=False)
+    tfset.close_all()
+    sfset.close_all()
+
+    print(f'\nVerifying {tfset.path} against {sfset.path}')
+    src_sums = {}
+    tgt_sums = {}
+    if sfset.num_selected() == tfset.nkpt:
+        buffer_size = verify.DEFAULT_VERIFY_BUFFER_MB * 1024 * 1024
+        with stats.phase('stage_verify'):
+            src_sums = verify.checksum_pool_files(sfset, buffer_size,
+                pools=sorted(sfset.pool_files.keys())[comm.rank::comm.size])
+            tgt_sums = verify.checksum_pool_files(tfset, buffer_size,
+                pools=sorted(tfset.pool_files.keys())[comm.rank::comm.size])
+
+    parts = comm.gather( (src_sums, tgt_sums), root=0)
+    matched = None
+    if comm.rank == 0:
+        for (src_part, tgt_part) in parts:
+            src_sums.update(src_part)
+            tgt_sums.update(tgt_part)
+        matched = verify.report_mismatches(
+            verify.compare_checksums(sfset, src_sums, tfset, tgt_sums))
+
+    return comm.bcast(matched, root=0)
+
+
+def materialize_target_files(comm, args):
+    '''
+    Materialize a virtual target directory, with each rank taking every
+    N-th file.
+    '''
+    tfset = PoolFileSet(args.todir)
+    tfset.find_files()
+    if tfset.num_pools == 0:
+        print('ERROR:  Found no pool data files in target directory, aborting.')
+        sys.exit(1)
+
+    if args.dryrun:
+        # Only rank 0 prints, so only it needs to look at the links.
+        if comm.rank == 0:
+            print('\nDry-run requested, not writing output files.')
+            print(f'Would materialize {reshape.count_target_links(tfset)} linked ' +
+                  f'datasets in {tfset.num_pools} files.')
+        return
+
+    copier = reshape.make_copier(args)
+
+    count = 0
+    snaps = [stats.snapshot()]
+    for pool in sorted(tfset.pool_files.keys())[comm.rank::comm.size]:
+        (n, snap) = reshape.mp_materialize_perturbo_hdf5_file(
+            tfset.pool_files[pool].filename, pool, copier)
+        count += n
+        snaps.append(snap)
+
+    stats.reset()
+    for snap in snaps:
+        stats.merge(snap)
+
+    count = comm.reduce(count, op=MPI.SUM, root=0)
+    print(f'Materialized {count} linked datasets in {tfset.num_pools} files.')
+
+
+def finish(comm, args, start, **extra):
+    '''
+    Wait for every rank to finish, then combine the ranks' statistics and
+    report them from rank 0.
+    '''
+    snaps = comm.gather(stats.snapshot(), root=0)
+    if comm.rank == 0:
+        stats.reset()
+        for snap in snaps:
+            stats.merge(snap)
+        stats.emit(time.perf_counter() - start, args.profile, args.stats_json, **extra)
+
+
+def run(comm, args):
+    start = time.perf_counter()
+
+    if args.materialize:
+        reshape.check_materialize_args(args)
+        with stats.phase('stage_materialize'):
+            materialize_target_files(comm, args)
+        finish(comm, args, start, command='reshape --materialize', ranks=comm.size)
+        print('\nDone!')
+        return
+
+    reshape.check_args(args)
+
+    # Every rank must check the target directory before rank 0 writes to it.
+    comm.Barrier()
+
+    def scan(args, path, what, required=True):
+        return scan_directory(comm, args, path, what, required)
+
+    with stats.phase('stage_scan'):
+        sfset = scan_directory(comm, args)
+        reuse_sets = reshape.scan_reuse_directories(args, sfset, scan=scan)
+
+    read_set = reshape.choose_source_set(args, sfset, reuse_sets)
+    reshape.report_reshape_ratio(args, read_set)
+    reshape.select_klocs(args, sfset, read_set)
+
+    write_start = time.perf_counter()
+    if args.dryrun:
+        print('\nDry-run requested, not writing output files.')
+    elif args.virtual:
+        # Writing links is quick, so rank 0 does it alone.
+        if comm.rank == 0:
+            reshape.write_virtual_target_files(args, read_set)
+    else:
+        journal = start_journal(comm, args, sfset)
+        write_target_files(comm, args, read_set, journal)
+
+        comm.Barrier()
+        if comm.rank == 0:
+            journal.remove()
+            reshape.record_origin(args, sfset)
+    stats.add_time('stage_write', time.perf_counter() - write_start)
+
+    sfset.close_all()
+    for pfset in reuse_sets:
+        pfset.close_all()
+
+    matched = True
+    if args.verify and not args.dryrun:
+        comm.Barrier()
+        matched = verify_target_files(comm, args, sfset)
+
+    finish(comm, args, start, command='reshape', scheduler='mpi', ranks=comm.size,
+        src_pools=sfset.num_pools, tgt_pools=args.pools, nkpt=sfset.nkpt, nkq=sfset.nkq,
+        read_from=read_set.path)
+
+    if not matched:
+        sys.exit(1)
+
+    print('\nDone!')
+
+
+def main(args):
+    if MPI is None:
+        print('ERROR:  --mpi requires the mpi4py package')
+        sys.exit(1)
+
+    comm = MPI.COMM_WORLD
+    if comm.rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+
+    try:
+        run(comm, args)
+    except SystemExit:
+        raise
+    except BaseException:
+        # Don't leave the other ranks waiting for this one forever.
+        print(f'ERROR:  rank {comm.rank} failed:', file=sys.stderr)
+        traceback.print_exc()
+        sys.stderr.flush()
+        comm.Abort(1)
@@ -0,0 +1,492 @@
+'''
+Running the steps of generated target directories.
+
+``generate`` records each target directory's steps in a steps file:  each
+step's name, its "runcmd" with the step's variables substituted, and the
+steps it depends on (by default, the previous step).  The ``run`` command
+runs the steps of many target directories, each step once its dependencies
+in the same directory have completed, and records what has completed in a
+state file in each directory, so that a rerun skips it.
+
+Two schedulers run the commands:
+
+*   ``slurm`` runs each command as it is written, normally an ``sbatch``
+    command, and records the submitted job's ID.  A step counts as complete
+    once it is submitted; the IDs of the jobs it depends on that were
+    submitted in the same run are passed to ``sbatch`` in
+    ``SBATCH_DEPENDENCY``, unless its command specifies its own
+    ``--dependency``.
+
+*   ``local`` runs each command to completion, for testing without Slurm:
+    an ``sbatch`` command runs its batch script with ``bash`` instead.  Each
+    step's output is written to a log file in its target directory.
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+from typing import Optional
+
+
+RUN_STEPS_FILENAME = '.pertool_steps.json'
+RUN_STATE_FILENAME = '.pertool_run.json'
+RUN_STEPS_VERSION = 1
+
+SCHEDULERS = ['slurm', 'local']
+DEFAULT_SCHEDULER = 'slurm'
+
+DEFAULT_JOBS = 4
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_DELAY = 5.0 # in seconds
+DEFAULT_BATCH_DELAY = 1.0 # in seconds
+
+# The sbatch options that take their value as a separate argument
+SBATCH_SHORT_OPTIONS_WITH_VALUES = {'-A', '-a', '-b', '-C', '-c', '-D', '-d', '-e', '-F', '-G',
+                                    '-i', '-J', '-L', '-M', '-m', '-N', '-n', '-o', '-p', '-q',
+                                    '-S', '-t', '-w', '-x'}
+
+SBATCH_JOB_ID_REGEX = re.compile(r'Submitted batch job (\d+)|^(\d+)(?:;\S+)?$', re.MULTILINE)
+
+
+def init_parser(subparsers) -> None:
+    parser = subparsers.add_parser('run',
+        help='Run the steps of generated target directories.')
+
+    parser.add_argument('dirs', nargs='+', metavar='DIR',
+        help='Target directories written by the generate command.')
+
+    parser.add_argument('--scheduler', choices=SCHEDULERS, default=DEFAULT_SCHEDULER,
+        help='How to run each step\'s "runcmd":  "slurm" runs it as written ' +
+             '(normally submitting a batch job with sbatch), and a step is ' +
+             'complete once it is submitted; the jobs it depends on that were ' +
+             'submitted by the same run are passed to sbatch in ' +
+             'SBATCH_DEPENDENCY.  "local" runs it to ' +
+             'completion, running an sbatch command\'s batch script with ' +
+             'bash instead, and logs its output to "pertool-run-STEP.log" in ' +
+             f'the target directory.  Default is "{DEFAULT_SCHEDULER}".')
+
+    parser.add_argument('--steps', metavar='NAME,...',
+        help='Only run the specified steps.  Steps they depend on must ' +
+             'already be complete.')
+
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+        help='Number of step commands to run at once.  Default is ' +
+             f'{DEFAULT_JOBS}.')
+
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+        help='Number of times to retry a failed step command, e.g. when ' +
+             'sbatch can\'t reach the Slurm controller.  Default is ' +
+             f'{DEFAULT_RETRIES}.')
+
+    parser.add_argument('--retry-delay', type=float, default=DEFAULT_RETRY_DELAY,
+        help='Seconds to wait before the first retry of a failed step; each ' +
+             f'further retry waits twice as long.  Default is {DEFAULT_RETRY_DELAY}.')
+
+    parser.add_argument('--batch-size', type=int, default=0,
+        help='Pause for --batch-delay seconds after every BATCH_SIZE step ' +
+             'commands, to avoid flooding the scheduler with submissions.  ' +
+             'Default is 0, for no pauses.')
+
+    parser.add_argument('--batch-delay', type=float, default=DEFAULT_BATCH_DELAY,
+        help='Seconds to pause between batches of step commands.  Default ' +
+             f'is {DEFAULT_BATCH_DELAY}.')
+
+    parser.add_argument('--force', action='store_true',
+        help='Run steps again even if they have already completed.')
+
+    parser.add_argument('-n', '--dryrun', action='store_true',
+        help='Print the commands that would be run, without running them.')
+
+
+def write_run_steps(todir: str, steps: list):
+    '''
+    Write a target directory's steps file.  An unchanged steps file is left
+    untouched.
+    '''
+    filename = os.path.join(todir, RUN_STEPS_FILENAME)
+    contents = {'version': RUN_STEPS_VERSION, 'steps': steps}
+    try:
+        with open(filename) as f:
+            if json.load(f) == contents:
+                return
+    except (OSError, ValueError):
+        pass
+
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(contents, f, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+def load_run_steps(todir: str) -> list:
+    '''
+    Load a target directory's steps, in an order where every step comes
+    after the steps it depends on.  Raises ``ValueError`` if there is no
+    steps file, or the steps' dependencies are unknown or circular.
+    '''
+    filename = os.path.join(todir, RUN_STEPS_FILENAME)
+    try:
+        with open(filename) as f:
+            contents = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ValueError(f'Can\'t load "{filename}" ({e}); was "{todir}" ' +
+                         'written by the generate command?') from None
+
+    if contents.get('version') != RUN_STEPS_VERSION:
+        raise ValueError(f'"{filename}" has an unsupported version')
+
+    steps = {step['name']: step for step in contents['steps']}
+    for step in steps.values():
+        for dep in step['depends']:
+            if dep not in steps:
+                raise ValueError(f'Step "{step["name"]}" of "{todir}" depends on ' +
+                                 f'unknown step "{dep}"')
+
+    ordered = []
+    visiting = set()
+    def visit(name):
+        if any(step['name'] == name for step in ordered):
+            return
+        if name in visiting:
+            raise ValueError(f'The steps of "{todir}" have circular dependencies ' +
+                             f'involving "{name}"')
+        visiting.add(name)
+        for dep in steps[name]['depends']:
+            visit(dep)
+        ordered.append(steps[name])
+
+    for name in steps:
+        visit(name)
+
+    return ordered
+
+
+class RunState:
+    '''
+    The state file of a target directory, recording each step that has
+    completed, the command it ran and its Slurm job ID, if any.  A step is
+    only considered complete if its command hasn't changed since.
+    '''
+
+    def __init__(self, todir: str):
+        self.todir = todir
+        self.filename = os.path.join(todir, RUN_STATE_FILENAME)
+        self.steps = {}
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                contents = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if contents.get('version') == RUN_STEPS_VERSION:
+            self.steps = contents.get('steps', {})
+
+    def completed(self, step: dict) -> Optional[dict]:
+        '''
+        Return the step's state if it has completed with its current
+        command, or ``None``.
+        '''
+        entry = self.steps.get(step['name'])
+        if entry is not None and entry['runcmd'] == step['runcmd']:
+            return entry
+        return None
+
+    def complete(self, step: dict, jobid: Optional[str]):
+        '''
+        Record that the step has completed, and save the state.
+        '''
+        self.steps[step['name']] = {
+            'runcmd': step['runcmd'],
+            'jobid': jobid,
+            'time': time.time(),
+        }
+        tmp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'version': RUN_STEPS_VERSION, 'steps': self.steps}, f)
+        os.replace(tmp_filename, self.filename)
+
+
+def local_command(runcmd: str, todir: str) -> str:
+    '''
+    Return the command to run a step's "runcmd" locally:  an ``sbatch``
+    command's batch script and its arguments, run with ``bash``, or else
+    the command itself.
+    '''
+    words = shlex.split(runcmd)
+    if not words or os.path.basename(words[0]) != 'sbatch':
+        return runcmd
+
+    i = 1
+    while i < len(words) and words[i].startswith('-'):
+        if words[i].startswith('--wrap='):
+            return words[i][len('--wrap='):]
+
+        if words[i] in SBATCH_SHORT_OPTIONS_WITH_VALUES:
+            i += 1
+        elif (words[i].startswith('--') and '=' not in words[i] and i + 1 < len(words) and
+              not words[i + 1].startswith('-') and
+              not os.path.isfile(os.path.join(todir, words[i + 1]))):
+            # A long option with its value as a separate argument
+            i += 1
+        i += 1
+
+    if i >= len(words):
+        raise ValueError(f'No batch script found in "{runcmd}"')
+
+    return shlex.join(['bash'] + words[i:])
+
+
+class Task:
+    '''
+    One step of one target directory.
+    '''
+
+    def __init__(self, todir: str, dir_index: int, state: RunState, step: dict, rank: int):
+        self.todir = todir
+        self.dir_index = dir_index
+        self.state = state
+        self.step = step
+        self.rank = rank
+        self.deps = []
+        self.status = 'pending'
+        self.jobid = None
+        self.ran = False
+        self.attempts = 0
+        self.ready_at = 0.0
+        self.error = None
+
+    def name(self) -> str:
+        return f'{self.todir}:  step "{self.step["name"]}"'
+
+
+def run_task(task: Task, scheduler: str, dep_jobids: list) -> tuple[bool, Optional[str], str]:
+    '''
+    Run a task's command with the scheduler.  Returns whether it succeeded,
+    the Slurm job ID if one was submitted, and an error message if it
+    failed.
+    '''
+    runcmd = task.step['runcmd']
+    if scheduler == 'local':
+        log_name = re.sub(r'[^\w.-]', '_', task.step['name'])
+        with open(os.path.join(task.todir, f'pertool-run-{log_name}.log'), 'a') as log:
+            result = subprocess.run(local_command(runcmd, task.todir), shell=True,
+                cwd=task.todir, stdout=log, stderr=subprocess.STDOUT)
+        return (result.returncode == 0, None, f'exit status {result.returncode}')
+
+    env = dict(os.environ)
+    if dep_jobids and '--dependency' not in runcmd:
+        env['SBATCH_DEPENDENCY'] = 'afterok:' + ':'.join(dep_jobids)
+
+    result = subprocess.run(runcmd, shell=True, cwd=task.todir, env=env,
+        capture_output=True, text=True)
+    if result.returncode != 0:
+        message = result.stderr.strip().splitlines()
+        return (False, None, f'exit status {result.returncode}' +
+                (f':  {message[-1]}' if message else ''))
+
+    match = SBATCH_JOB_ID_REGEX.search(result.stdout)
+    jobid = (match.group(1) or match.group(2)) if match else None
+    return (True, jobid, '')
+
+
+def make_tasks(args, dirs: list) -> list:
+    '''
+    Make the tasks for the steps of every target directory, marking the ones
+    already completed.  Raises ``ValueError`` if a directory's steps can't be
+    loaded, or --steps names an unknown step.
+    '''
+    selected = None
+    if args.steps is not None:
+        selected = [name.strip() for name in args.steps.split(',') if name.strip()]
+
+    tasks = []
+    for (dir_index, todir) in enumerate(dirs):
+        steps = load_run_steps(todir)
+        names = [step['name'] for step in steps]
+        for name in selected or []:
+            if name not in names:
+                raise ValueError(f'"{todir}" has no step "{name}"; its steps are ' +
+                                 ', '.join(names))
+
+        state = RunState(todir)
+        state.load()
+
+        dir_tasks = {}
+        for (rank, step) in enumerate(steps):
+            task = Task(todir, dir_index, state, step, rank)
+            task.deps = [dir_tasks[dep] for dep in step['depends']]
+            dir_tasks[step['name']] = task
+
+            # --force only applies to the selected steps
+            entry = state.completed(step)
+            unselected = selected is not None and step['name'] not in selected
+            if step['runcmd'] is None:
+                task.status = 'done'
+            elif entry is not None and (unselected or not args.force):
+                task.status = 'done'
+                task.jobid = entry['jobid']
+            elif unselected:
+                task.status = 'unselected'
+
+            tasks.append(task)
+
+    return tasks
+
+
+def run_tasks(args, tasks: list) -> tuple[int, list]:
+    '''
+    Run the pending tasks, each once its dependencies are done, with up to
+    --jobs running at once.  Tasks are started in order of their step's
+    position, then their target directory's, so that each step is started
+    in every directory before the next.  Returns the number of tasks run,
+    and the tasks that failed or couldn't run.
+    '''
+    pending = sorted((task for task in tasks if task.status == 'pending'),
+                     key=lambda task: (task.rank, task.dir_index))
+    total = len(pending)
+    finished = 0
+    started = 0
+    failed = []
+
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        running = {}
+        while pending or running:
+            now = time.monotonic()
+            for task in list(pending):
+                if len(running) >= args.jobs:
+                    break
+
+                blockers = [dep for dep in task.deps if dep.status in ('failed', 'blocked', 'unselected')]
+                if blockers:
+                    pending.remove(task)
+                    task.status = 'blocked'
+                    task.error = f'step "{blockers[0].step["name"]}" didn\'t complete'
+                    failed.append(task)
+                    finished += 1
+                    print(f'[{finished}/{total}] {task.name()} skipped:  {task.error}')
+                    continue
+
+                if task.ready_at > now or any(dep.status != 'done' for dep in task.deps):
+                    continue
+
+                if args.batch_size > 0 and started > 0 and started % args.batch_size == 0:
+                    time.sleep(args.batch_delay)
+
+                pending.remove(task)
+                task.status = 'running'
+                task.attempts += 1
+                started += 1
+                # Jobs from earlier runs may be long gone, so only depend on
+                # the ones submitted by this run
+                dep_jobids = [dep.jobid for dep in task.deps if dep.ran and dep.jobid is not None]
+                future = executor.submit(run_task, task, args.scheduler, dep_jobids)
+                running[future] = task
+
+            # Wake up for the next retry whose delay runs out, if any.  Tasks
+            # waiting on a retrying dependency have no delay of their own.
+            waiting = [task.ready_at for task in pending if task.ready_at > now]
+            timeout = min(waiting) - now if waiting else None
+
+            if not running:
+                if timeout is not None:
+                    time.sleep(timeout)
+                continue
+
+            (done, _) = concurrent.futures.wait(running, timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    (ok, jobid, error) = future.result()
+                except (OSError, ValueError) as e:
+                    (ok, jobid, error) = (False, None, f'{type(e).__name__}:  {e}')
+
+                if ok:
+                    task.status = 'done'
+                    task.jobid = jobid
+                    task.ran = True
+                    task.state.complete(task.step, jobid)
+                    finished += 1
+                    job = f' (job {jobid})' if jobid is not None else ''
+                    print(f'[{finished}/{total}] {task.name()} done{job}')
+
+                elif task.attempts <= args.retries:
+                    delay = args.retry_delay * 2 ** (task.attempts - 1)
+                    print(f'WARNING:  {task.name()} failed ({error}); retrying in {delay:g}s ' +
+                          f'(attempt {task.attempts + 1} of {args.retries + 1})')
+                    task.status = 'pending'
+                    task.ready_at = time.monotonic() + delay
+                    pending.insert(0, task)
+
+                else:
+                    task.status = 'failed'
+                    task.error = error
+                    failed.append(task)
+                    finished += 1
+                    print(f'[{finished}/{total}] {task.name()} FAILED:  {error}')
+
+    return (total, failed)
+
+
+def main(args: Optional[argparse.Namespace]=None) -> None:
+    if args is None:
+        parser = argparse.ArgumentParser(description='Run the steps of ' +
+            'generated target directories.')
+        init_parser(parser)
+        args = parser.parse_args()
+
+    if args.jobs < 1:
+        print(f'ERROR:  Number of jobs must be positive; got {args.jobs}')
+        sys.exit(1)
+
+    if args.retries < 0 or args.batch_size < 0:
+        print('ERROR:  --retries and --batch-size can\'t be negative')
+        sys.exit(1)
+
+    for todir in args.dirs:
+        if not os.path.isdir(todir):
+            print(f'ERROR:  "{todir}" is not a directory')
+            sys.exit(1)
+
+    try:
+        tasks = make_tasks(args, args.dirs)
+    except ValueError as e:
+        print(f'ERROR:  {e}')
+        sys.exit(1)
+
+    num_done = sum(1 for task in tasks if task.status == 'done' and task.step['runcmd'])
+    num_pending = sum(1 for task in tasks if task.status == 'pending')
+    print(f'{len(args.dirs)} target directories:  {num_pending} steps to run, ' +
+          f'{num_done} already complete')
+
+    if args.dryrun:
+        pending = sorted((task for task in tasks if task.status == 'pending'),
+                         key=lambda task: (task.rank, task.dir_index))
+        for task in pending:
+            runcmd = task.step['runcmd']
+            try:
+                if args.scheduler == 'local':
+                    runcmd = local_command(runcmd, task.todir)
+            except ValueError as e:
+                runcmd = f'ERROR:  {e}'
+            print(f'{task.name()}:  {runcmd}')
+        return
+
+    (total, failed) = run_tasks(args, tasks)
+
+    if failed:
+        print(f'\nERROR:  {len(failed)} of {total} steps didn\'t complete:')
+        for task in failed:
+            print(f' * {task.name()}:  {task.error}')
+        sys.exit(1)
+
+    print('\nDone!')
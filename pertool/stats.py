@@ -0,0 +1,154 @@
+'''
+Lightweight per-process instrumentation for the analyze and reshape
+operations.
+
+Each process accumulates wall-clock time per phase (e.g. "hdf5_open",
+"read", "write", "queue_wait"), named counters (e.g. "bytes_read",
+"datasets_written") and per-file versions of both.  Subprocess functions
+call ``reset()`` when they start and send ``snapshot()`` back to the parent
+process, which combines them with ``merge()``.  Phase times are summed over
+all processes, so in multiprocessing runs they can add up to more than the
+elapsed time.
+'''
+
+import contextlib
+import json
+import time
+
+
+_phases = {}
+_counters = {}
+_files = {}
+
+
+def reset():
+    '''
+    Discard all statistics recorded in this process.
+    '''
+    _phases.clear()
+    _counters.clear()
+    _files.clear()
+
+
+def add_time(phase, seconds, filename=None):
+    '''
+    Add ``seconds`` of wall-clock time to the specified phase, and also to
+    the phase for the specified file if ``filename`` is given.
+    '''
+    _phases[phase] = _phases.get(phase, 0.0) + seconds
+    if filename is not None:
+        f = _files.setdefault(filename, {})
+        key = f'{phase}_seconds'
+        f[key] = f.get(key, 0.0) + seconds
+
+
+def add(counter, value=1, filename=None):
+    '''
+    Add ``value`` to the specified counter, and also to the counter for the
+    specified file if ``filename`` is given.
+    '''
+    _counters[counter] = _counters.get(counter, 0) + value
+    if filename is not None:
+        f = _files.setdefault(filename, {})
+        f[counter] = f.get(counter, 0) + value
+
+
+@contextlib.contextmanager
+def phase(name, filename=None):
+    '''
+    Context manager that records the time spent in its body against the
+    specified phase (and file).
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start, filename)
+
+
+def snapshot() -> dict:
+    '''
+    Return a copy of the statistics recorded in this process, as a plain
+    dictionary that can be sent to another process.
+    '''
+    return {
+        'phases': dict(_phases),
+        'counters': dict(_counters),
+        'files': {name: dict(values) for (name, values) in _files.items()},
+    }
+
+
+def merge(snap):
+    '''
+    Add the statistics in a ``snapshot()`` from another process to the
+    statistics recorded in this process.
+    '''
+    if not snap:
+        return
+
+    for (name, seconds) in snap['phases'].items():
+        _phases[name] = _phases.get(name, 0.0) + seconds
+
+    for (name, value) in snap['counters'].items():
+        _counters[name] = _counters.get(name, 0) + value
+
+    for (filename, values) in snap['files'].items():
+        f = _files.setdefault(filename, {})
+        for (name, value) in values.items():
+            f[name] = f.get(name, 0) + value
+
+
+def report(elapsed=None, max_files=10):
+    '''
+    Print a summary of the recorded statistics.  Only the ``max_files``
+    files with the most recorded time are listed.
+    '''
+    print('\nPerformance statistics:')
+    if elapsed is not None:
+        print(f'  elapsed                 {elapsed:12.3f} s')
+
+    for (name, seconds) in sorted(_phases.items(), key=lambda item: -item[1]):
+        print(f'  {name:24}{seconds:12.3f} s')
+
+    for (name, value) in sorted(_counters.items()):
+        if name.startswith('bytes'):
+            print(f'  {name:24}{value / 1e6:12.1f} MB')
+        else:
+            print(f'  {name:24}{value:12}')
+
+    if _files:
+        def file_seconds(item):
+            return sum(v for (k, v) in item[1].items() if k.endswith('_seconds'))
+
+        files = sorted(_files.items(), key=file_seconds, reverse=True)
+        print(f'\n  Slowest files (of {len(files)}):')
+        for (filename, values) in files[:max_files]:
+            details = '  '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}'
+                                for (k, v) in sorted(values.items()))
+            print(f'  * {filename}:  {details}')
+
+
+def write_json(path, elapsed=None, **extra):
+    '''
+    Write the recorded statistics to the specified file as JSON, along with
+    the total elapsed time and any other ``extra`` values.
+    '''
+    contents = snapshot()
+    contents['elapsed_seconds'] = elapsed
+    contents.update(extra)
+    with open(path, 'w') as f:
+        json.dump(contents, f, indent=2)
+
+
+def emit(elapsed, profile=False, json_path=None, **extra):
+    '''
+    Report the recorded statistics as requested on the command line:  print
+    a summary if ``profile`` is set, and write JSON to ``json_path`` if it
+    is specified.
+    '''
+    if profile:
+        report(elapsed)
+
+    if json_path:
+        write_json(json_path, elapsed, **extra)
+        print(f'\nWrote performance statistics to {json_path}')
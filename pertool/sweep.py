@@ -0,0 +1,329 @@
+'''
+Parameter sweeps for the generate command.
+
+A sweep is made of axes, constraints and optional sampling:
+
+*   Each axis gives a list of values for one variable (a "foreach" axis), or
+    lists of paired values for several variables, which change together
+    (a "zip" axis).  The sweep's points are every combination of one value
+    of each axis, with the first axis changing slowest.
+
+*   Constraints are Python expressions over the variables, such as
+    ``nodes * 4 <= mpi_tasks``, and only points where all of them are true
+    are kept.  Variable values are strings, but in constraints, values that
+    look like numbers are converted to ``int`` or ``float``.
+
+*   Sampling keeps a fixed number of the points, chosen either uniformly at
+    random from the points that meet the constraints, or by Latin-hypercube
+    sampling of the axes (after which the constraints are applied, so fewer
+    points may remain).
+
+Points are generated lazily, so a sweep over millions of combinations can be
+filtered and sampled without ever holding them all in memory.
+
+Axis values can be given as lists, and numeric ranges as "FIRST:LAST" or
+"FIRST:LAST:STEP", inclusive.  In a config file, a sweep is specified as:
+
+    "sweep": {
+        "foreach": {"nodes": [1, 2, 4, 8], "gridsize": "100:200:50"},
+        "zip": [{"cdyn_impl": ["std", "tgt"], "job_suffix": ["s", "t"]}],
+        "where": ["gridsize >= 150 or nodes < 4"],
+        "sample": {"count": 20, "method": "lhs", "seed": 1}
+    }
+'''
+
+import itertools
+import math
+import random
+import re
+
+from typing import Iterator, Optional
+
+
+SAMPLE_METHODS = ['random', 'lhs']
+DEFAULT_SAMPLE_METHOD = 'random'
+
+RANGE_REGEX = re.compile(r'(-?\d+):(-?\d+)(?::(\d+))?')
+INT_REGEX = re.compile(r'-?(0|[1-9]\d*)')
+
+# The functions available to constraint expressions
+CONSTRAINT_FUNCTIONS = {
+    'abs': abs, 'float': float, 'int': int, 'len': len, 'max': max, 'min': min,
+    'round': round, 'str': str,
+}
+
+
+def expand_values(values: list) -> list:
+    '''
+    Expand any numeric ranges ("FIRST:LAST" or "FIRST:LAST:STEP",
+    inclusive) in a list of axis values, and convert all values to strings,
+    as they would be given on the command line.
+    '''
+    result = []
+    for value in values:
+        value = str(value).strip()
+        match = RANGE_REGEX.fullmatch(value)
+        if match:
+            (first, last) = (int(match.group(1)), int(match.group(2)))
+            step = int(match.group(3)) if match.group(3) else 1
+            if step < 1 or last < first:
+                raise ValueError(f'Bad range "{value}":  expected FIRST <= LAST and STEP >= 1')
+            result.extend(str(v) for v in range(first, last + 1, step))
+        else:
+            result.append(value)
+    return result
+
+
+def constraint_value(value):
+    '''
+    Return a variable's value as it is seen by constraint expressions:
+    strings that look like integers or floats are converted to numbers.
+    '''
+    if not isinstance(value, str):
+        return value
+
+    if INT_REGEX.fullmatch(value):
+        return int(value)
+
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class Sweep:
+    '''
+    A lazily-generated parameter sweep; see the module documentation.
+    '''
+
+    def __init__(self):
+        # Each axis is a (names, values) pair, where values is a list of
+        # tuples with one value per name.
+        self.axes = []
+        self.constraints = []
+        self.sample_count = None
+        self.sample_method = DEFAULT_SAMPLE_METHOD
+        self.seed = None
+
+    def names(self) -> list:
+        return [name for (names, _) in self.axes for name in names]
+
+    def add_axis(self, names: list, value_lists: list):
+        '''
+        Add an axis over the specified variables.  ``value_lists`` has one
+        list of values per variable, all the same length; with one variable
+        this is an ordinary "foreach" axis.
+        '''
+        value_lists = [expand_values(values) for values in value_lists]
+        if len(names) != len(value_lists):
+            raise ValueError(f'Axis {",".join(names)} has {len(names)} names but ' +
+                             f'{len(value_lists)} value lists')
+
+        if any(len(values) == 0 for values in value_lists):
+            raise ValueError(f'Axis {",".join(names)} has no values')
+
+        if len(set(len(values) for values in value_lists)) != 1:
+            raise ValueError(f'Paired variables {",".join(names)} have different numbers of values')
+
+        for name in names:
+            if name in self.names():
+                raise ValueError(f'Variable "{name}" is swept more than once')
+
+        self.axes.append( (list(names), list(zip(*value_lists))) )
+
+    def add_constraint(self, expr: str):
+        '''
+        Add a constraint expression.  Raises ``SyntaxError`` if it isn't a
+        valid Python expression.
+        '''
+        self.constraints.append( (expr, compile(expr, '<constraint>', 'eval')) )
+
+    def set_sample(self, count: Optional[int], method=DEFAULT_SAMPLE_METHOD, seed=None):
+        if count is not None and count < 1:
+            raise ValueError(f'Sample count must be positive; got {count}')
+        if method not in SAMPLE_METHODS:
+            raise ValueError(f'Unknown sampling method "{method}"; expected one of {SAMPLE_METHODS}')
+        self.sample_count = count
+        self.sample_method = method
+        self.seed = seed
+
+    def size(self) -> int:
+        '''
+        Return the number of points in the sweep, before constraints and
+        sampling.
+        '''
+        return math.prod(len(values) for (_, values) in self.axes)
+
+    def point(self, indexes) -> dict:
+        '''
+        Return the variables of the point with the specified value index
+        along each axis.
+        '''
+        variables = {}
+        for ((names, values), i) in zip(self.axes, indexes):
+            variables.update(zip(names, values[i]))
+        return variables
+
+    def satisfies(self, variables: dict) -> bool:
+        '''
+        Return whether the variables meet all of the constraints.  Raises
+        ``ValueError`` if a constraint can't be evaluated.
+        '''
+        namespace = {name: constraint_value(value) for (name, value) in variables.items()}
+        return self._satisfies(namespace)
+
+    def _satisfies(self, namespace: dict) -> bool:
+        # Like satisfies(), for variables already converted by
+        # constraint_value()
+        namespace['__builtins__'] = CONSTRAINT_FUNCTIONS
+        for (expr, code) in self.constraints:
+            try:
+                if not eval(code, namespace):
+                    return False
+            except Exception as e:
+                raise ValueError(f'Can\'t evaluate constraint "{expr}":  ' +
+                                 f'{type(e).__name__}:  {e}') from None
+        return True
+
+    def _all_indexes(self) -> Iterator[tuple]:
+        return itertools.product(*[range(len(values)) for (_, values) in self.axes])
+
+    def _lhs_indexes(self, rng) -> list:
+        # Latin-hypercube sample of the axes:  each axis is divided into
+        # sample_count strata, and each stratum is used by exactly one
+        # sample.  Duplicates are dropped, and the samples are sorted into
+        # sweep order.
+        if not self.axes:
+            # Like an unsampled sweep, a sweep with no axes has one point
+            return [()]
+
+        n = self.sample_count
+        columns = []
+        for (_, values) in self.axes:
+            strata = list(range(n))
+            rng.shuffle(strata)
+            columns.append([int((s + rng.random()) * len(values) / n) for s in strata])
+        return sorted(set(zip(*columns)))
+
+    def _sampled_indexes(self, accept) -> Iterator[tuple]:
+        rng = random.Random(self.seed)
+        if self.sample_method == 'lhs':
+            return iter(self._lhs_indexes(rng))
+
+        # Reservoir sampling of the points that meet the constraints, which
+        # only ever holds sample_count of them.
+        reservoir = []
+        for (seen, indexes) in enumerate(filter(accept, self._all_indexes())):
+            if seen < self.sample_count:
+                reservoir.append(indexes)
+            else:
+                j = rng.randrange(seen + 1)
+                if j < self.sample_count:
+                    reservoir[j] = indexes
+        return iter(sorted(reservoir))
+
+    def bindings(self, fixed_vars: Optional[dict]=None) -> Iterator[dict]:
+        '''
+        Generate the swept variables of every selected point of the sweep, in
+        sweep order.  Constraints see the point's variables on top of
+        ``fixed_vars``, the variables that don't change.
+        '''
+        # Convert every value for the constraints once, not once per point
+        fixed_namespace = {name: constraint_value(value)
+                           for (name, value) in (fixed_vars or {}).items()}
+        axis_namespaces = [[{name: constraint_value(value) for (name, value) in zip(names, tup)}
+                            for tup in values]
+                           for (names, values) in self.axes]
+
+        def accept(indexes):
+            if not self.constraints:
+                return True
+            namespace = dict(fixed_namespace)
+            for (namespaces, i) in zip(axis_namespaces, indexes):
+                namespace.update(namespaces[i])
+            return self._satisfies(namespace)
+
+        if self.sample_count is None:
+            candidates = filter(accept, self._all_indexes())
+        elif self.sample_method == 'random':
+            # The constraints are checked while sampling
+            candidates = self._sampled_indexes(accept)
+        else:
+            candidates = filter(accept, self._sampled_indexes(accept))
+
+        for indexes in candidates:
+            yield self.point(indexes)
+
+
+def parse_value_list(s: str, text: str) -> list:
+    '''
+    Parse a "[v1,v2,...]" value list from a command-line argument ``s``.
+    Values may be ranges; see ``expand_values()``.
+    '''
+    text = text.strip()
+    if len(text) < 2 or text[0] != '[' or text[-1] != ']':
+        raise ValueError(f'Bad argument "{s}":  no [] around value-list')
+
+    values = [v.strip() for v in text[1:-1].split(',')]
+    values = [v for v in values if len(v) > 0]
+    if len(values) == 0:
+        raise ValueError(f'Bad argument "{s}":  no values found in list')
+
+    return expand_values(values)
+
+
+def parse_arg_zip(s: str) -> tuple[list, list]:
+    '''
+    Parse a --zip NAME1,NAME2=[A1,A2,...],[B1,B2,...] argument into a list of
+    names and a list of value lists.
+    '''
+    (names, eq, lists) = s.partition('=')
+    if not eq:
+        raise ValueError(f'Bad --zip argument "{s}":  missing =')
+
+    names = [name.strip() for name in names.split(',')]
+    value_lists = [parse_value_list(s, f'[{text}]')
+                   for text in re.findall(r'\[([^\]]*)\]', lists)]
+    if re.sub(r'\[[^\]]*\]', '', lists).strip(' ,'):
+        raise ValueError(f'Bad --zip argument "{s}":  expected [..],[..] value lists')
+
+    return (names, value_lists)
+
+
+def add_config_sweep(sweep: Sweep, config: dict):
+    '''
+    Add the sweep specified in a config file's "sweep" section, if any, to
+    ``sweep``.  Raises ``ValueError`` if it is malformed.
+    '''
+    spec = config.get('sweep')
+    if not spec:
+        return
+
+    if not isinstance(spec, dict):
+        raise ValueError('The config file\'s "sweep" must be a dictionary')
+
+    for (name, values) in spec.get('foreach', {}).items():
+        if not isinstance(values, list):
+            values = [values]
+        sweep.add_axis([name], [values])
+
+    for group in spec.get('zip', []):
+        if not isinstance(group, dict):
+            raise ValueError(f'Bad zip group {group} in the config file\'s sweep:  ' +
+                             'expected a dictionary of value lists')
+        sweep.add_axis(list(group.keys()),
+                       [values if isinstance(values, list) else [values]
+                        for values in group.values()])
+
+    where = spec.get('where', [])
+    for expr in [where] if isinstance(where, str) else where:
+        try:
+            sweep.add_constraint(expr)
+        except SyntaxError as e:
+            raise ValueError(f'Bad "where" expression "{expr}" in the config file\'s sweep:  ' +
+                             f'{e.msg}') from None
+
+    sample = spec.get('sample')
+    if sample:
+        sweep.set_sample(sample.get('count'), sample.get('method', DEFAULT_SAMPLE_METHOD),
+                         sample.get('seed'))
@@ -0,0 +1,379 @@
+'''
+Verification that a set of pool files holds exactly the same data as
+another set with a different number of pools, e.g. a reshape's target
+directory and its source directory.
+
+Every dataset is checksummed, and the checksums of the two sets are compared
+k-location by k-location, undoing each set's round-robin assignment of
+k-locations to pools.  If the source set has a selection of k-locations
+(see ``PoolFileSet.select_klocs()``), only those are checksummed, and the
+target set must hold them in order.
+
+Checksums cover each dataset's type, shape and decoded contents, so they
+don't depend on the datasets' chunking or compression.  Datasets are read in
+slabs of a bounded size, and with ``--mp`` the files are checksummed in
+parallel.
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import zlib
+
+import numpy as np
+
+# Optional:  a much faster checksum than CRC-32, if installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from .poolfiles import *
+from .manifest import ScanManifest
+from . import stats
+
+
+DEFAULT_VERIFY_BUFFER_MB = 64
+
+# Number of mismatched k-locations to report in detail
+MAX_REPORTED_MISMATCHES = 10
+
+
+def init_parser(subparsers):
+    parser = subparsers.add_parser('verify',
+        help='Verify that reshaped Perturbo tmp/ pool files hold the same data as their source.')
+
+    parser.add_argument('-f', '--fromdir', default=DEFAULT_FROMDIR,
+        help=f'Source directory to read eph_g2_p*.h5 files from.  Default is {DEFAULT_FROMDIR}.')
+
+    parser.add_argument('-t', '--todir', required=True,
+        help='Reshaped directory of eph_g2_p*.h5 files to verify against the source.')
+
+    parser.add_argument('--krange', metavar='FIRST:LAST[:STEP]',
+        help='Verify a reshape made with the same --krange option.')
+
+    parser.add_argument('--klist', metavar='LIST',
+        help='Verify a reshape made with the same --klist option.')
+
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='Run in "quiet mode," with a minimum of output.')
+
+    parser.add_argument('--mp', action='store_true',
+        help='Use multiprocessing to checksum files in parallel.')
+
+    parser.add_argument('-M', '--max-processes', type=int, default=DEFAULT_MAX_PROCESSES,
+        help=f'Specify maximum number of subprocesses to use.  Default is {DEFAULT_MAX_PROCESSES}.')
+
+    parser.add_argument('--buffer', type=int, default=DEFAULT_VERIFY_BUFFER_MB, metavar='MB',
+        help='Maximum amount of a dataset read at a time by each process, ' +
+             f'in megabytes.  Default is {DEFAULT_VERIFY_BUFFER_MB}.')
+
+    parser.add_argument('--profile', action='store_true',
+        help='Report per-phase timings and the slowest files when finished.')
+
+    parser.add_argument('--stats-json', metavar='PATH',
+        help='Write per-phase and per-file timings and I/O statistics to ' +
+             'the specified JSON file when finished.')
+
+    parser.add_argument('--no-cache', action='store_true',
+        help='Always rescan every source file, ignoring and not writing the scan manifest.')
+
+    parser.add_argument('--cache-dir',
+        help='Directory to keep the scan manifest in.  Default is the source ' +
+             'directory, or the user cache directory if that isn\'t writable.')
+
+
+def check_args(args):
+    # Check arguments
+
+    for path in (args.fromdir, args.todir):
+        if not os.path.isdir(path):
+            print(f'ERROR:  {path} is not a directory')
+            sys.exit(1)
+
+    if args.buffer < 1:
+        print(f'ERROR:  Buffer size must be positive; got {args.buffer}')
+        sys.exit(1)
+
+    if args.mp:
+        print(f'\nUsing multiprocessing to speed up performance.  Max processes = {args.max_processes}.')
+
+
+def new_checksum():
+    # A new checksum object, with update() and hexdigest() methods
+    if xxhash is not None:
+        return xxhash.xxh3_64()
+    return Crc32()
+
+
+class Crc32:
+    '''
+    CRC-32 checksum with the same interface as the ``hashlib`` and
+    ``xxhash`` objects, for when ``xxhash`` isn't installed.
+    '''
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self) -> str:
+        return f'{self.crc:08x}'
+
+
+def checksum_dataset(ds, buffer_size) -> str:
+    '''
+    Return a checksum of a dataset's type, shape and contents.  The
+    contents are read in slabs along the first axis of at most
+    ``buffer_size`` bytes (or one row, if that is larger), aligned to the
+    dataset's chunks, so each chunk is only decompressed once.
+    '''
+    h = new_checksum()
+    h.update(f'{ds.dtype.str}{ds.shape}'.encode())
+
+    if ds.ndim == 0 or ds.size == 0:
+        h.update(np.ascontiguousarray(ds[()]).tobytes())
+        stats.add('bytes_checksummed', ds.dtype.itemsize * ds.size)
+        return h.hexdigest()
+
+    row_bytes = max(1, ds.dtype.itemsize * (ds.size // ds.shape[0]))
+    rows = max(1, buffer_size // row_bytes)
+    if ds.chunks is not None:
+        rows = max(1, rows // ds.chunks[0]) * ds.chunks[0]
+
+    for start in range(0, ds.shape[0], rows):
+        data = np.ascontiguousarray(ds[start:start + rows])
+        h.update(data.data)
+        stats.add('bytes_checksummed', data.nbytes)
+
+    return h.hexdigest()
+
+
+def checksum_pool_file(filename, pool, indexes, buffer_size) -> dict:
+    '''
+    Return the ``(eph_g2, bands_index)`` checksums of the k-locations of a
+    pool file at the specified (zero-based) indexes, as a dictionary keyed
+    by index.
+    '''
+    f = PoolFile(filename, pool)
+    f.open('r')
+    try:
+        sums = {}
+        with stats.phase('checksum', filename):
+            for i in indexes:
+                sums[i] = (checksum_dataset(f.get_eph_g2(i + 1), buffer_size),
+                           checksum_dataset(f.get_bands_index(i + 1), buffer_size))
+        return sums
+    finally:
+        f.close()
+
+
+def mp_checksum_pool_file(filename, pool, indexes, buffer_size):
+    '''
+    Subprocess function for ``checksum_pool_file()``, which also returns a
+    snapshot of the statistics recorded while checksumming.
+    '''
+    stats.reset()
+    task_start = time.perf_counter()
+    sums = checksum_pool_file(filename, pool, indexes, buffer_size)
+    stats.add_time('task', time.perf_counter() - task_start)
+    return (sums, stats.snapshot())
+
+
+def pool_indexes(pfset) -> dict:
+    '''
+    Return the (zero-based) indexes of the k-locations to checksum in each
+    pool of a scanned pool-file set:  all of them, or only the selected
+    ones if the set has a selection.
+    '''
+    if pfset.selection is None:
+        return {pool: range(f.nk_loc) for (pool, f) in pfset.pool_files.items()}
+
+    indexes = {pool: [] for pool in pfset.pool_files}
+    for i_kloc in pfset.selection:
+        (pool, idx) = kloc_index_to_pool_index(i_kloc, pfset.num_pools)
+        indexes[pool + 1].append(idx)
+    return indexes
+
+
+def checksum_pool_files(pfset, buffer_size, pools=None, max_processes=None) -> dict:
+    '''
+    Checksum the specified pools of a scanned pool-file set (by default,
+    all of them), returning a dictionary of each pool's checksums from
+    ``checksum_pool_file()``.  If ``max_processes`` is given, the files are
+    checksummed in parallel with that many subprocesses.
+    '''
+    indexes = pool_indexes(pfset)
+    if pools is None:
+        pools = sorted(pfset.pool_files.keys())
+    pools = [pool for pool in pools if len(indexes[pool]) > 0]
+
+    if max_processes is None:
+        return {pool: checksum_pool_file(pfset.pool_files[pool].filename, pool,
+                                         indexes[pool], buffer_size)
+                for pool in pools}
+
+    exec_pool = multiprocessing.Pool(max_processes)
+    results = []
+    for pool in pools:
+        r = exec_pool.apply_async(mp_checksum_pool_file,
+            (pfset.pool_files[pool].filename, pool, indexes[pool], buffer_size))
+        results.append( (pool, r) )
+    exec_pool.close()
+
+    sums = {}
+    errors = 0
+    for (pool, r) in results:
+        try:
+            (sums[pool], snap) = r.get()
+            stats.merge(snap)
+        except BaseException as err:
+            print(f'ERROR:  exception while checksumming pool-file {pool}:')
+            traceback.print_exception(err)
+            errors += 1
+
+    exec_pool.join()
+
+    if errors:
+        raise RuntimeError(f'{errors} error(s) detected while checksumming pool files')
+
+    return sums
+
+
+def global_checksums(pfset, sums) -> dict:
+    '''
+    Arrange the per-pool checksums of a pool-file set by global (zero-based)
+    k-location, undoing the round-robin assignment of k-locations to pools.
+    '''
+    result = {}
+    for (pool, pool_sums) in sums.items():
+        for (idx, value) in pool_sums.items():
+            result[idx * pfset.num_pools + pool - 1] = value
+    return result
+
+
+def compare_checksums(sfset, src_sums, tfset, tgt_sums) -> list:
+    '''
+    Compare the checksums of two pool-file sets, and return a list of
+    descriptions of the differences, which is empty if the sets hold the
+    same data.
+    '''
+    if sfset.num_selected() != tfset.nkpt:
+        return [f'{tfset.path} has {tfset.nkpt} k-locations, but ' +
+                f'{sfset.num_selected()} are expected from {sfset.path}']
+
+    src_klocs = sfset.selection if sfset.selection is not None else range(sfset.nkpt)
+
+    mismatches = []
+    src_global = global_checksums(sfset, src_sums)
+    tgt_global = global_checksums(tfset, tgt_sums)
+    for (tgt_kloc, src_kloc) in enumerate(src_klocs):
+        for (i, name) in enumerate(('eph_g2', 'bands_index')):
+            if src_global[src_kloc][i] == tgt_global[tgt_kloc][i]:
+                continue
+
+            (src_pool, src_idx) = kloc_index_to_pool_index(src_kloc, sfset.num_pools)
+            (tgt_pool, tgt_idx) = kloc_index_to_pool_index(tgt_kloc, tfset.num_pools)
+            mismatches.append(f'k-location {tgt_kloc + 1}:  {name}_{tgt_idx + 1} of target ' +
+                f'pool {tgt_pool + 1} doesn\'t match {name}_{src_idx + 1} of source ' +
+                f'pool {src_pool + 1}')
+
+    return mismatches
+
+
+def report_mismatches(mismatches) -> bool:
+    '''
+    Print the result of ``compare_checksums()``, and return whether the
+    data matched.
+    '''
+    if not mismatches:
+        print('All datasets match.')
+        return True
+
+    print(f'ERROR:  Found {len(mismatches)} mismatched dataset(s):')
+    for mismatch in mismatches[:MAX_REPORTED_MISMATCHES]:
+        print(f' * {mismatch}')
+    if len(mismatches) > MAX_REPORTED_MISMATCHES:
+        print(f'   ... and {len(mismatches) - MAX_REPORTED_MISMATCHES} more')
+    return False
+
+
+def verify_pool_sets(args, sfset, tfset, buffer_size) -> bool:
+    '''
+    Checksum two scanned pool-file sets, which must not be open, and report
+    whether they hold the same data.
+    '''
+    print(f'\nVerifying {tfset.path} against {sfset.path}')
+    if sfset.num_selected() != tfset.nkpt:
+        return report_mismatches(compare_checksums(sfset, {}, tfset, {}))
+
+    max_processes = args.max_processes if args.mp else None
+    with stats.phase('stage_verify'):
+        src_sums = checksum_pool_files(sfset, buffer_size, max_processes=max_processes)
+        tgt_sums = checksum_pool_files(tfset, buffer_size, max_processes=max_processes)
+
+    return report_mismatches(compare_checksums(sfset, src_sums, tfset, tgt_sums))
+
+
+def scan_pool_directory(args, path, what, use_manifest=True):
+    '''
+    Find and scan the pool files in a directory, leaving them closed.  The
+    scan manifest is only used if ``use_manifest`` is true, so that none is
+    written into e.g. a reshape's target directory.
+    '''
+    print(f'\nScanning {what} directory {path}')
+
+    pfset = PoolFileSet(path)
+    pfset.find_files()
+    if pfset.num_pools == 0:
+        print(f'ERROR:  Found no pool data files in {what} directory, aborting.')
+        sys.exit(1)
+
+    manifest = None
+    if use_manifest and not args.no_cache:
+        manifest = ScanManifest(path, cache_dir=args.cache_dir)
+        manifest.load()
+
+    if args.mp:
+        pfset.scan_files_mp(max_processes=args.max_processes, manifest=manifest,
+            keep_open=False)
+    else:
+        pfset.scan_files(manifest=manifest, keep_open=False)
+
+    if not args.quiet:
+        print(f'Found {pfset.num_pools} files.  Total k-grid points:  {pfset.nkpt}\t' +
+              f'Total k-q pairs:  {pfset.nkq}')
+
+    return pfset
+
+
+def main(args):
+    start = time.perf_counter()
+    check_args(args)
+
+    with stats.phase('stage_scan'):
+        sfset = scan_pool_directory(args, args.fromdir, 'source')
+        tfset = scan_pool_directory(args, args.todir, 'target', use_manifest=False)
+
+    if args.krange or args.klist:
+        try:
+            sfset.select_klocs(parse_kloc_selection(args.krange, args.klist, sfset.nkpt))
+        except (OSError, ValueError) as e:
+            print(f'ERROR:  Invalid k-location selection:  {e}')
+            sys.exit(1)
+
+    matched = verify_pool_sets(args, sfset, tfset, args.buffer * 1024 * 1024)
+
+    stats.emit(time.perf_counter() - start, args.profile, args.stats_json,
+        command='verify', src_pools=sfset.num_pools, tgt_pools=tfset.num_pools,
+        nkpt=sfset.nkpt, nkq=sfset.nkq, matched=matched)
+
+    if not matched:
+        sys.exit(1)
+
+    print('\nDone!')
+    sys.exit(0)